@@ -1,27 +1,51 @@
-from fastapi import FastAPI, APIRouter, HTTPException, UploadFile, File
-from fastapi.responses import StreamingResponse, FileResponse
+from fastapi import FastAPI, APIRouter, HTTPException, UploadFile, File, Request
+from fastapi.responses import StreamingResponse, FileResponse, Response, JSONResponse
+from starlette.background import BackgroundTask
+from starlette.datastructures import Headers
+from prometheus_client import Counter, Gauge, Histogram, CONTENT_TYPE_LATEST, generate_latest
 import shutil
 import os
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReturnDocument, UpdateOne
 import os
 import logging
 from pathlib import Path
 from pydantic import BaseModel, Field
-from typing import List, Optional
+from typing import List, Optional, Sequence
 import uuid
 from datetime import datetime, timedelta
 import aiohttp
 import asyncio
+import time
 import zipfile
+import zlib
 import tempfile
 import shutil
 import openpyxl
+import numpy as np
+import pandas as pd
 from io import BytesIO
 import aiofiles
 import uuid
 from datetime import datetime
+import re
+import json
+import csv
+import codecs
+import io
+import gzip
+import mimetypes
+import hashlib
+import heapq
+import itertools
+from array import array
+from collections import OrderedDict, defaultdict
+from abc import ABC, abstractmethod
+from contextlib import AsyncExitStack, asynccontextmanager, contextmanager
+from contextvars import ContextVar
+import urllib.parse
 
 
 ROOT_DIR = Path(__file__).parent
@@ -39,104 +63,551 @@ app = FastAPI()
 api_router = APIRouter(prefix="/api")
 
 # Base URL for images
-IMAGE_BASE_URL = "https://borellacasalinghi.it/foto-prodotti/cartella-immagini"
+IMAGE_BASE_URL = os.environ.get('IMAGE_BASE_URL', "https://borellacasalinghi.it/foto-prodotti/cartella-immagini").rstrip('/')
 SUPPORTED_FORMATS = [".jpg", ".png", ".webp", ".tif"]
+GENERIC_CONTENT_TYPE = "application/octet-stream"  # sent by origins that do not know the format
 
 # Define Models
+class ProbeTrace(BaseModel):
+    url: str
+    rule: Optional[str] = None
+    status: Optional[int] = None
+    latency_ms: float
+    error: Optional[str] = None
+    etag: Optional[str] = None
+    size: Optional[int] = None
+    content_type: Optional[str] = None
+
 class ImageSearchResult(BaseModel):
     code: str
     found: bool
     image_url: Optional[str] = None
     format: Optional[str] = None
     error: Optional[str] = None
+    etag: Optional[str] = None
+    # Image metadata: size and type from the store, dimensions on request (metadata=true)
+    size_bytes: Optional[int] = None
+    content_type: Optional[str] = None
+    width: Optional[int] = None
+    height: Optional[int] = None
+    # Only filled in explain mode
+    trace: Optional[List[ProbeTrace]] = None
+    elapsed_ms: Optional[float] = None
+
+class InvalidCode(BaseModel):
+    row: int
+    value: str
+    reason: str
 
 class BatchSearchResult(BaseModel):
     total_codes: int
     found_codes: List[str]
     not_found_codes: List[str]
     results: List[ImageSearchResult]
+    # Time-budgeted searches: codes still being resolved in background task `task_id`
+    pending_codes: List[str] = []
+    task_id: Optional[str] = None
+    # Normalisation: repeated codes (searched once) and rejected cells
+    duplicate_count: int = 0
+    invalid_count: int = 0
+    invalid_codes: List[InvalidCode] = []
 
 class SearchRequest(BaseModel):
     code: str
+    explain: bool = False
+    metadata: bool = False
+
+# Batch processing limits
+MAX_UPLOAD_SIZE = 10 * 1024 * 1024  # 10MB
+MAX_BATCH_CODES = int(os.environ.get('MAX_BATCH_CODES', 100000))
+BATCH_CHUNK_SIZE = int(os.environ.get('BATCH_CHUNK_SIZE', 200))
+BATCH_CONCURRENCY = int(os.environ.get('BATCH_CONCURRENCY', 4))
+# Above this size the progress payload only carries counters, not the code lists
+MAX_TRACKED_ITEMS = 1000
+# Per-task working files (uploaded workbook, incremental results)
+BATCH_WORK_DIR = Path(os.environ.get('BATCH_WORK_DIR', os.path.join(tempfile.gettempdir(), 'borella-batch')))
 
 # Progress tracking storage
 progress_storage = {}
+# Finished tasks (and their work files) are kept this long after they end
+TASK_RETENTION = timedelta(minutes=int(os.environ.get('TASK_RETENTION_MINUTES', 60)))
+# Two-phase batches never executed are dropped this long after /search-batch-start
+PENDING_TASK_RETENTION = timedelta(minutes=int(os.environ.get('PENDING_TASK_RETENTION_MINUTES', 30)))
+TASK_SWEEP_INTERVAL = 60  # seconds
+task_sweeper = None
+
+# Result status codes stored in BatchResultStore.statuses
+RESULT_NOT_FOUND = 0
+RESULT_FOUND = 1
+
+class BatchResultStore:
+    """Per-task search results in a compact columnar layout.
+    
+    Row numbers, file offsets and statuses are kept in typed arrays (a few bytes
+    per code); the full result (code, URL, format) lives in the task's JSON lines
+    file and is read back by offset only for the requested page."""
+    def __init__(self, path: Path):
+        self.path = path
+        self.rows = array('I')
+        self.offsets = array('Q')
+        self.statuses = bytearray()
+        self._end = 0
+    
+    def __len__(self):
+        return len(self.statuses)
+    
+    async def append(self, entries: List[tuple]):
+        """Append (row number, ImageSearchResult) pairs, in row order"""
+        lines = []
+        offsets = []
+        for row_number, result in entries:
+            line = (json.dumps({"row": row_number, **result.model_dump()}) + "\n").encode()
+            offsets.append(self._end)
+            self._end += len(line)
+            lines.append(line)
+        
+        async with aiofiles.open(self.path, "ab") as results_file:
+            await results_file.write(b"".join(lines))
+        
+        # Columns are only extended once the lines are on disk
+        for (row_number, result), offset in zip(entries, offsets):
+            self.rows.append(row_number)
+            self.offsets.append(offset)
+            self.statuses.append(RESULT_FOUND if result.found else RESULT_NOT_FOUND)
+    
+    def select(self, status: Optional[int] = None) -> Sequence[int]:
+        """Indexes of the stored results, optionally only those with the given status"""
+        if status is None:
+            return range(len(self))
+        return [index for index, value in enumerate(self.statuses) if value == status]
+    
+    def read(self, indexes) -> List[dict]:
+        results = []
+        with open(self.path, "rb") as results_file:
+            for index in indexes:
+                results_file.seek(self.offsets[index])
+                results.append(json.loads(results_file.readline()))
+        return results
+
+class CodeList:
+    """The valid (row number, code) entries of a parsed code list, kept by a task until searched.
+    
+    Distinct codes are joined in a single string and every row refers to its
+    code by index, so a large list costs a few bytes per row; (row, code) pairs
+    are only built a chunk at a time."""
+    def __init__(self, rows, codes):
+        indexes, distinct = pd.factorize(pd.Series(codes, dtype=object), sort=False)
+        self.codes = "\n".join(distinct)  # normalised codes contain no newlines
+        self.distinct_count = len(distinct)
+        self.rows = np.asarray(rows, dtype=np.uint32)
+        self.indexes = indexes.astype(np.uint32)
+    
+    def __len__(self):
+        return len(self.rows)
+    
+    def distinct_codes(self) -> List[str]:
+        """The distinct codes, in order of first appearance"""
+        return self.codes.split("\n") if self.distinct_count else []
+    
+    def chunks(self, chunk_size: int = BATCH_CHUNK_SIZE):
+        """Yield the (row number, code) pairs in row order, `chunk_size` at a time"""
+        codes = self.distinct_codes()
+        for start in range(0, len(self), chunk_size):
+            rows = self.rows[start:start + chunk_size].tolist()
+            indexes = self.indexes[start:start + chunk_size].tolist()
+            yield [(row_number, codes[index]) for row_number, index in zip(rows, indexes)]
+    
+    def __iter__(self):
+        for chunk in self.chunks():
+            yield from chunk
 
 class ProgressTracker:
-    def __init__(self, task_id: str, total_items: int):
+    def __init__(self, task_id: str, total_items: int, work_dir: Optional[Path] = None):
         self.task_id = task_id
         self.total_items = total_items
         self.completed_items = 0
         self.current_item = ""
+        self.found_count = 0
+        self.not_found_count = 0
+        # Large batches are tracked with counters only, so memory stays flat
+        self.keep_items = total_items <= MAX_TRACKED_ITEMS
         self.found_items = []
         self.not_found_items = []
+        self.work_dir = work_dir
+        self.results = BatchResultStore(work_dir / "results.jsonl") if work_dir else None
+        self.source_filename = None
+        self.source_kind = ".xlsx"
+        self.column_index = None
+        self.has_header = True
         self.start_time = datetime.now()
-        self.status = "in_progress"  # in_progress, completed, error
+        self.finished_at = None
+        self.status = "in_progress"  # pending, in_progress, completed, error, cancelled
+        # Background asyncio task doing the work, if any (used for cancellation)
+        self.job = None
+        # ZIP jobs only: image download progress and the finished archive
+        self.zip_progress = None
+        self.archive_path = None
+        # Two-phase batches only: the parsed code list waiting for /search-batch-execute
+        self.pending_codes = None
         
     def update_progress(self, current_item: str, found: bool = None):
         self.current_item = current_item
         if found is not None:
-            self.completed_items += 1
-            if found:
-                self.found_items.append(current_item)
-            else:
-                self.not_found_items.append(current_item)
+            self.record_result(current_item, found)
+    
+    def record_result(self, code: str, found: bool):
+        self.completed_items += 1
+        if found:
+            self.found_count += 1
+            if self.keep_items:
+                self.found_items.append(code)
+        else:
+            self.not_found_count += 1
+            if self.keep_items:
+                self.not_found_items.append(code)
+    
+    @property
+    def source_path(self) -> Optional[Path]:
+        return self.work_dir / f"source{self.source_kind}" if self.work_dir else None
+    
+    @property
+    def results_path(self) -> Optional[Path]:
+        return self.results.path if self.results else None
+    
+    def cleanup(self):
+        if self.work_dir:
+            shutil.rmtree(self.work_dir, ignore_errors=True)
     
     def complete(self):
         self.status = "completed"
         self.current_item = "Completato"
+        self.finished_at = datetime.now()
     
     def error(self, message: str):
         self.status = "error"
         self.current_item = f"Errore: {message}"
+        self.finished_at = datetime.now()
+    
+    def cancel(self):
+        self.status = "cancelled"
+        self.current_item = "Annullato"
+        self.finished_at = datetime.now()
+    
+    def expired(self, now: datetime) -> bool:
+        if self.status == "pending":
+            return now - self.start_time > PENDING_TASK_RETENTION
+        return self.finished_at is not None and now - self.finished_at > TASK_RETENTION
     
     def get_progress(self):
         progress_percentage = (self.completed_items / self.total_items * 100) if self.total_items > 0 else 0
-        return {
+        progress = {
             "task_id": self.task_id,
             "status": self.status,
             "progress_percentage": round(progress_percentage, 1),
             "completed_items": self.completed_items,
             "total_items": self.total_items,
             "current_item": self.current_item,
-            "found_count": len(self.found_items),
-            "not_found_count": len(self.not_found_items),
+            "found_count": self.found_count,
+            "not_found_count": self.not_found_count,
             "found_items": self.found_items,
             "not_found_items": self.not_found_items,
+            "items_truncated": not self.keep_items,
             "elapsed_time": str(datetime.now() - self.start_time).split('.')[0]
         }
+        if self.zip_progress is not None:
+            progress["zip"] = dict(self.zip_progress)
+        return progress
 
-# Helper function to check if image exists
-async def check_image_exists(session: aiohttp.ClientSession, url: str) -> bool:
-    try:
-        # Add browser-like headers to avoid 403 Forbidden
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
-            'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,image/apng,*/*;q=0.8',
-            'Accept-Language': 'en-US,en;q=0.9,it;q=0.8',
-            'Accept-Encoding': 'gzip, deflate, br',
-            'Connection': 'keep-alive',
-            'Upgrade-Insecure-Requests': '1'
-        }
+# Prometheus metrics (exposed on /metrics)
+HEAD_LATENCY = Histogram(
+    "image_search_head_seconds", "Latency of HEAD probes against the image origin", ["outcome"]
+)
+HEAD_TIMEOUTS = Counter("image_search_head_timeouts_total", "HEAD probes that timed out")
+HEAD_ERRORS = Counter("image_search_head_errors_total", "HEAD probes that failed with an error")
+PROBES_PER_CODE = Histogram(
+    "image_search_probes_per_code", "Number of HEAD probes needed to resolve a code",
+    buckets=(1, 2, 5, 10, 15, 20, 25, 30, 40, 50)
+)
+PATTERN_HITS = Counter("image_search_pattern_hits_total", "Codes resolved by each candidate rule", ["rule"])
+CODES_RESOLVED = Counter("image_search_codes_total", "Codes searched, by outcome", ["outcome"])
+# Counted in full when a download starts: archives go out with sendfile/pathsend,
+# which reports no progress, so an aborted download still counts its whole archive
+ZIP_ARCHIVE_BYTES = Counter("image_search_zip_archive_bytes_total", "Size of the ZIP archives served (counted when the download starts)")
+
+def _active_trackers():
+    return [tracker for tracker in list(progress_storage.values()) if tracker.status == "in_progress"]
+
+def _batch_codes_per_second() -> float:
+    rate = 0.0
+    for tracker in _active_trackers():
+        elapsed = (datetime.now() - tracker.start_time).total_seconds()
+        if elapsed > 0:
+            rate += tracker.completed_items / elapsed
+    return rate
+
+Gauge("image_search_active_tasks", "Background tasks in progress").set_function(
+    lambda: len(_active_trackers())
+)
+Gauge("image_search_tasks_stored", "Tasks kept in progress storage").set_function(
+    lambda: len(progress_storage)
+)
+Gauge("image_search_batch_queue_depth", "Codes still waiting in running batches").set_function(
+    lambda: sum(tracker.total_items - tracker.completed_items for tracker in _active_trackers())
+)
+Gauge("image_search_batch_codes_per_second", "Average throughput of running batches").set_function(
+    _batch_codes_per_second
+)
+
+async def sweep_expired_tasks():
+    """Drop the tasks finished more than TASK_RETENTION ago, with their work files"""
+    now = datetime.now()
+    expired = [tracker for tracker in list(progress_storage.values()) if tracker.expired(now)]
+    for tracker in expired:
+        progress_storage.pop(tracker.task_id, None)
+    if expired:
+        await asyncio.to_thread(lambda: [tracker.cleanup() for tracker in expired])
+
+async def run_task_sweeper():
+    """Periodic task cleanup (background task)"""
+    while True:
+        await asyncio.sleep(TASK_SWEEP_INTERVAL)
+        try:
+            await sweep_expired_tasks()
+        except Exception as e:
+            logging.error(f"Errore nella pulizia dei task: {str(e)}")
+
+# Origin request capture: with ORIGIN_TRACE_FILE set, every request to the
+# origin (URL, status, headers, timing, body size) is appended to a JSON lines
+# file that benchmarks/replay_origin.py can serve back with the same latencies
+ORIGIN_TRACE_FILE = os.environ.get('ORIGIN_TRACE_FILE')
+TRACED_HEADERS = ["Content-Type", "Content-Length", "ETag", "Last-Modified"]
+
+class OriginTraceRecorder:
+    def __init__(self, path: str):
+        self.path = path
+        self.trace_config = aiohttp.TraceConfig()
+        self.trace_config.on_request_start.append(self._on_request_start)
+        self.trace_config.on_request_end.append(self._on_request_end)
+        self.trace_config.on_request_exception.append(self._on_request_exception)
+        self._file = open(path, "a", buffering=1)
+        self._write({"type": "meta", "image_base_url": IMAGE_BASE_URL, "started_at": datetime.now().isoformat()})
+    
+    def _write(self, record: dict):
+        self._file.write(json.dumps(record) + "\n")
+    
+    async def _on_request_start(self, session, context, params):
+        context.started = time.perf_counter()
+    
+    async def _on_request_end(self, session, context, params):
+        response = params.response
+        self._write({
+            "type": "request",
+            "method": params.method,
+            "url": str(params.url),
+            "status": response.status,
+            "headers": {name: response.headers[name] for name in TRACED_HEADERS if name in response.headers},
+            "elapsed_ms": round((time.perf_counter() - context.started) * 1000, 2),
+            "body_size": response.content_length,
+        })
+    
+    async def _on_request_exception(self, session, context, params):
+        self._write({
+            "type": "request",
+            "method": params.method,
+            "url": str(params.url),
+            "status": None,
+            "error": "timeout" if isinstance(params.exception, asyncio.TimeoutError) else str(params.exception),
+            "elapsed_ms": round((time.perf_counter() - context.started) * 1000, 2),
+        })
+    
+    def close(self):
+        self._file.close()
+
+origin_recorder = OriginTraceRecorder(ORIGIN_TRACE_FILE) if ORIGIN_TRACE_FILE else None
+
+def create_origin_session(**kwargs) -> aiohttp.ClientSession:
+    """ClientSession for requests to the image origin"""
+    trace_configs = [origin_recorder.trace_config] if origin_recorder else []
+    return aiohttp.ClientSession(trace_configs=trace_configs, **kwargs)
+
+# Global origin scheduler: every request to the origin takes a slot, granted by
+# priority class first and then fairly (start-time fair queuing) between the
+# tasks of the same class, so interactive searches are not starved by batches
+ORIGIN_MAX_CONCURRENCY = int(os.environ.get('ORIGIN_MAX_CONCURRENCY', 16))
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_ZIP = 1
+PRIORITY_BATCH = 2
+PRIORITY_WARMUP = 3
+PRIORITY_NAMES = {
+    PRIORITY_INTERACTIVE: "interactive",
+    PRIORITY_ZIP: "zip",
+    PRIORITY_BATCH: "batch",
+    PRIORITY_WARMUP: "warmup",
+}
+
+# Priority and task of the current request/background job
+probe_priority: ContextVar[int] = ContextVar("probe_priority", default=PRIORITY_INTERACTIVE)
+probe_task: ContextVar[Optional[str]] = ContextVar("probe_task", default=None)
+
+def set_probe_context(priority: int, task_key: Optional[str] = None):
+    probe_priority.set(priority)
+    probe_task.set(task_key)
+
+SCHEDULER_WAIT = Histogram(
+    "image_search_scheduler_wait_seconds", "Time spent waiting for an origin slot", ["priority"]
+)
+
+class ProbeScheduler:
+    def __init__(self, slots: int):
+        self.slots = slots
+        self.in_use = 0
+        self._queue = []
+        self._sequence = itertools.count()
+        self._virtual_time = 0
+        self._task_time = {}
+        self._task_refs = defaultdict(int)
+    
+    @property
+    def waiting(self) -> int:
+        return sum(1 for entry in self._queue if not entry[-1].done())
+    
+    def _grant_next(self):
+        while self._queue and self.in_use < self.slots:
+            priority, start, _, waiter = heapq.heappop(self._queue)
+            if waiter.done():
+                # Cancelled while waiting
+                continue
+            self.in_use += 1
+            self._virtual_time = start
+            waiter.set_result(None)
+    
+    def _forget(self, task_key):
+        self._task_refs[task_key] -= 1
+        if self._task_refs[task_key] <= 0:
+            del self._task_refs[task_key]
+            self._task_time.pop(task_key, None)
+    
+    async def acquire(self, priority: int, task_key: Optional[str]):
+        # New tasks start at the current virtual time instead of zero, so they
+        # share slots with running tasks rather than overtaking them
+        self._task_refs[task_key] += 1
+        start = max(self._task_time.get(task_key, 0), self._virtual_time)
+        self._task_time[task_key] = start + 1
         
+        waiter = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._queue, (priority, start, next(self._sequence), waiter))
+        self._grant_next()
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # Granted right before the cancellation: hand the slot back
+                self.release(task_key)
+            else:
+                waiter.cancel()
+                self._forget(task_key)
+            raise
+    
+    def release(self, task_key: Optional[str]):
+        self.in_use -= 1
+        self._forget(task_key)
+        self._grant_next()
+    
+    @asynccontextmanager
+    async def slot(self):
+        """Hold an origin slot for the priority/task of the current context"""
+        priority, task_key = probe_priority.get(), probe_task.get()
+        started = time.perf_counter()
+        await self.acquire(priority, task_key)
+        SCHEDULER_WAIT.labels(priority=PRIORITY_NAMES.get(priority, str(priority))).observe(time.perf_counter() - started)
+        try:
+            yield
+        finally:
+            self.release(task_key)
+
+probe_scheduler = ProbeScheduler(ORIGIN_MAX_CONCURRENCY)
+
+Gauge("image_search_scheduler_slots_in_use", "Origin slots currently held").set_function(
+    lambda: probe_scheduler.in_use
+)
+Gauge("image_search_scheduler_waiting", "Origin requests waiting for a slot").set_function(
+    lambda: probe_scheduler.waiting
+)
+
+class ClientDisconnected(Exception):
+    pass
+
+DISCONNECT_POLL_INTERVAL = 0.5
+
+async def run_until_disconnected(request: Request, coro):
+    """Await `coro`, cancelling it (and raising ClientDisconnected) if the client disconnects"""
+    job = asyncio.ensure_future(coro)
+    try:
+        while True:
+            done, _ = await asyncio.wait({job}, timeout=DISCONNECT_POLL_INTERVAL)
+            if done:
+                return job.result()
+            if await request.is_disconnected():
+                job.cancel()
+                await asyncio.gather(job, return_exceptions=True)
+                raise ClientDisconnected()
+    finally:
+        if not job.done():
+            job.cancel()
+
+# Browser-like headers sent with every origin request (the origin answers 403 without them)
+ORIGIN_DOWNLOAD_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
+    'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,image/apng,*/*;q=0.8',
+    'Accept-Language': 'en-US,en;q=0.9,it;q=0.8',
+    'Accept-Encoding': 'gzip, deflate, br',
+    'Connection': 'keep-alive',
+    'Upgrade-Insecure-Requests': '1'
+}
+
+# Helper function to probe an image URL with a HEAD request
+async def probe_image(session: aiohttp.ClientSession, url: str) -> ProbeTrace:
+    if image_mirror is not None:
+        mirrored = image_mirror.probe(url)
+        if mirrored is not None:
+            return mirrored
+    
+    started = time.perf_counter()
+    try:
         timeout = aiohttp.ClientTimeout(total=10)
-        async with session.head(url, headers=headers, timeout=timeout, allow_redirects=True) as response:
-            logging.info(f"Checking {url}: Status {response.status}")
-            return response.status == 200
+        async with probe_scheduler.slot():
+            started = time.perf_counter()
+            async with session.head(url, headers=ORIGIN_DOWNLOAD_HEADERS, timeout=timeout, allow_redirects=True) as response:
+                elapsed = time.perf_counter() - started
+                HEAD_LATENCY.labels(outcome="hit" if response.status == 200 else "miss").observe(elapsed)
+                logging.debug(f"Checking {url}: Status {response.status}")
+                content_length = response.headers.get("Content-Length", "")
+                return ProbeTrace(
+                    url=url, status=response.status, latency_ms=round(elapsed * 1000, 2), etag=response.headers.get("ETag"),
+                    size=int(content_length) if content_length.isdigit() else None,
+                    content_type=response.headers.get("Content-Type")
+                )
     except asyncio.TimeoutError:
+        HEAD_TIMEOUTS.inc()
         logging.error(f"Timeout checking {url}")
-        return False
+        error = "timeout"
     except Exception as e:
+        HEAD_ERRORS.inc()
         logging.error(f"Error checking {url}: {str(e)}")
-        return False
+        error = str(e) or e.__class__.__name__
+    return ProbeTrace(url=url, latency_ms=round((time.perf_counter() - started) * 1000, 2), error=error)
 
-import re
-import urllib.parse
+# Helper function to check if image exists
+async def check_image_exists(session: aiohttp.ClientSession, url: str) -> bool:
+    probe = await probe_image(session, url)
+    return probe.status == 200
 
-# Function to find image for a product code using optimized pattern matching
-async def find_product_image(session: aiohttp.ClientSession, code: str) -> ImageSearchResult:
-    code = code.strip()
-    
+# Candidate filenames for a product code, in probing order.
+# Each candidate is tagged with the rule that generated it, so hits can be
+# attributed (metrics) and useless patterns identified.
+def iter_candidate_filenames(code: str):
+    """Yield (rule, filename, format) tuples using optimized pattern matching"""
     # Optimized search with timeout - limit to most common patterns to avoid long searches
     # All supported formats including case variations (ordered by frequency/priority)
     format_extensions = [".jpg", ".JPG", ".png", ".PNG", ".jpeg", ".JPEG", ".webp", ".WEBP", ".tif", ".TIF"]
@@ -150,19 +621,9 @@ async def find_product_image(session: aiohttp.ClientSession, code: str) -> Image
     for format_ext in format_extensions:
         if check_count >= max_checks:
             break
-            
-        exact_match_pattern = f"{code}{format_ext}"
-        encoded_filename = urllib.parse.quote(exact_match_pattern)
-        image_url = f"{IMAGE_BASE_URL}/{encoded_filename}"
         
         check_count += 1
-        if await check_image_exists(session, image_url):
-            return ImageSearchResult(
-                code=code,
-                found=True,
-                image_url=image_url,
-                format=format_ext
-            )
+        yield "exact", f"{code}{format_ext}", format_ext
     
     # PRIORITY 2: Test variant patterns (parentheses) for ALL formats
     for format_ext in format_extensions:
@@ -180,27 +641,17 @@ async def find_product_image(session: aiohttp.ClientSession, code: str) -> Image
             if check_count >= max_checks:
                 break
             check_count += 1
-            
-            encoded_filename = urllib.parse.quote(pattern)
-            image_url = f"{IMAGE_BASE_URL}/{encoded_filename}"
-            
-            if await check_image_exists(session, image_url):
-                return ImageSearchResult(
-                    code=code,
-                    found=True,
-                    image_url=image_url,
-                    format=format_ext
-                )
+            yield "variant", pattern, format_ext
         
         # If priority patterns fail, try a few high-probability extended patterns
         if check_count < max_checks:
             # Only try most common extensions based on examples and real data
             high_probability_patterns = [
-                f"{code} - BEST TISANIERA{format_ext}",
-                f"{code} - ROSSO{format_ext}",
-                f"{code}- VEGA SET 6 COPPETTE ARLECCHIN{format_ext}",
+                ("known-suffix", f"{code} - BEST TISANIERA{format_ext}"),
+                ("known-suffix", f"{code} - ROSSO{format_ext}"),
+                ("known-suffix", f"{code}- VEGA SET 6 COPPETTE ARLECCHIN{format_ext}"),
                 # Specific pattern for code 117 found in real data
-                f"{code} - 118 - 1124 - 1415 panarea (1){format_ext}",
+                ("known-suffix", f"{code} - 118 - 1124 - 1415 panarea (1){format_ext}"),
             ]
             
             # If numeric code, try adjacent code patterns (prioritizing known working patterns)
@@ -211,26 +662,26 @@ async def find_product_image(session: aiohttp.ClientSession, code: str) -> Image
                 # Pattern for 22497-22501 PORTAFOTO-ASTRA (highest priority)
                 if base_code >= 22497 and base_code <= 22499:
                     high_priority_astra = "22497 - 22498 - 22499 - 22500 - 22501 PORTAFOTO-ASTRA"
-                    high_probability_patterns.insert(0, f"{high_priority_astra}{format_ext}")
+                    high_probability_patterns.insert(0, ("known-series", f"{high_priority_astra}{format_ext}"))
                     check_count += 1
                 
                 # Pattern for 22492-22496 PORTAFOTO-ALTEA  
                 if base_code >= 22492 and base_code <= 22496:
                     high_priority_altea = "22492 - 22493 - 22494 - 22495 - 22496 PORTAFOTO-ALTEA"
-                    high_probability_patterns.insert(0, f"{high_priority_altea}{format_ext}")
+                    high_probability_patterns.insert(0, ("known-series", f"{high_priority_altea}{format_ext}"))
                     check_count += 1
                 
                 # Pattern for 25531-25534 sequence (4 consecutive codes)
                 if base_code >= 25531 and base_code <= 25534:
                     high_priority_25531 = "25531 - 25532 - 25533 - 25534"
-                    high_probability_patterns.insert(0, f"{high_priority_25531}{format_ext}")
+                    high_probability_patterns.insert(0, ("known-series", f"{high_priority_25531}{format_ext}"))
                     check_count += 1
                 
                 # Standard patterns
                 next_code = base_code + 1
                 high_probability_patterns.extend([
-                    f"{code} - {next_code}{format_ext}",
-                    f"{code} - {next_code} ROSSO{format_ext}",
+                    ("adjacent", f"{code} - {next_code}{format_ext}"),
+                    ("adjacent", f"{code} - {next_code} ROSSO{format_ext}"),
                 ])
                 check_count += 2
                 
@@ -272,7 +723,7 @@ async def find_product_image(session: aiohttp.ClientSession, code: str) -> Image
                     for pattern in multi_code_patterns:
                         if check_count >= max_checks:
                             break
-                        high_probability_patterns.append(pattern)
+                        high_probability_patterns.append(("multi-code", pattern))
                         check_count += 1
                 
                 # Pattern: CODE_START - CODE_START+1 - CODE_START+2 - ... (consecutive codes at beginning)
@@ -282,13 +733,13 @@ async def find_product_image(session: aiohttp.ClientSession, code: str) -> Image
                 if base_code >= 22497 and base_code <= 22499:
                     # Specific pattern for the 22497-22501 sequence
                     astra_pattern = "22497 - 22498 - 22499 - 22500 - 22501 PORTAFOTO-ASTRA"
-                    consecutive_patterns.append(f"{astra_pattern}{format_ext}")
+                    consecutive_patterns.append(("known-series", f"{astra_pattern}{format_ext}"))
                 
                 # General consecutive patterns for any code
                 consecutive_patterns.extend([
-                    f"{code} - {base_code + 1} - {base_code + 2} - {base_code + 3} - {base_code + 4} PORTAFOTO-ASTRA{format_ext}",
-                    f"{code} - {base_code + 1} - {base_code + 2}{format_ext}",
-                    f"{code} - {base_code + 1} - {base_code + 2} - {base_code + 3}{format_ext}",
+                    ("consecutive", f"{code} - {base_code + 1} - {base_code + 2} - {base_code + 3} - {base_code + 4} PORTAFOTO-ASTRA{format_ext}"),
+                    ("consecutive", f"{code} - {base_code + 1} - {base_code + 2}{format_ext}"),
+                    ("consecutive", f"{code} - {base_code + 1} - {base_code + 2} - {base_code + 3}{format_ext}"),
                 ])
                 
                 for pattern in consecutive_patterns:
@@ -297,568 +748,2724 @@ async def find_product_image(session: aiohttp.ClientSession, code: str) -> Image
                     high_probability_patterns.append(pattern)
                     check_count += 1
             
-            for pattern in high_probability_patterns:
+            for rule, pattern in high_probability_patterns:
                 if check_count >= max_checks:
                     break
                 check_count += 1
-                
-                encoded_filename = urllib.parse.quote(pattern)
-                image_url = f"{IMAGE_BASE_URL}/{encoded_filename}"
-                
-                if await check_image_exists(session, image_url):
-                    return ImageSearchResult(
-                        code=code,
-                        found=True,
-                        image_url=image_url,
-                        format=format_ext
-                    )
-    
-    return ImageSearchResult(
-        code=code,
-        found=False,
-        error="Immagine non trovata"
-    )
+                yield rule, pattern, format_ext
 
-@api_router.get("/")
-async def root():
-    return {"message": "Sistema di Ricerca Immagini Prodotti"}
+# Not found, but some candidates could not be checked (origin errors/timeouts)
+INCOMPLETE_SEARCH_ERROR = "Immagine non trovata (ricerca incompleta per errori di rete)"
 
-@api_router.get("/progress/{task_id}")
-async def get_progress(task_id: str):
-    if task_id not in progress_storage:
-        raise HTTPException(status_code=404, detail="Task ID non trovato")
+# Function to find image for a product code using optimized pattern matching
+async def find_product_image(session: aiohttp.ClientSession, code: str, explain: bool = False,
+                             rules: Optional[set] = None, exclude_rules: Optional[set] = None,
+                             final: bool = True, prior_probes: int = 0) -> ImageSearchResult:
+    """Probe the candidate filenames of a code in order, stopping at the first hit.
     
-    tracker = progress_storage[task_id]
-    progress_data = tracker.get_progress()
+    With `explain` the result carries every probe attempted (URL, rule, status,
+    latency) and the total time spent. `rules`/`exclude_rules` restrict the
+    candidates probed (e.g. only the cheap exact matches). A search split in
+    passes counts the code once: a pass that is not `final` records nothing when
+    it finds nothing, and the next pass adds its `prior_probes`."""
+    code = code.strip()
+    started = time.perf_counter()
+    trace = [] if explain else None
+    probes = prior_probes
+    probe_errors = 0
+    counted = True
+    listings = {}
     
-    # Clean up completed tasks after a while
-    if tracker.status in ["completed", "error"] and datetime.now() - tracker.start_time > timedelta(minutes=10):
-        del progress_storage[task_id]
+    try:
+        for rule, filename, format_ext in iter_candidate_filenames(code):
+            if (rules is not None and rule not in rules) or (exclude_rules and rule in exclude_rules):
+                continue
+            probes += 1
+            probe = await image_store.probe(session, code, filename, listings)
+            image_url = probe.url
+            if probe.error:
+                probe_errors += 1
+            if explain:
+                probe.rule = rule
+                trace.append(probe)
+            
+            if probe.status == 200:
+                PATTERN_HITS.labels(rule=rule).inc()
+                CODES_RESOLVED.labels(outcome="found").inc()
+                result = ImageSearchResult(
+                    code=code,
+                    found=True,
+                    image_url=image_url,
+                    format=format_ext,
+                    etag=probe.etag,
+                    size_bytes=probe.size,
+                    content_type=(probe.content_type if probe.content_type not in (None, GENERIC_CONTENT_TYPE)
+                                  else mimetypes.guess_type(filename)[0] or probe.content_type)
+                )
+                break
+        else:
+            if final:
+                CODES_RESOLVED.labels(outcome="not_found").inc()
+            else:
+                counted = False
+            result = ImageSearchResult(
+                code=code,
+                found=False,
+                error=INCOMPLETE_SEARCH_ERROR if probe_errors else "Immagine non trovata"
+            )
+    finally:
+        if counted:
+            PROBES_PER_CODE.observe(probes)
     
-    return progress_data
+    if explain:
+        result.trace = trace
+        result.elapsed_ms = round((time.perf_counter() - started) * 1000, 2)
+    return result
 
-@api_router.post("/search-single", response_model=ImageSearchResult)
-async def search_single_product(request: SearchRequest):
-    if not request.code.strip():
-        raise HTTPException(status_code=400, detail="Codice prodotto non può essere vuoto")
-    
-    async with aiohttp.ClientSession() as session:
-        result = await find_product_image(session, request.code)
-        return result
+# Local mirror of the origin folder (IMAGE_MIRROR_DIR): once synced, candidate
+# probes are answered from the mirror index and downloads served from disk.
+# The folder is re-synced periodically from its directory listing: only new or
+# changed entries are fetched, with conditional GETs (ETag/Last-Modified).
+IMAGE_MIRROR_DIR = os.environ.get('IMAGE_MIRROR_DIR', '')
+IMAGE_MIRROR_SYNC_MINUTES = int(os.environ.get('IMAGE_MIRROR_SYNC_MINUTES', 60))
+IMAGE_MIRROR_CONCURRENCY = int(os.environ.get('IMAGE_MIRROR_CONCURRENCY', 4))
 
-@api_router.get("/download-image")
-async def download_single_image(url: str, filename: str):
-    try:
-        # Add browser-like headers
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
-            'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,image/apng,*/*;q=0.8',
-            'Accept-Language': 'en-US,en;q=0.9,it;q=0.8',
-            'Accept-Encoding': 'gzip, deflate, br',
-            'Connection': 'keep-alive',
-            'Upgrade-Insecure-Requests': '1'
-        }
-        
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url, headers=headers) as response:
-                if response.status != 200:
-                    raise HTTPException(status_code=404, detail="Immagine non trovata")
-                
-                content = await response.read()
-                
-                return StreamingResponse(
-                    BytesIO(content),
-                    media_type="application/octet-stream",
-                    headers={"Content-Disposition": f"attachment; filename={filename}"}
-                )
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Errore nel download: {str(e)}")
+MIRROR_FETCHES = Counter("image_search_mirror_fetches_total", "Files checked by mirror syncs, by outcome", ["result"])
 
-@api_router.post("/search-batch", response_model=BatchSearchResult)
-async def search_batch_products_sync(file: UploadFile = File(...)):
-    """Original synchronous batch search endpoint"""
-    if not file.filename.endswith('.xlsx'):
-        raise HTTPException(status_code=400, detail="Il file deve essere in formato .xlsx")
+LISTING_LINK = re.compile(r'<a\s[^>]*href="([^"]+)"[^>]*>.*?</a>', re.IGNORECASE)
+LISTING_TAG = re.compile(r'<[^>]+>')
+
+def parse_listing(html: str) -> dict:
+    """Parse an Apache/nginx directory index into {filename: stamp}.
     
-    try:
-        # Read Excel file
-        contents = await file.read()
-        workbook = openpyxl.load_workbook(BytesIO(contents))
-        sheet = workbook.active
-        
-        # Find CODICE, COD.PR, or C.ART column
-        codice_col = None
-        column_found = None
-        
-        # Priority 1: CODICE
-        for col in range(1, sheet.max_column + 1):
-            cell_value = sheet.cell(row=1, column=col).value
-            if cell_value and str(cell_value).upper() == "CODICE":
-                codice_col = col
-                column_found = "CODICE"
-                break
-        
-        # Priority 2: COD.PR
-        if codice_col is None:
-            for col in range(1, sheet.max_column + 1):
-                cell_value = sheet.cell(row=1, column=col).value
-                if cell_value and str(cell_value).upper() == "COD.PR":
-                    codice_col = col
-                    column_found = "COD.PR"
-                    break
-        
-        # Priority 3: C.ART
-        if codice_col is None:
-            for col in range(1, sheet.max_column + 1):
-                cell_value = sheet.cell(row=1, column=col).value
-                if cell_value and str(cell_value).upper() == "C.ART":
-                    codice_col = col
-                    column_found = "C.ART"
-                    break
-        
-        if codice_col is None:
-            raise HTTPException(status_code=400, detail="Colonna 'CODICE', 'COD.PR' o 'C.ART' non trovata nel file Excel")
-        
-        # Extract codes
-        codes = []
-        for row in range(2, sheet.max_row + 1):
-            cell_value = sheet.cell(row=row, column=codice_col).value
-            if cell_value:
-                codes.append(str(cell_value).strip())
-        
-        if not codes:
-            raise HTTPException(status_code=400, detail="Nessun codice trovato nella colonna")
-        
-        # Search for images synchronously
-        results = []
-        found_codes = []
-        not_found_codes = []
-        
-        async with aiohttp.ClientSession() as session:
-            for code in codes:
-                result = await find_product_image(session, code)
-                results.append(result)
-                
-                if result.found:
-                    found_codes.append(result.code)
-                else:
-                    not_found_codes.append(result.code)
-        
-        return BatchSearchResult(
-            total_codes=len(codes),
-            found_codes=found_codes,
-            not_found_codes=not_found_codes,
-            results=results
-        )
+    The stamp is the text following the link (modification date and size), so a
+    changed stamp marks a file to re-check."""
+    entries = {}
+    for line in html.splitlines():
+        match = LISTING_LINK.search(line)
+        if not match:
+            continue
+        href = match.group(1)
+        if href.startswith("./"):
+            href = href[2:]
+        if not href or href.startswith(("?", "/", "#", "..")) or href.endswith("/") or "://" in href:
+            continue
+        filename = urllib.parse.unquote(href)
+        if "/" in filename or "\\" in filename or filename.startswith("."):
+            continue
+        entries[filename] = " ".join(LISTING_TAG.sub(" ", line[match.end():]).split())
+    return entries
+
+async def fetch_listing(session: aiohttp.ClientSession, base_url: str, validators: Optional[dict] = None) -> Optional[tuple]:
+    """({filename: stamp}, validators) of the origin directory index.
     
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Errore nell'elaborazione del file: {str(e)}")
+    With the validators of a previous response (If-None-Match/If-Modified-Since)
+    the request is conditional and None means the listing has not changed."""
+    headers = dict(ORIGIN_DOWNLOAD_HEADERS, **(validators or {}))
+    async with probe_scheduler.slot(), session.get(
+        f"{base_url}/", headers=headers, timeout=aiohttp.ClientTimeout(total=120)
+    ) as response:
+        if response.status == 304:
+            return None
+        if response.status != 200:
+            raise RuntimeError(f"Elenco della cartella non disponibile (status {response.status})")
+        html = await response.text()
+        validators = {"If-None-Match": response.headers.get("ETag"), "If-Modified-Since": response.headers.get("Last-Modified")}
+    
+    listing = parse_listing(html)
+    if not listing:
+        # An empty listing is far more likely a broken page than an empty folder
+        raise RuntimeError("Elenco della cartella vuoto")
+    return listing, {header: value for header, value in validators.items() if value}
 
-@api_router.post("/search-batch-start")
-async def search_batch_products(file: UploadFile = File(...)):
-    if not file.filename.endswith('.xlsx'):
-        raise HTTPException(status_code=400, detail="Il file deve essere in formato .xlsx")
+def filename_for_url(base_url: str, url: str) -> Optional[str]:
+    """Filename of an image URL directly under `base_url` (None for any other URL)"""
+    if not url.startswith(base_url + "/"):
+        return None
+    filename = urllib.parse.unquote(url[len(base_url) + 1:])
+    return None if "/" in filename else filename
+
+class ImageMirror:
+    """Local copy of the image folder with an index of filename -> stamp/ETag/Last-Modified"""
+    def __init__(self, directory: Path, base_url: str):
+        self.directory = directory
+        self.files_dir = directory / "files"
+        self.index_path = directory / "index.json"
+        self.base_url = base_url
+        self.index = {}
+        # Listed files that could not be fetched: looked up on the origin
+        self.failed = set()
+        self.ready = False
+        self.last_sync = None
+        self.last_error = None
+        self.job = None
+        self._lock = asyncio.Lock()
     
-    # Generate unique task ID
-    task_id = str(uuid.uuid4())
+    @property
+    def syncing(self) -> bool:
+        return self._lock.locked()
     
-    try:
-        # Read Excel file
-        contents = await file.read()
-        workbook = openpyxl.load_workbook(BytesIO(contents))
-        sheet = workbook.active
-        
-        # Find CODICE or COD.PR column (same logic as before)
-        codice_col = None
-        column_found = None
-        
-        # First, try to find CODICE column
-        for col in range(1, sheet.max_column + 1):
-            cell_value = sheet.cell(row=1, column=col).value
-            if cell_value and str(cell_value).upper() == "CODICE":
-                codice_col = col
-                column_found = "CODICE"
-                break
-        
-        # If CODICE not found, try to find COD.PR column
-        if codice_col is None:
-            for col in range(1, sheet.max_column + 1):
-                cell_value = sheet.cell(row=1, column=col).value
-                if cell_value and str(cell_value).upper() == "COD.PR":
-                    codice_col = col
-                    column_found = "COD.PR"
-                    break
-        
-        if codice_col is None:
-            raise HTTPException(status_code=400, detail="Colonna 'CODICE' o 'COD.PR' non trovata nel file Excel")
-        
-        # Extract codes
-        codes = []
-        for row in range(2, sheet.max_row + 1):
-            cell_value = sheet.cell(row=row, column=codice_col).value
-            if cell_value:
-                codes.append(str(cell_value).strip())
-        
-        if not codes:
-            raise HTTPException(status_code=400, detail="Nessun codice trovato nella colonna")
-        
-        # Initialize progress tracker
-        tracker = ProgressTracker(task_id, len(codes))
-        progress_storage[task_id] = tracker
-        
-        # Return task ID immediately for progress tracking
-        return {
-            "task_id": task_id,
-            "total_codes": len(codes),
-            "column_used": column_found,
-            "message": "Elaborazione avviata. Usa l'ID per tracciare il progresso."
-        }
+    def load(self):
+        """Load the index of a previous sync, so a restart serves from disk right away"""
+        self.files_dir.mkdir(parents=True, exist_ok=True)
+        if self.index_path.exists():
+            with open(self.index_path) as index_file:
+                self.index = json.load(index_file)
+            self.ready = True
     
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Errore nell'elaborazione del file: {str(e)}")
-
-@api_router.post("/search-batch-execute/{task_id}", response_model=BatchSearchResult)
-async def execute_batch_search(task_id: str):
-    if task_id not in progress_storage:
-        raise HTTPException(status_code=404, detail="Task ID non trovato")
+    def save(self):
+        temp_path = self.index_path.with_suffix(".tmp")
+        with open(temp_path, "w") as index_file:
+            json.dump(self.index, index_file)
+        os.replace(temp_path, self.index_path)
     
-    tracker = progress_storage[task_id]
+    def filename_for(self, url: str) -> Optional[str]:
+        return filename_for_url(self.base_url, url)
     
-    try:
-        # Search for images with progress tracking
-        results = []
-        found_codes = []
-        not_found_codes = []
+    def path_for(self, url: str) -> Optional[Path]:
+        """Local file of an origin URL, if mirrored"""
+        filename = self.filename_for(url)
+        if not self.ready or filename is None or filename not in self.index:
+            return None
+        return self.files_dir / filename
+    
+    def probe(self, url: str) -> Optional[ProbeTrace]:
+        """Answer a probe from the index (None: the origin must be asked)"""
+        filename = self.filename_for(url)
+        if not self.ready or filename is None or filename in self.failed:
+            return None
+        entry = self.index.get(filename)
+        if entry is None:
+            return ProbeTrace(url=url, status=404, latency_ms=0.0)
+        return ProbeTrace(url=url, status=200, latency_ms=0.0, etag=entry["etag"], size=entry.get("size"))
+    
+    async def _fetch(self, session: aiohttp.ClientSession, filename: str, stamp: str):
+        url = f"{self.base_url}/{urllib.parse.quote(filename)}"
+        local_path = self.files_dir / filename
+        entry = self.index.get(filename)
+        headers = dict(ORIGIN_DOWNLOAD_HEADERS)
+        if entry and local_path.exists():
+            if entry.get("etag"):
+                headers["If-None-Match"] = entry["etag"]
+            if entry.get("last_modified"):
+                headers["If-Modified-Since"] = entry["last_modified"]
         
-        async with aiohttp.ClientSession() as session:
-            for i, code in enumerate(tracker.found_items + tracker.not_found_items):
-                # Update progress
-                tracker.update_progress(f"Cercando {code}...")
+        try:
+            async with probe_scheduler.slot(), session.get(url, headers=headers) as response:
+                if response.status == 304:
+                    entry["stamp"] = stamp
+                    MIRROR_FETCHES.labels(result="unchanged").inc()
+                    return
+                if response.status != 200:
+                    raise RuntimeError(f"Status {response.status}")
                 
-                # Perform search
-                result = await find_product_image(session, code)
-                results.append(result)
+                part_path = self.files_dir / f".{filename}.part"
+                async with aiofiles.open(part_path, "wb") as part_file:
+                    async for block in response.content.iter_chunked(64 * 1024):
+                        await part_file.write(block)
+                os.replace(part_path, local_path)
+                self.index[filename] = {
+                    "stamp": stamp,
+                    "etag": response.headers.get("ETag"),
+                    "last_modified": response.headers.get("Last-Modified"),
+                    "size": local_path.stat().st_size
+                }
+                self.failed.discard(filename)
+                MIRROR_FETCHES.labels(result="updated").inc()
+        except Exception as e:
+            if filename not in self.index:
+                self.failed.add(filename)
+            MIRROR_FETCHES.labels(result="error").inc()
+            logging.error(f"Mirror: errore nel download di {filename}: {str(e)}")
+    
+    async def sync(self):
+        """Bring the mirror up to date with the origin directory listing"""
+        async with self._lock:
+            set_probe_context(PRIORITY_WARMUP, "mirror")
+            started = time.perf_counter()
+            async with create_origin_session(timeout=aiohttp.ClientTimeout(total=120)) as session:
+                listing, _ = await fetch_listing(session, self.base_url)
                 
-                # Update tracker based on result
-                tracker.update_progress(code, result.found)
+                # Origin changes since the previous sync (none on the first one)
+                known = set(self.index) | self.failed
+                added = set(listing) - known if known else set()
+                vanished = known - set(listing)
+                replaced = {
+                    filename for filename, entry in self.index.items()
+                    if filename in listing and entry["stamp"] != listing[filename]
+                }
                 
-                if result.found:
-                    found_codes.append(result.code)
-                else:
-                    not_found_codes.append(result.code)
+                removed = set(self.index) - set(listing)
+                for filename in removed:
+                    (self.files_dir / filename).unlink(missing_ok=True)
+                    del self.index[filename]
+                    MIRROR_FETCHES.labels(result="removed").inc()
+                self.failed &= set(listing)
                 
-                # Small delay to prevent overwhelming the server
-                await asyncio.sleep(0.1)
-            
-            # Complete the task
-            tracker.complete()
+                changed = [
+                    (filename, stamp) for filename, stamp in listing.items()
+                    if filename not in self.index or self.index[filename]["stamp"] != stamp
+                    or not (self.files_dir / filename).exists()
+                ]
+                semaphore = asyncio.Semaphore(IMAGE_MIRROR_CONCURRENCY)
+                
+                async def fetch(filename: str, stamp: str):
+                    async with semaphore:
+                        await self._fetch(session, filename, stamp)
+                
+                await asyncio.gather(*(fetch(filename, stamp) for filename, stamp in changed))
             
-            return BatchSearchResult(
-                total_codes=len(results),
-                found_codes=found_codes,
-                not_found_codes=not_found_codes,
-                results=results
-            )
+            await asyncio.to_thread(self.save)
+            self.ready = True
+            self.last_sync = datetime.now()
+            self.last_error = None
+            await origin_watcher.apply(added, vanished, replaced)
+            logging.info(f"Mirror sincronizzato: {len(self.index)} file, {len(changed)} controllati in {time.perf_counter() - started:.1f}s")
     
-    except Exception as e:
-        tracker.error(str(e))
-        raise HTTPException(status_code=500, detail=f"Errore durante la ricerca: {str(e)}")
+    async def try_sync(self):
+        """sync() for background tasks: failures are logged and kept in the status"""
+        try:
+            await self.sync()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.last_error = str(e)
+            logging.error(f"Errore nella sincronizzazione del mirror: {str(e)}")
+    
+    async def run(self, interval_minutes: int):
+        """Periodic sync loop (background task)"""
+        while True:
+            await self.try_sync()
+            await asyncio.sleep(interval_minutes * 60)
+    
+    def get_status(self) -> dict:
+        return {
+            "enabled": True,
+            "ready": self.ready,
+            "syncing": self.syncing,
+            "files": len(self.index),
+            "failed": len(self.failed),
+            "last_sync": self.last_sync.isoformat() if self.last_sync else None,
+            "last_error": self.last_error
+        }
 
-@api_router.post("/search-batch-async")
-async def search_batch_async(file: UploadFile = File(...)):
-    """Versione asincrona che avvia l'elaborazione in background con validazione migliorata"""
+image_mirror = ImageMirror(Path(IMAGE_MIRROR_DIR), IMAGE_BASE_URL) if IMAGE_MIRROR_DIR else None
+
+Gauge("image_search_mirror_files", "Files in the local image mirror").set_function(
+    lambda: len(image_mirror.index) if image_mirror else 0
+)
+
+# Image stores: where product images live. find_product_image checks the
+# candidate filenames of a code, in order, against the configured store:
+# - http: HEAD probes against IMAGE_BASE_URL (default; local mirror if enabled)
+# - local: a directory on this machine (IMAGE_STORE_DIR), e.g. the origin's docroot
+# - s3: an S3-compatible bucket, one ListObjectsV2 call per filename prefix
+IMAGE_STORE = os.environ.get('IMAGE_STORE', 'http').lower()
+IMAGE_STORE_DIR = os.environ.get('IMAGE_STORE_DIR', '')
+S3_BUCKET = os.environ.get('S3_BUCKET', '')
+S3_PREFIX = os.environ.get('S3_PREFIX', '')
+S3_ENDPOINT_URL = os.environ.get('S3_ENDPOINT_URL') or None
+S3_PUBLIC_URL = os.environ.get('S3_PUBLIC_URL', '')
+S3_REGION = os.environ.get('S3_REGION') or None
+
+S3_LIST_CALLS = Counter("image_search_s3_list_calls_total", "ListObjectsV2 calls made by the S3 image store")
+
+class ImageStore(ABC):
+    """Interface of the image stores.
     
-    # Validazione formato file
-    if not file.filename:
-        raise HTTPException(status_code=400, detail="Nome file non valido")
+    `probe` answers whether a candidate filename exists (a ProbeTrace with status
+    200/404, or an error); `read`/`local_path` give the bytes behind an image URL
+    returned in the search results."""
+    name = "base"
     
-    if not file.filename.lower().endswith('.xlsx'):
-        raise HTTPException(status_code=400, detail=f"Formato file non supportato. Il file '{file.filename}' deve essere in formato Excel (.xlsx)")
+    def __init__(self, base_url: str):
+        self.base_url = base_url.rstrip("/")
     
-    # Validazione dimensione file (max 10MB)
-    file_size = 0
-    contents = await file.read()
-    file_size = len(contents)
+    def url_for(self, filename: str) -> str:
+        return f"{self.base_url}/{urllib.parse.quote(filename)}"
     
-    if file_size == 0:
-        raise HTTPException(status_code=400, detail="File vuoto o corrotto")
+    def filename_for(self, url: str) -> Optional[str]:
+        return filename_for_url(self.base_url, url)
     
-    if file_size > 10 * 1024 * 1024:  # 10MB
-        raise HTTPException(status_code=400, detail="File troppo grande. Dimensione massima: 10MB")
+    @abstractmethod
+    async def probe(self, session: aiohttp.ClientSession, code: str, filename: str, listings: dict) -> ProbeTrace:
+        """Check one candidate; `listings` is scratch space shared by the probes of one lookup"""
     
-    # Generate unique task ID
-    task_id = str(uuid.uuid4())
+    def local_path(self, url: str) -> Optional[Path]:
+        """File on this machine holding the image, if any (served with sendfile)"""
+        return None
     
-    try:
-        # Tentativo di lettura del file Excel
-        try:
-            workbook = openpyxl.load_workbook(BytesIO(contents))
-            sheet = workbook.active
-        except Exception as e:
-            raise HTTPException(
-                status_code=400, 
-                detail=f"Impossibile leggere il file Excel. Assicurati che sia un file .xlsx valido e non corrotto. Errore: {str(e)}"
-            )
+    @abstractmethod
+    async def list_files(self, session: aiohttp.ClientSession) -> Optional[dict]:
+        """{filename: stamp} of the whole store, or None if unchanged since the last call.
         
-        # Verifica che il foglio non sia vuoto
-        if sheet.max_row < 2:
-            raise HTTPException(
-                status_code=400, 
-                detail="Il file Excel sembra essere vuoto o non contiene dati. Assicurati che ci siano almeno 2 righe (intestazione + dati)"
-            )
+        A different stamp marks a file replaced under the same name."""
+    
+    @abstractmethod
+    async def read(self, session: aiohttp.ClientSession, url: str) -> Optional[bytes]:
+        """The whole image behind a result URL (None if it cannot be read)"""
+    
+    async def read_range(self, session: aiohttp.ClientSession, url: str, start: int, length: int) -> Optional[bytes]:
+        """Up to `length` bytes of the image from offset `start`, without fetching the rest"""
+        path = self.local_path(url)
+        if path is None:
+            return None
         
-        if sheet.max_column < 1:
-            raise HTTPException(
-                status_code=400, 
-                detail="Il file Excel non contiene colonne. Assicurati che il file sia formattato correttamente"
+        def read_file_range():
+            with open(path, "rb") as image_file:
+                image_file.seek(start)
+                return image_file.read(length)
+        
+        try:
+            return await asyncio.to_thread(read_file_range)
+        except OSError:
+            return None
+
+class HttpImageStore(ImageStore):
+    """Images behind a web server, found with HEAD probes"""
+    name = "http"
+    
+    def __init__(self, base_url: str):
+        super().__init__(base_url)
+        self._listing_validators = {}
+    
+    async def probe(self, session: aiohttp.ClientSession, code: str, filename: str, listings: dict) -> ProbeTrace:
+        return await probe_image(session, self.url_for(filename))
+    
+    def local_path(self, url: str) -> Optional[Path]:
+        return image_mirror.path_for(url) if image_mirror else None
+    
+    async def list_files(self, session: aiohttp.ClientSession) -> Optional[dict]:
+        """Directory index of the origin, fetched conditionally (ETag/Last-Modified)"""
+        fetched = await fetch_listing(session, self.base_url, self._listing_validators)
+        if fetched is None:
+            return None
+        listing, self._listing_validators = fetched
+        return listing
+    
+    async def read_range(self, session: aiohttp.ClientSession, url: str, start: int, length: int) -> Optional[bytes]:
+        local_path = self.local_path(url)
+        if local_path is not None and local_path.exists():
+            return await super().read_range(session, url, start, length)
+        
+        headers = dict(ORIGIN_DOWNLOAD_HEADERS, Range=f"bytes={start}-{start + length - 1}")
+        try:
+            async with probe_scheduler.slot(), session.get(url, headers=headers, timeout=aiohttp.ClientTimeout(total=10)) as response:
+                # A server ignoring Range sends the whole file: only its beginning is usable
+                if not (response.status == 206 or (response.status == 200 and start == 0)):
+                    return None
+                data = bytearray()
+                while len(data) < length:
+                    block = await response.content.read(length - len(data))
+                    if not block:
+                        break
+                    data += block
+                return bytes(data)
+        except Exception as e:
+            logging.error(f"Errore nella lettura parziale di {url}: {str(e)}")
+            return None
+    
+    async def read(self, session: aiohttp.ClientSession, url: str) -> Optional[bytes]:
+        try:
+            async with probe_scheduler.slot(), session.get(url, headers=ORIGIN_DOWNLOAD_HEADERS, timeout=aiohttp.ClientTimeout(total=30)) as response:
+                if response.status != 200:
+                    logging.error(f"Errore nel download di {url}: Status {response.status}")
+                    return None
+                return await response.read()
+        except Exception as e:
+            logging.error(f"Errore nel download di {url}: {str(e)}")
+            return None
+
+class LocalImageStore(ImageStore):
+    """Images in a local directory; results keep the public URLs of `base_url`.
+    
+    The file names are cached and rescanned when the directory changes."""
+    name = "local"
+    
+    def __init__(self, directory: Path, base_url: str):
+        super().__init__(base_url)
+        self.directory = directory
+        self._names = set()
+        self._scanned_mtime = None
+        self._listed_mtime = None
+    
+    def _refresh(self):
+        mtime = self.directory.stat().st_mtime_ns
+        if mtime != self._scanned_mtime:
+            with os.scandir(self.directory) as entries:
+                self._names = {entry.name for entry in entries if entry.is_file()}
+            self._scanned_mtime = mtime
+    
+    async def probe(self, session: aiohttp.ClientSession, code: str, filename: str, listings: dict) -> ProbeTrace:
+        url = self.url_for(filename)
+        started = time.perf_counter()
+        try:
+            if "scanned" not in listings:
+                await asyncio.to_thread(self._refresh)
+                listings["scanned"] = True
+            if filename not in self._names:
+                return ProbeTrace(url=url, status=404, latency_ms=round((time.perf_counter() - started) * 1000, 2))
+            stat_result = (self.directory / filename).stat()
+        except OSError as e:
+            return ProbeTrace(url=url, latency_ms=round((time.perf_counter() - started) * 1000, 2), error=str(e))
+        return ProbeTrace(
+            url=url, status=200, latency_ms=round((time.perf_counter() - started) * 1000, 2),
+            etag=f'"{stat_result.st_size:x}-{stat_result.st_mtime_ns:x}"', size=stat_result.st_size
+        )
+    
+    def local_path(self, url: str) -> Optional[Path]:
+        filename = self.filename_for(url)
+        return self.directory / filename if filename is not None else None
+    
+    async def list_files(self, session: aiohttp.ClientSession) -> Optional[dict]:
+        """Directory scan, skipped while the directory mtime is unchanged
+        (files rewritten in place keep their name, so their codes are unaffected)"""
+        def scan():
+            mtime = self.directory.stat().st_mtime_ns
+            if mtime == self._listed_mtime:
+                return None
+            listing = {}
+            with os.scandir(self.directory) as entries:
+                for entry in entries:
+                    if entry.is_file():
+                        stat_result = entry.stat()
+                        listing[entry.name] = f"{stat_result.st_size:x}-{stat_result.st_mtime_ns:x}"
+            self._listed_mtime = mtime
+            return listing
+        
+        return await asyncio.to_thread(scan)
+    
+    async def read(self, session: aiohttp.ClientSession, url: str) -> Optional[bytes]:
+        path = self.local_path(url)
+        try:
+            return await asyncio.to_thread(path.read_bytes) if path is not None else None
+        except OSError as e:
+            logging.error(f"Errore nella lettura di {path}: {str(e)}")
+            return None
+
+# Leading part of a candidate name ("22497 - 22498 ... .jpg" -> "22497"), used as list prefix
+LIST_PREFIX = re.compile(r"[^ .(]+")
+
+class S3ImageStore(ImageStore):
+    """Images in an S3-compatible bucket (AWS, MinIO, ...).
+    
+    Instead of one request per candidate, the keys starting with the code are
+    listed once (ListObjectsV2 with Prefix) and the candidates checked against
+    the listing; candidates starting with another code list their own prefix."""
+    name = "s3"
+    
+    def __init__(self, bucket: str, prefix: str = "", endpoint_url: Optional[str] = None,
+                 public_url: str = "", region: Optional[str] = None):
+        import boto3
+        from botocore.config import Config
+        
+        if not public_url:
+            public_url = f"{endpoint_url.rstrip('/')}/{bucket}" if endpoint_url else f"https://{bucket}.s3.amazonaws.com"
+        super().__init__(public_url + ("/" + prefix.strip("/") if prefix.strip("/") else ""))
+        self.bucket = bucket
+        self.prefix = prefix.strip("/") + "/" if prefix.strip("/") else ""
+        # Local stand-ins (MinIO, moto) only support path-style addressing
+        config = Config(s3={"addressing_style": "path"}, max_pool_connections=ORIGIN_MAX_CONCURRENCY) if endpoint_url else None
+        self.client = boto3.client("s3", endpoint_url=endpoint_url, region_name=region, config=config)
+    
+    def _list(self, prefix: str) -> dict:
+        """{filename: (ETag, size)} of the objects whose name starts with `prefix`"""
+        objects = {}
+        paginator = self.client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self.prefix + prefix):
+            S3_LIST_CALLS.inc()
+            for entry in page.get("Contents", []):
+                name = entry["Key"][len(self.prefix):]
+                if "/" not in name:
+                    objects[name] = (entry.get("ETag"), entry.get("Size"))
+        return objects
+    
+    async def probe(self, session: aiohttp.ClientSession, code: str, filename: str, listings: dict) -> ProbeTrace:
+        url = self.url_for(filename)
+        if filename.startswith(code):
+            list_prefix = code
+        else:
+            match = LIST_PREFIX.match(filename)
+            list_prefix = match.group(0) if match else filename
+        
+        started = time.perf_counter()
+        if list_prefix not in listings:
+            try:
+                async with probe_scheduler.slot():
+                    listings[list_prefix] = await asyncio.to_thread(self._list, list_prefix)
+            except Exception as e:
+                logging.error(f"Errore nell'elenco S3 per {list_prefix}: {str(e)}")
+                return ProbeTrace(url=url, latency_ms=round((time.perf_counter() - started) * 1000, 2), error=str(e))
+        
+        latency_ms = round((time.perf_counter() - started) * 1000, 2)
+        if filename not in listings[list_prefix]:
+            return ProbeTrace(url=url, status=404, latency_ms=latency_ms)
+        etag, size = listings[list_prefix][filename]
+        return ProbeTrace(url=url, status=200, latency_ms=latency_ms, etag=etag, size=size)
+    
+    def _get(self, key: str, byte_range: Optional[str] = None) -> bytes:
+        if byte_range:
+            return self.client.get_object(Bucket=self.bucket, Key=key, Range=byte_range)["Body"].read()
+        return self.client.get_object(Bucket=self.bucket, Key=key)["Body"].read()
+    
+    async def read_range(self, session: aiohttp.ClientSession, url: str, start: int, length: int) -> Optional[bytes]:
+        filename = self.filename_for(url)
+        if filename is None:
+            return None
+        try:
+            async with probe_scheduler.slot():
+                return await asyncio.to_thread(self._get, self.prefix + filename, f"bytes={start}-{start + length - 1}")
+        except Exception as e:
+            logging.error(f"Errore nella lettura parziale S3 di {filename}: {str(e)}")
+            return None
+    
+    async def list_files(self, session: aiohttp.ClientSession) -> Optional[dict]:
+        """Full listing of the bucket (prefix), stamped with the object ETags"""
+        async with probe_scheduler.slot():
+            objects = await asyncio.to_thread(self._list, "")
+        return {name: etag for name, (etag, _) in objects.items()}
+    
+    async def read(self, session: aiohttp.ClientSession, url: str) -> Optional[bytes]:
+        filename = self.filename_for(url)
+        if filename is None:
+            return None
+        try:
+            async with probe_scheduler.slot():
+                return await asyncio.to_thread(self._get, self.prefix + filename)
+        except Exception as e:
+            logging.error(f"Errore nel download S3 di {filename}: {str(e)}")
+            return None
+
+def create_image_store() -> ImageStore:
+    if IMAGE_STORE == "http":
+        return HttpImageStore(IMAGE_BASE_URL)
+    if IMAGE_STORE == "local":
+        if not IMAGE_STORE_DIR:
+            raise RuntimeError("IMAGE_STORE=local richiede IMAGE_STORE_DIR")
+        return LocalImageStore(Path(IMAGE_STORE_DIR), IMAGE_BASE_URL)
+    if IMAGE_STORE == "s3":
+        if not S3_BUCKET:
+            raise RuntimeError("IMAGE_STORE=s3 richiede S3_BUCKET")
+        return S3ImageStore(S3_BUCKET, S3_PREFIX, S3_ENDPOINT_URL, S3_PUBLIC_URL, S3_REGION)
+    raise RuntimeError(f"IMAGE_STORE non valido: {IMAGE_STORE} (valori ammessi: http, local, s3)")
+
+image_store = create_image_store()
+
+# In-process memo: first tier of the resolution cache, so hot codes (best sellers
+# looked up over and over by the UI and the plugins) are answered without the
+# MongoDB round trip. LRU bounded by entries and by an estimate of the memory
+# used; the codes affected by origin changes are dropped by the origin watcher,
+# the others just expire.
+RESOLUTION_MEMO_MAX_ENTRIES = int(os.environ.get('RESOLUTION_MEMO_MAX_ENTRIES', 50000))  # 0 disables the memo
+RESOLUTION_MEMO_MAX_BYTES = int(os.environ.get('RESOLUTION_MEMO_MAX_MB', 64)) * 1024 * 1024
+RESOLUTION_MEMO_TTL = int(os.environ.get('RESOLUTION_MEMO_TTL_SECONDS', 600))
+RESOLUTION_MEMO_NEGATIVE_TTL = int(os.environ.get('RESOLUTION_MEMO_NEGATIVE_TTL_SECONDS', 60))
+MEMO_ENTRY_OVERHEAD = 600  # approximate bytes of a memoized result besides its strings
+
+MEMO_REQUESTS = Counter("image_search_resolution_memo_total", "In-process resolution memo lookups", ["result"])
+
+class ResolutionMemo:
+    def __init__(self, max_entries: int, max_bytes: int, ttl: float, negative_ttl: float):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.entries = OrderedDict()  # code -> (result, expires at, size), least recently used first
+        self.bytes = 0
+        self.stats = {"hits": 0, "misses": 0, "expired": 0, "evicted": 0, "invalidated": 0}
+    
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0
+    
+    def _remove(self, code: str):
+        _, _, size = self.entries.pop(code)
+        self.bytes -= size
+    
+    def discard(self, codes) -> int:
+        """Drop the entries of `codes`, returning how many were memoized"""
+        dropped = 0
+        for code in codes:
+            if code in self.entries:
+                self._remove(code)
+                dropped += 1
+        self.stats["invalidated"] += dropped
+        return dropped
+    
+    def get(self, code: str) -> Optional[ImageSearchResult]:
+        if not self.enabled:
+            return None
+        entry = self.entries.get(code)
+        if entry is not None and entry[1] <= time.monotonic():
+            self._remove(code)
+            self.stats["expired"] += 1
+            entry = None
+        if entry is None:
+            self.stats["misses"] += 1
+            MEMO_REQUESTS.labels(result="miss").inc()
+            return None
+        self.entries.move_to_end(code)
+        self.stats["hits"] += 1
+        MEMO_REQUESTS.labels(result="hit").inc()
+        # Callers may enrich the result they get
+        return entry[0].model_copy()
+    
+    def put(self, result: ImageSearchResult):
+        if not self.enabled or result.error == INCOMPLETE_SEARCH_ERROR:
+            return
+        if result.code in self.entries:
+            self._remove(result.code)
+        size = MEMO_ENTRY_OVERHEAD + len(result.code) + len(result.image_url or "") + len(result.error or "")
+        ttl = self.ttl if result.found else self.negative_ttl
+        self.entries[result.code] = (result.model_copy(update={"trace": None, "elapsed_ms": None}), time.monotonic() + ttl, size)
+        self.bytes += size
+        while len(self.entries) > self.max_entries or self.bytes > self.max_bytes:
+            _, (_, _, evicted_size) = self.entries.popitem(last=False)
+            self.bytes -= evicted_size
+            self.stats["evicted"] += 1
+    
+    def get_status(self) -> dict:
+        lookups = self.stats["hits"] + self.stats["misses"]
+        return {
+            "enabled": self.enabled,
+            "entries": len(self.entries),
+            "max_entries": self.max_entries,
+            "bytes": self.bytes,
+            "max_bytes": self.max_bytes,
+            **self.stats,
+            "hit_rate": round(self.stats["hits"] / lookups, 4) if lookups else None
+        }
+
+resolution_memo = ResolutionMemo(
+    RESOLUTION_MEMO_MAX_ENTRIES, RESOLUTION_MEMO_MAX_BYTES, RESOLUTION_MEMO_TTL, RESOLUTION_MEMO_NEGATIVE_TTL
+)
+
+Gauge("image_search_resolution_memo_entries", "Results in the in-process resolution memo").set_function(
+    lambda: len(resolution_memo.entries)
+)
+
+# Resolution cache (MongoDB collection shared by all workers): code -> resolved image.
+# Not found results expire sooner, since new images are uploaded to the origin.
+RESOLUTION_CACHE_ENABLED = os.environ.get('RESOLUTION_CACHE_ENABLED', 'true').lower() == 'true'
+RESOLUTION_TTL = timedelta(hours=int(os.environ.get('RESOLUTION_TTL_HOURS', 24)))
+RESOLUTION_NEGATIVE_TTL = timedelta(minutes=int(os.environ.get('RESOLUTION_NEGATIVE_TTL_MINUTES', 60)))
+RESOLUTION_CACHE_TIMEOUT = 0.5  # seconds per cache operation
+RESOLUTION_CACHE_RETRY = 60  # seconds without cache after a failure
+
+CACHE_REQUESTS = Counter("image_search_resolution_cache_total", "Resolution cache lookups", ["result"])
+
+class ResolutionCache:
+    def __init__(self, collection, enabled: bool = True, manifest=None, memo: Optional[ResolutionMemo] = None):
+        self.collection = collection
+        self.enabled = enabled
+        self.manifest = manifest
+        self.memo = memo
+        self._retry_at = 0.0
+    
+    @property
+    def available(self) -> bool:
+        return self.enabled and time.monotonic() >= self._retry_at
+    
+    def _failed(self, e: Exception):
+        logging.warning(f"Cache risoluzioni non disponibile: {str(e) or e.__class__.__name__}")
+        CACHE_REQUESTS.labels(result="error").inc()
+        self._retry_at = time.monotonic() + RESOLUTION_CACHE_RETRY
+    
+    async def ensure_indexes(self):
+        if not self.available:
+            return
+        try:
+            await asyncio.wait_for(
+                self.collection.create_index("expires_at", expireAfterSeconds=0), RESOLUTION_CACHE_TIMEOUT * 4
             )
+        except Exception as e:
+            self._failed(e)
+    
+    async def get_many(self, codes: List[str]) -> dict:
+        """Return {code: ImageSearchResult} for the codes with a valid cached resolution.
         
-        # Find CODICE, COD.PR, or C.ART column con messaggi di errore migliorati
-        codice_col = None
-        column_found = None
-        available_columns = []
-        
-        # Raccogli tutte le colonne disponibili per il messaggio di errore
-        for col in range(1, sheet.max_column + 1):
-            cell_value = sheet.cell(row=1, column=col).value
-            if cell_value:
-                available_columns.append(str(cell_value).strip())
-        
-        # Priority 1: CODICE
-        for col in range(1, sheet.max_column + 1):
-            cell_value = sheet.cell(row=1, column=col).value
-            if cell_value and str(cell_value).upper().strip() == "CODICE":
-                codice_col = col
-                column_found = "CODICE"
-                break
+        The in-process memo is checked first, MongoDB only for the codes it misses."""
+        cached = {}
+        missing = list(dict.fromkeys(codes))
+        if self.memo is not None:
+            for code in missing:
+                result = self.memo.get(code)
+                if result is not None:
+                    cached[code] = result
+            missing = [code for code in missing if code not in cached]
+        if not missing or not self.available:
+            return cached
+        try:
+            cursor = self.collection.find({"_id": {"$in": missing}, "expires_at": {"$gt": datetime.utcnow()}})
+            documents = await asyncio.wait_for(cursor.to_list(length=None), RESOLUTION_CACHE_TIMEOUT)
+        except Exception as e:
+            self._failed(e)
+            return cached
         
-        # Priority 2: COD.PR
-        if codice_col is None:
-            for col in range(1, sheet.max_column + 1):
-                cell_value = sheet.cell(row=1, column=col).value
-                if cell_value and str(cell_value).upper().strip() == "COD.PR":
-                    codice_col = col
-                    column_found = "COD.PR"
-                    break
+        for document in documents:
+            result = ImageSearchResult(code=document["_id"], **document["result"])
+            if self.memo is not None:
+                self.memo.put(result)
+            cached[result.code] = result
+        CACHE_REQUESTS.labels(result="hit").inc(len(documents))
+        CACHE_REQUESTS.labels(result="miss").inc(len(missing) - len(documents))
+        return cached
+    
+    async def get(self, code: str) -> Optional[ImageSearchResult]:
+        return (await self.get_many([code])).get(code)
+    
+    async def put(self, result: ImageSearchResult):
+        if self.memo is not None:
+            self.memo.put(result)
+        if self.manifest is not None:
+            self.manifest.record(result)
+        # Incomplete searches are retried next time instead of cached as not found
+        if not self.available or result.error == INCOMPLETE_SEARCH_ERROR:
+            return
+        now = datetime.utcnow()
+        ttl = RESOLUTION_TTL if result.found else RESOLUTION_NEGATIVE_TTL
+        document = {
+            "result": result.model_dump(include={"found", "image_url", "format", "error", "etag", "size_bytes", "content_type", "width", "height"}),
+            "resolved_at": now,
+            "expires_at": now + ttl,
+        }
+        try:
+            await asyncio.wait_for(
+                self.collection.replace_one({"_id": result.code}, document, upsert=True), RESOLUTION_CACHE_TIMEOUT
+            )
+        except Exception as e:
+            self._failed(e)
+    
+    async def discard(self, codes: List[str]) -> int:
+        """Forget the resolutions of `codes` in both tiers, returning how many MongoDB held"""
+        if self.memo is not None:
+            self.memo.discard(codes)
+        if not codes or not self.available:
+            return 0
+        try:
+            deleted = await asyncio.wait_for(
+                self.collection.delete_many({"_id": {"$in": list(codes)}}), RESOLUTION_CACHE_TIMEOUT * 4
+            )
+            return deleted.deleted_count
+        except Exception as e:
+            self._failed(e)
+            return 0
+
+# Image dimensions are parsed from the file header, fetched with Range reads:
+# the first IMAGE_HEADER_BYTES, then only the ranges the parser asks for (a JPEG
+# frame header after a large EXIF block, a TIFF IFD at the end of the file)
+IMAGE_HEADER_BYTES = 64 * 1024
+IMAGE_EXTRA_RANGE_BYTES = 16 * 1024
+IMAGE_METADATA_MAX_READS = 4
+
+# JPEG start-of-frame markers (baseline, progressive, lossless, arithmetic)
+JPEG_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+class NeedBytes(Exception):
+    """The header parser needs bytes that have not been fetched yet"""
+    def __init__(self, start: int, length: int):
+        self.start = start
+        self.length = length
+
+class RangeBuffer:
+    """Sparse view of a remote file made of the ranges read so far"""
+    def __init__(self):
+        self.segments = []
+    
+    def add(self, start: int, data: bytes):
+        self.segments.append((start, data))
+    
+    def get(self, start: int, length: int) -> bytes:
+        for segment_start, data in self.segments:
+            if segment_start <= start and start + length <= segment_start + len(data):
+                return data[start - segment_start:start - segment_start + length]
+        raise NeedBytes(start, length)
+
+def _jpeg_dimensions(buffer: RangeBuffer) -> Optional[tuple]:
+    offset = 2
+    while True:
+        marker = buffer.get(offset, 4)
+        if marker[0] != 0xFF:
+            return None
+        kind = marker[1]
+        if kind == 0xFF:  # fill byte
+            offset += 1
+        elif kind in (0xD8, 0x01) or 0xD0 <= kind <= 0xD7:  # markers without a segment
+            offset += 2
+        elif kind in (0xD9, 0xDA):  # end of image / start of scan before any frame header
+            return None
+        elif kind in JPEG_SOF_MARKERS:
+            frame = buffer.get(offset + 5, 4)
+            return int.from_bytes(frame[2:4], "big"), int.from_bytes(frame[0:2], "big")
+        else:
+            offset += 2 + int.from_bytes(marker[2:4], "big")
+
+def _webp_dimensions(buffer: RangeBuffer) -> Optional[tuple]:
+    chunk = buffer.get(12, 4)
+    if chunk == b"VP8 ":
+        frame = buffer.get(23, 7)
+        if frame[:3] != b"\x9d\x01\x2a":
+            return None
+        return int.from_bytes(frame[3:5], "little") & 0x3FFF, int.from_bytes(frame[5:7], "little") & 0x3FFF
+    if chunk == b"VP8L":
+        bits = buffer.get(20, 5)
+        if bits[0] != 0x2F:
+            return None
+        value = int.from_bytes(bits[1:5], "little")
+        return (value & 0x3FFF) + 1, ((value >> 14) & 0x3FFF) + 1
+    if chunk == b"VP8X":
+        canvas = buffer.get(24, 6)
+        return int.from_bytes(canvas[0:3], "little") + 1, int.from_bytes(canvas[3:6], "little") + 1
+    return None
+
+def _tiff_dimensions(buffer: RangeBuffer) -> Optional[tuple]:
+    header = buffer.get(0, 8)
+    order = "little" if header[:2] == b"II" else "big"
+    if int.from_bytes(header[2:4], order) != 42:  # BigTIFF (43) is not supported
+        return None
+    ifd_offset = int.from_bytes(header[4:8], order)
+    count = int.from_bytes(buffer.get(ifd_offset, 2), order)
+    entries = buffer.get(ifd_offset + 2, 12 * count)
+    values = {}
+    for index in range(count):
+        entry = entries[index * 12:(index + 1) * 12]
+        tag = int.from_bytes(entry[0:2], order)
+        if tag in (256, 257):  # ImageWidth, ImageLength: SHORT or LONG
+            field_type = int.from_bytes(entry[2:4], order)
+            values[tag] = int.from_bytes(entry[8:10] if field_type == 3 else entry[8:12], order)
+    if 256 in values and 257 in values:
+        return values[256], values[257]
+    return None
+
+def parse_image_dimensions(buffer: RangeBuffer) -> Optional[tuple]:
+    """(width, height) of a JPEG/PNG/WebP/TIFF file; raises NeedBytes for missing ranges"""
+    signature = buffer.get(0, 12)
+    if signature.startswith(b"\xff\xd8"):
+        return _jpeg_dimensions(buffer)
+    if signature.startswith(b"\x89PNG\r\n\x1a\n"):
+        ihdr = buffer.get(16, 8)
+        return int.from_bytes(ihdr[0:4], "big"), int.from_bytes(ihdr[4:8], "big")
+    if signature[:4] == b"RIFF" and signature[8:12] == b"WEBP":
+        return _webp_dimensions(buffer)
+    if signature[:4] in (b"II*\x00", b"MM\x00*"):
+        return _tiff_dimensions(buffer)
+    return None
+
+async def read_image_dimensions(session: aiohttp.ClientSession, url: str, size: Optional[int] = None) -> Optional[tuple]:
+    buffer = RangeBuffer()
+    start, length = 0, IMAGE_HEADER_BYTES
+    for _ in range(IMAGE_METADATA_MAX_READS):
+        data = await image_store.read_range(session, url, start, length)
+        if not data:
+            return None
+        buffer.add(start, data)
+        try:
+            return parse_image_dimensions(buffer)
+        except NeedBytes as need:
+            if (size is not None and need.start + need.length > size) or (start == 0 and len(data) < length):
+                return None  # beyond the end of the file: truncated or corrupt
+            start, length = need.start, max(need.length, IMAGE_EXTRA_RANGE_BYTES)
+    return None
+
+async def enrich_image_metadata(session: aiohttp.ClientSession, result: ImageSearchResult) -> bool:
+    """Fill in the dimensions of a found image; returns True if the result changed"""
+    if not result.found or result.width is not None:
+        return False
+    try:
+        dimensions = await read_image_dimensions(session, result.image_url, result.size_bytes)
+    except Exception as e:
+        logging.error(f"Errore nella lettura dei metadati di {result.image_url}: {str(e)}")
+        return False
+    if dimensions is None:
+        return False
+    result.width, result.height = dimensions
+    return True
+
+# Code -> image manifest for the WordPress plugins: the current resolution of
+# every code ever found, each stamped with the manifest version that last
+# changed it. Clients download the full manifest once, then only the changes
+# since the version they hold; codes no longer found are reported as removed.
+MANIFEST_ENABLED = os.environ.get('MANIFEST_ENABLED', 'true').lower() == 'true'
+MANIFEST_TIMEOUT = 10  # seconds for exports and change queries
+MANIFEST_MAX_CHANGES = 50000
+# Resolutions are written behind the searches, in batches
+MANIFEST_FLUSH_INTERVAL = 0.5  # seconds
+MANIFEST_FLUSH_BATCH = 500
+MANIFEST_MAX_QUEUED = 50000
+# A version claim left open this long belongs to a writer that died
+MANIFEST_CLAIM_TIMEOUT = timedelta(seconds=60)
+
+class ResolutionManifest:
+    def __init__(self, collection, meta_collection, enabled: bool = True):
+        self.collection = collection
+        self.meta = meta_collection
+        self.enabled = enabled
+        self._retry_at = 0.0
+        self._export = None  # (version, gzip bytes) of the last full export
+        self._export_lock = asyncio.Lock()
+        # code -> (found, image_url, format) waiting for the flusher
+        self._queue = {}
+        self._wakeup = asyncio.Event()
+        self.job = None
+    
+    @property
+    def available(self) -> bool:
+        return self.enabled and time.monotonic() >= self._retry_at
+    
+    def _failed(self, e: Exception):
+        logging.warning(f"Manifest non disponibile: {str(e) or e.__class__.__name__}")
+        self._retry_at = time.monotonic() + RESOLUTION_CACHE_RETRY
+    
+    async def ensure_indexes(self):
+        if not self.available:
+            return
+        try:
+            await asyncio.wait_for(self.collection.create_index("version"), RESOLUTION_CACHE_TIMEOUT * 4)
+        except Exception as e:
+            self._failed(e)
+    
+    def record(self, result: ImageSearchResult):
+        """Queue a resolution for the manifest; the flusher writes the queue in batches"""
+        if not self.enabled or result.error == INCOMPLETE_SEARCH_ERROR:
+            return
+        if len(self._queue) >= MANIFEST_MAX_QUEUED and result.code not in self._queue:
+            return
+        self._queue[result.code] = (result.found, result.image_url, result.format)
+        if len(self._queue) >= MANIFEST_FLUSH_BATCH:
+            self._wakeup.set()
+    
+    async def flush(self):
+        """Write the queued resolutions.
+        
+        While MongoDB is unavailable the queue is kept (up to MANIFEST_MAX_QUEUED
+        codes) and written once it is back; a failed batch is queued again."""
+        while self._queue and self.available:
+            codes = list(itertools.islice(self._queue, MANIFEST_FLUSH_BATCH))
+            batch = {code: self._queue.pop(code) for code in codes}
+            try:
+                await self._write(batch)
+            except Exception as e:
+                self._failed(e)
+                # Resolutions recorded meanwhile are newer than the batch
+                for code, entry in batch.items():
+                    self._queue.setdefault(code, entry)
+    
+    async def _write(self, batch: dict):
+        """Store the entries of `batch` that changed, each with a new version.
+        
+        The versions are claimed first (counter and open claim in one update) and
+        the claim is closed once the entries are written, so readers never move
+        past a version whose entry is not visible yet (see version())."""
+        cursor = self.collection.find({"_id": {"$in": list(batch)}}, {"found": 1, "image_url": 1, "format": 1})
+        documents = await asyncio.wait_for(cursor.to_list(length=None), RESOLUTION_CACHE_TIMEOUT)
+        current = {document["_id"]: (document["found"], document["image_url"], document["format"]) for document in documents}
+        changed = [
+            (code, entry) for code, entry in batch.items()
+            if (code in current and current[code] != entry) or (code not in current and entry[0])
+        ]
+        if not changed:
+            return
+        
+        counter = await asyncio.wait_for(
+            self.meta.find_one_and_update(
+                {"_id": "version"},
+                [
+                    {"$set": {"value": {"$add": [{"$ifNull": ["$value", 0]}, len(changed)]}}},
+                    {"$set": {"claims": {"$concatArrays": [
+                        {"$ifNull": ["$claims", []]},
+                        [{"first": {"$subtract": ["$value", len(changed) - 1]}, "at": "$$NOW"}]
+                    ]}}}
+                ],
+                upsert=True, return_document=ReturnDocument.AFTER
+            ),
+            RESOLUTION_CACHE_TIMEOUT
+        )
+        first = counter["value"] - len(changed) + 1
+        now = datetime.utcnow()
+        try:
+            await asyncio.wait_for(
+                self.collection.bulk_write([
+                    UpdateOne({"_id": code}, {"$set": {
+                        "found": found,
+                        "image_url": image_url,
+                        "format": format_ext,
+                        "version": first + offset,
+                        "updated_at": now
+                    }}, upsert=True)
+                    for offset, (code, (found, image_url, format_ext)) in enumerate(changed)
+                ], ordered=False),
+                RESOLUTION_CACHE_TIMEOUT * 4
+            )
+        finally:
+            await asyncio.wait_for(
+                self.meta.update_one({"_id": "version"}, {"$pull": {"claims": {"$or": [
+                    {"first": first}, {"at": {"$lt": now - MANIFEST_CLAIM_TIMEOUT}}
+                ]}}}),
+                RESOLUTION_CACHE_TIMEOUT
+            )
+    
+    async def run(self):
+        """Flush loop (background task)"""
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), MANIFEST_FLUSH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+    
+    async def known_codes(self, codes: List[str]) -> List[str]:
+        """The codes among `codes` that have a manifest entry (found or removed), or one queued"""
+        queued = [code for code in codes if code in self._queue]
+        if not codes or not self.available:
+            return queued
+        try:
+            cursor = self.collection.find({"_id": {"$in": list(codes)}}, {"_id": 1})
+            documents = await asyncio.wait_for(cursor.to_list(length=None), MANIFEST_TIMEOUT)
+        except Exception as e:
+            self._failed(e)
+            return queued
+        return sorted({document["_id"] for document in documents} | set(queued))
+    
+    async def version(self) -> int:
+        """Highest version whose entries are all written: just below the oldest open claim"""
+        counter = await asyncio.wait_for(self.meta.find_one({"_id": "version"}), MANIFEST_TIMEOUT)
+        if counter is None:
+            return 0
+        cutoff = datetime.utcnow() - MANIFEST_CLAIM_TIMEOUT
+        open_claims = [claim["first"] for claim in counter.get("claims", []) if claim["at"] > cutoff]
+        return min(open_claims) - 1 if open_claims else counter["value"]
+    
+    async def export(self) -> tuple:
+        """(version, gzip-compressed JSON) of the full manifest, rebuilt only when the version changed"""
+        async with self._export_lock:
+            version = await self.version()
+            if self._export is not None and self._export[0] == version:
+                return self._export
+            
+            cursor = self.collection.find({"found": True}, {"image_url": 1, "format": 1})
+            documents = await asyncio.wait_for(cursor.to_list(length=None), MANIFEST_TIMEOUT)
+            payload = {
+                "version": version,
+                "generated_at": datetime.utcnow().isoformat(),
+                "count": len(documents),
+                "entries": {document["_id"]: {"url": document["image_url"], "format": document["format"]} for document in documents}
+            }
+            body = await asyncio.to_thread(lambda: gzip.compress(json.dumps(payload, separators=(",", ":")).encode()))
+            self._export = (version, body)
+            return self._export
+    
+    async def changes(self, since: int, limit: int) -> dict:
+        """Codes changed after version `since`, oldest first (up to the last fully written version)"""
+        committed = await self.version()
+        cursor = self.collection.find({"version": {"$gt": since, "$lte": committed}}).sort("version", 1).limit(limit + 1)
+        documents = await asyncio.wait_for(cursor.to_list(length=None), MANIFEST_TIMEOUT)
+        has_more = len(documents) > limit
+        documents = documents[:limit]
+        version = documents[-1]["version"] if has_more else max(since, committed)
+        return {
+            "since": since,
+            "version": version,
+            "has_more": has_more,
+            "changes": {
+                document["_id"]: {"url": document["image_url"], "format": document["format"]}
+                for document in documents if document["found"]
+            },
+            "removed": [document["_id"] for document in documents if not document["found"]]
+        }
+
+resolution_manifest = ResolutionManifest(db.image_manifest, db.image_manifest_meta, enabled=MANIFEST_ENABLED)
+
+resolution_cache = ResolutionCache(db.image_resolutions, enabled=RESOLUTION_CACHE_ENABLED, manifest=resolution_manifest,
+                                   memo=resolution_memo)
+
+async def resolve_code(session: aiohttp.ClientSession, code: str, explain: bool = False, metadata: bool = False) -> ImageSearchResult:
+    """Cached lookup of a product code (explain mode always probes the origin).
+    
+    With `metadata` the image dimensions are read (and cached) if not known yet."""
+    code = code.strip()
+    cached = None if explain else await resolution_cache.get(code)
+    return await complete_resolution(session, code, cached, explain=explain, metadata=metadata)
+
+async def complete_resolution(session: aiohttp.ClientSession, code: str, cached: Optional[ImageSearchResult],
+                              explain: bool = False, metadata: bool = False) -> ImageSearchResult:
+    """resolve_code after the cache lookup (`cached` is its result, None on a miss)"""
+    if cached is not None:
+        if metadata and await enrich_image_metadata(session, cached):
+            await resolution_cache.put(cached)
+        return cached
+    
+    result = await find_product_image(session, code, explain=explain)
+    if metadata:
+        await enrich_image_metadata(session, result)
+    await resolution_cache.put(result)
+    return result
+
+# Origin change detection: successive listings of the image store (or the mirror
+# syncs) are diffed, and only the codes whose candidate filenames include an
+# added, removed or replaced file are invalidated. The manifest entries of those
+# codes are re-resolved, so the plugins get the change in the next delta.
+ORIGIN_WATCH_SECONDS = int(os.environ.get('ORIGIN_WATCH_SECONDS', 60))  # 0 disables the watcher
+ORIGIN_REFRESH_CONCURRENCY = int(os.environ.get('ORIGIN_REFRESH_CONCURRENCY', 4))
+
+ORIGIN_CHANGES = Counter("image_search_origin_changes_total", "Origin files seen changing by the change detection", ["change"])
+CODES_INVALIDATED = Counter("image_search_codes_invalidated_total", "Codes invalidated after origin changes")
+
+CANDIDATE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".webp", ".tif"}
+FILENAME_VARIANT = re.compile(r" \(\d+\)$")
+FILENAME_SUFFIX_SEPARATOR = re.compile(r" ?- ")
+FILENAME_TOKEN = re.compile(r"[^\s()-]+")
+
+def codes_for_filename(filename: str) -> set:
+    """Codes that may resolve to `filename`.
+    
+    A superset of the codes whose candidates (iter_candidate_filenames) produce
+    this name: the name without extension and " (n)" variant, every prefix
+    before a " - " suffix, and every numeric token of a multi-code name."""
+    stem, extension = os.path.splitext(filename)
+    if extension.lower() not in CANDIDATE_EXTENSIONS:
+        return set()
+    codes = {stem, FILENAME_VARIANT.sub("", stem)}
+    codes.update(stem[:match.start()] for match in FILENAME_SUFFIX_SEPARATOR.finditer(stem))
+    codes.update(token for token in FILENAME_TOKEN.findall(stem) if token.isdigit())
+    codes.discard("")
+    return codes
+
+class OriginWatcher:
+    """Diffs successive listings of the image store and invalidates the codes affected"""
+    def __init__(self):
+        self.listing = None
+        self.last_check = None
+        self.last_change = None
+        self.last_error = None
+        self.job = None
+        self.stats = {"added": 0, "removed": 0, "changed": 0, "codes_invalidated": 0, "codes_refreshed": 0}
+    
+    async def check(self):
+        """List the store and apply the differences from the previous listing"""
+        set_probe_context(PRIORITY_WARMUP, "origin-watch")
+        async with create_origin_session() as session:
+            listing = await image_store.list_files(session)
+        self.last_check = datetime.now()
+        if listing is None:
+            return
+        if self.listing is None:
+            # First listing: nothing to compare with
+            self.listing = listing
+            return
+        
+        previous, self.listing = self.listing, listing
+        added = listing.keys() - previous.keys()
+        removed = previous.keys() - listing.keys()
+        changed = {filename for filename in listing.keys() & previous.keys() if listing[filename] != previous[filename]}
+        await self.apply(added, removed, changed)
+    
+    async def apply(self, added, removed, changed=()):
+        """Invalidate the codes affected by the given files, refreshing their manifest entries"""
+        for change, filenames in (("added", added), ("removed", removed), ("changed", changed)):
+            self.stats[change] += len(filenames)
+            ORIGIN_CHANGES.labels(change=change).inc(len(filenames))
+        codes = set()
+        for filename in (*added, *removed, *changed):
+            codes |= codes_for_filename(filename)
+        if not codes:
+            return
+        
+        codes = sorted(codes)
+        self.last_change = datetime.now()
+        await resolution_cache.discard(codes)
+        self.stats["codes_invalidated"] += len(codes)
+        CODES_INVALIDATED.inc(len(codes))
+        
+        stale = await resolution_manifest.known_codes(codes)
+        if stale:
+            semaphore = asyncio.Semaphore(ORIGIN_REFRESH_CONCURRENCY)
+            
+            async def refresh(session: aiohttp.ClientSession, code: str):
+                async with semaphore:
+                    await resolution_cache.put(await find_product_image(session, code))
+            
+            set_probe_context(PRIORITY_WARMUP, "origin-watch")
+            async with create_origin_session() as session:
+                await asyncio.gather(*(refresh(session, code) for code in stale))
+            self.stats["codes_refreshed"] += len(stale)
+        logging.info(
+            f"Modifiche all'origine: {len(added)} aggiunti, {len(removed)} rimossi, {len(changed)} modificati; "
+            f"{len(codes)} codici invalidati, {len(stale)} aggiornati nel manifest"
+        )
+    
+    async def run(self, interval_seconds: int):
+        """Periodic check loop (background task)"""
+        while True:
+            try:
+                await self.check()
+                self.last_error = None
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.last_error = str(e) or e.__class__.__name__
+                logging.error(f"Errore nel controllo delle modifiche all'origine: {self.last_error}")
+            await asyncio.sleep(interval_seconds)
+    
+    def get_status(self) -> dict:
+        return {
+            "enabled": self.job is not None or image_mirror is not None,
+            "files": len(self.listing) if self.listing is not None else None,
+            "last_check": self.last_check.isoformat() if self.last_check else None,
+            "last_change": self.last_change.isoformat() if self.last_change else None,
+            "last_error": self.last_error,
+            **self.stats
+        }
+
+origin_watcher = OriginWatcher()
+
+# Uploads: the multipart parser spools each file to a SpooledTemporaryFile (1MB in
+# memory, then disk); the body size is limited while it streams in and parsers
+# read the spooled file directly instead of loading it into memory
+UPLOAD_BODY_OVERHEAD = 64 * 1024  # multipart boundaries and part headers
+UPLOAD_COPY_CHUNK_SIZE = 1024 * 1024
+UPLOAD_TOO_LARGE = "File troppo grande. Dimensione massima: 10MB"
+
+class UploadSizeLimitMiddleware:
+    """Reject multipart request bodies above `max_body_size` before they are fully received"""
+    def __init__(self, app, max_body_size: int):
+        self.app = app
+        self.max_body_size = max_body_size
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        headers = Headers(scope=scope)
+        if not headers.get("content-type", "").startswith("multipart/form-data"):
+            return await self.app(scope, receive, send)
+        
+        content_length = headers.get("content-length", "")
+        if content_length.isdigit() and int(content_length) > self.max_body_size:
+            response = JSONResponse({"detail": UPLOAD_TOO_LARGE}, status_code=413)
+            return await response(scope, receive, send)
+        
+        received = 0
+        
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_body_size:
+                    # Raised while the form is parsed: FastAPI re-raises HTTPException as is
+                    raise HTTPException(status_code=413, detail=UPLOAD_TOO_LARGE)
+            return message
+        
+        await self.app(scope, limited_receive, send)
+
+def open_upload(file: UploadFile):
+    """Return the spooled file of an upload, rewound, after checking its size"""
+    size = file.size
+    if size is None:
+        file.file.seek(0, os.SEEK_END)
+        size = file.file.tell()
+    
+    if size == 0:
+        raise HTTPException(status_code=400, detail="File vuoto o corrotto")
+    
+    if size > MAX_UPLOAD_SIZE:
+        raise HTTPException(status_code=400, detail=UPLOAD_TOO_LARGE)
+    
+    file.file.seek(0)
+    return file.file
+
+def save_upload(upload_file, path: Path):
+    """Copy a spooled upload to `path` in chunks (run in a worker thread)"""
+    with open(path, "wb") as output:
+        shutil.copyfileobj(upload_file, output, UPLOAD_COPY_CHUNK_SIZE)
+
+# Excel helpers for large batches: the workbook is streamed in read-only mode,
+# only the code column is kept in memory and codes are searched in chunks
+CODE_COLUMN_NAMES = ["CODICE", "COD.PR", "C.ART"]
+
+# Code normalisation: the whole code column is cleaned in one vectorized pass
+# before any probe. Integer-valued numbers become integer codes, whether numeric
+# cells (25627.0) or text exported from them ("25627.0"), so a list gives the
+# same codes as a workbook or as CSV. Unicode compatibility forms, invisible
+# characters and repeated spaces are folded, and values that cannot name an
+# image file (Excel errors, paths, control characters such as tabs inside a
+# code, non-integral or out of range numbers) are reported, not probed.
+CODE_MAX_LENGTH = 64
+CODE_STRIP_LEADING_ZEROS = os.environ.get('CODE_STRIP_LEADING_ZEROS', 'false').lower() == 'true'
+INVALID_CODE_SAMPLES = 100  # invalid codes listed in the responses
+INVISIBLE_CHARACTERS = r"[\u00ad\u200b-\u200f\u2060\ufeff]"
+INVALID_CODE_CHARACTERS = r'[\x00-\x1f\x7f/\\?#%*:|"<>]'
+CONTROL_CHARACTERS = r"[\x00-\x1f\x7f]"
+INTEGRAL_NUMBER_TEXT = r"^(\d+)\.0+$"
+NUMERIC_CODE_LIMIT = 1e18  # integer codes are formatted through int64
+EXCEL_ERROR_VALUES = ["#N/A", "#NAME?", "#NULL!", "#DIV/0!", "#NUM!", "#REF!", "#VALUE!", "#SPILL!", "#CALC!"]
+
+def normalize_codes(values) -> pd.DataFrame:
+    """Normalise a column of raw cell values.
+    
+    Returns one row per value with the cleaned `code`, `empty` for blank cells,
+    the `reason` an invalid code is rejected (None if valid) and `duplicate` for
+    repeats of an earlier valid code. Every step runs on whole columns: numeric
+    cells skip the text cleanup and the regular expressions only see the
+    (usually few) codes with characters other than letters and digits."""
+    raw = pd.Series(values, dtype=object)
+    # Missing cells (None, and the NaN pandas fills short rows with) are empty
+    missing = raw.isna()
+    types = raw.map(type)
+    number_types = [kind for kind in types.unique() if issubclass(kind, (int, float, np.number)) and not issubclass(kind, bool)]
+    numeric = types.isin(number_types) & ~missing
+    codes = raw.where(~numeric & ~missing, "").astype(str)
+    
+    # Numeric cells: integral floats lose the ".0", nothing else to clean
+    numbers = raw[numeric].astype(float)
+    in_range = numbers.abs() < NUMERIC_CODE_LIMIT
+    integral = (numbers == np.floor(numbers)) & in_range
+    if numeric.any():
+        codes[numbers.index[integral]] = numbers[integral].astype(np.int64).astype(str)
+        codes[numbers.index[~integral]] = numbers[~integral].astype(str)
+    
+    # Text cells
+    text = codes[~numeric & ~missing]
+    non_ascii = ~text.str.isascii()
+    if non_ascii.any():
+        text[non_ascii] = text[non_ascii].str.normalize("NFKC").str.replace(INVISIBLE_CHARACTERS, "", regex=True)
+    text = text.str.strip()
+    special = ~text.str.isalnum() & (text != "")
+    # Control characters inside a code (a tab, a line break in a cell) make it
+    # invalid: checked before the whitespace is folded
+    control = text[special].str.contains(CONTROL_CHARACTERS, regex=True)
+    if special.any():
+        text[special] = (text[special].str.replace(INTEGRAL_NUMBER_TEXT, r"\1", regex=True)
+                         .str.replace(r"\s+", " ", regex=True))
+    codes[text.index] = text
+    
+    # Codes are probed as written ("0042.jpg"); with CODE_STRIP_LEADING_ZEROS
+    # "0042" and "42" only count as duplicates of each other
+    key = codes
+    if CODE_STRIP_LEADING_ZEROS:
+        digits = codes.str.startswith("0") & codes.str.isdigit()
+        stripped = codes[digits].str.lstrip("0")
+        key = codes.copy()
+        key[digits] = stripped.where(stripped != "", "0")
+    
+    empty = codes == ""
+    reason = pd.Series(None, index=codes.index, dtype=object)
+    reason[numbers.index[~integral & in_range]] = "numero non intero"
+    reason[numbers.index[~in_range]] = "numero fuori intervallo"
+    reason[text.index[text.str.len() > CODE_MAX_LENGTH]] = f"più di {CODE_MAX_LENGTH} caratteri"
+    checked = text[special]
+    reason[checked.index[~checked.str.contains(r"[^\W_]", regex=True)]] = "nessun carattere alfanumerico"
+    reason[checked.index[checked.str.contains(INVALID_CODE_CHARACTERS, regex=True)]] = "caratteri non ammessi in un nome file"
+    reason[checked.index[checked.isin(EXCEL_ERROR_VALUES)]] = "errore di formula Excel"
+    reason[control.index[control]] = "caratteri di controllo"
+    
+    valid = ~empty & reason.isna()
+    duplicate = valid & key.where(valid).duplicated()
+    return pd.DataFrame({"code": codes, "empty": empty, "reason": reason, "duplicate": duplicate})
+
+def invalid_code_samples(rows, values, normalized: pd.DataFrame) -> List[InvalidCode]:
+    """The first invalid codes of a column, with their row and original value"""
+    invalid = normalized.index[normalized["reason"].notna()][:INVALID_CODE_SAMPLES]
+    return [InvalidCode(row=rows[index], value=str(values[index]), reason=normalized.at[index, "reason"]) for index in invalid]
+
+# Code lists are Excel workbooks or delimited text exports (CSV/TSV/TXT). Text
+# lists skip the OOXML unzip and parse entirely: the code column is read by the
+# pandas C parser, full rows (for exports) are streamed with the csv module. A
+# .txt file without a recognised header is a bare list, one code per line.
+CODE_LIST_KINDS = (".xlsx", ".csv", ".tsv", ".txt")
+CODE_LIST_FORMAT_ERROR = "Il file deve essere in formato .xlsx, .csv, .tsv o .txt"
+CODE_COLUMN_ERROR = "Colonna 'CODICE', 'COD.PR' o 'C.ART' non trovata nel file"
+TEXT_LIST_DELIMITERS = [";", ",", "\t", "|"]  # by priority when counts tie
+TEXT_LIST_SNIFF_BYTES = 1024 * 1024
+
+class WorkbookScan(BaseModel):
+    kind: str = ".xlsx"
+    has_header: bool = True
+    column_index: Optional[int] = None
+    column_found: Optional[str] = None
+    available_columns: List[str] = []
+    total_codes: int = 0
+    empty_rows: int = 0
+    duplicate_count: int = 0
+    invalid_count: int = 0
+    invalid_codes: List[InvalidCode] = []
+
+def code_list_kind(filename: Optional[str]) -> Optional[str]:
+    """The supported extension of an uploaded code list, or None"""
+    suffix = Path(filename or "").suffix.lower()
+    return suffix if suffix in CODE_LIST_KINDS else None
+
+@contextmanager
+def open_code_list(source):
+    """Binary stream of a code list given as a path or an (uploaded) file object"""
+    if isinstance(source, (str, Path)):
+        with open(source, "rb") as stream:
+            yield stream
+    else:
+        source.seek(0)
+        yield source
+
+def text_list_format(source, kind: str) -> tuple:
+    """(encoding, delimiter) of a text code list, guessed from its first bytes"""
+    with open_code_list(source) as stream:
+        head = stream.read(TEXT_LIST_SNIFF_BYTES)
+    try:
+        codecs.getincrementaldecoder("utf-8")().decode(head)  # tolerates a character cut at the end
+        encoding = "utf-8-sig"
+    except UnicodeDecodeError:
+        encoding = "cp1252"  # ERP exports on Windows
+    if kind == ".tsv":
+        return encoding, "\t"
+    first_line = next(iter(head.decode(encoding, errors="replace").splitlines()), "")
+    counts = [first_line.count(delimiter) for delimiter in TEXT_LIST_DELIMITERS]
+    return encoding, TEXT_LIST_DELIMITERS[counts.index(max(counts))] if max(counts) else ","
+
+def iter_code_list_rows(source, kind: str):
+    """Yield the rows of a code list as tuples of cell values, header included"""
+    if kind == ".xlsx":
+        with open_code_list(source) as stream:
+            workbook = openpyxl.load_workbook(stream, read_only=True, data_only=True)
+            try:
+                yield from workbook.active.iter_rows(values_only=True)
+            finally:
+                workbook.close()
+        return
+    
+    encoding, delimiter = text_list_format(source, kind)
+    with open_code_list(source) as stream:
+        text = io.TextIOWrapper(stream, encoding=encoding, errors="replace", newline="")
+        try:
+            for row in csv.reader(text, delimiter=delimiter):
+                yield tuple(row)
+        finally:
+            text.detach()  # an uploaded file stays open for its owner
+
+def find_code_column(header_row) -> tuple:
+    """Return (0-based index, column name) of the code column, by priority"""
+    headers = [str(value).upper().strip() if value is not None else "" for value in header_row]
+    for name in CODE_COLUMN_NAMES:
+        if name in headers:
+            return headers.index(name), name
+    return None, None
+
+def read_code_column(source, kind: str, column_index: int, has_header: bool = True, width: int = 1) -> tuple:
+    """Return (row numbers, raw values) of the code column.
+    
+    Workbooks are streamed row by row; text lists are parsed by pandas, only
+    the code column being materialised (`width` is the header's column count)."""
+    first_row = 2 if has_header else 1
+    if kind != ".xlsx":
+        encoding, delimiter = text_list_format(source, kind)
+        try:
+            with open_code_list(source) as stream:
+                column = pd.read_csv(
+                    stream, sep=delimiter, header=None, skiprows=first_row - 1,
+                    names=range(max(width, column_index + 1)), usecols=[column_index], index_col=False,
+                    dtype=str, keep_default_na=False, skip_blank_lines=False,
+                    encoding=encoding, encoding_errors="replace"
+                )[column_index]
+            values = column.tolist()
+            return list(range(first_row, first_row + len(values))), values
+        except pd.errors.EmptyDataError:
+            return [], []
+        except pd.errors.ParserError:
+            pass  # malformed quoting: fall back to the (slower, lenient) csv module
+    
+    rows, values = [], []
+    for row_number, row in enumerate(itertools.islice(iter_code_list_rows(source, kind), first_row - 1, None), start=first_row):
+        rows.append(row_number)
+        values.append(row[column_index] if column_index < len(row) else None)
+    return rows, values
+
+def read_code_list(source, kind: str) -> tuple:
+    """Locate and normalise the code column of a code list.
+    
+    Returns (scan, entries): the counts of valid, empty, duplicate and invalid
+    codes, and the CodeList of the valid ones. Without a code
+    column the scan has no `column_index` and there are no entries."""
+    rows_iter = iter_code_list_rows(source, kind)
+    try:
+        header_row = next(rows_iter, None) or ()
+    finally:
+        rows_iter.close()
+    scan = WorkbookScan(
+        kind=kind,
+        available_columns=[str(value).strip() for value in header_row if value]
+    )
+    scan.column_index, scan.column_found = find_code_column(header_row)
+    if scan.column_index is None:
+        if kind != ".txt" or len(header_row) > 1:
+            return scan, CodeList([], [])
+        scan.column_index, scan.has_header = 0, False
+    
+    rows, values = read_code_column(source, kind, scan.column_index, scan.has_header, len(header_row))
+    normalized = normalize_codes(values)
+    invalid = normalized["reason"].notna()
+    scan.empty_rows = int(normalized["empty"].sum())
+    scan.invalid_count = int(invalid.sum())
+    scan.total_codes = len(normalized) - scan.empty_rows - scan.invalid_count
+    scan.duplicate_count = int(normalized["duplicate"].sum())
+    scan.invalid_codes = invalid_code_samples(rows, values, normalized)
+    return scan, valid_code_entries(rows, normalized)
+
+def valid_code_entries(rows, normalized: pd.DataFrame) -> CodeList:
+    """(row number, normalised code) of the valid codes of a column, duplicates included"""
+    valid = (~normalized["empty"] & normalized["reason"].isna()).to_numpy()
+    return CodeList(np.asarray(rows, dtype=np.uint32)[valid], normalized["code"].to_numpy()[valid])
+
+# HTTP caching for GET endpoints: strong ETags derived from the data (or from
+# the version/state it is built from, so a 304 needs no recomputation)
+SEARCH_MAX_AGE = int(os.environ.get('SEARCH_CACHE_MAX_AGE', 300))
+SEARCH_NEGATIVE_MAX_AGE = int(os.environ.get('SEARCH_CACHE_NEGATIVE_MAX_AGE', 60))
+
+def make_etag(*parts) -> str:
+    digest = hashlib.sha256(json.dumps(parts, sort_keys=True, default=str, separators=(",", ":")).encode()).hexdigest()
+    return f'"{digest[:32]}"'
+
+def etag_matches(request: Request, etag: str) -> bool:
+    """If-None-Match check (weak comparison, as the header requires)"""
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    return any(tag.strip().removeprefix("W/") == etag for tag in header.split(","))
+
+def not_modified(etag: str, cache_control: str) -> Response:
+    return Response(status_code=304, headers={"ETag": etag, "Cache-Control": cache_control})
+
+def accepts_gzip(request: Request) -> bool:
+    return "gzip" in request.headers.get("accept-encoding", "")
+
+@api_router.get("/")
+async def root():
+    return {"message": "Sistema di Ricerca Immagini Prodotti"}
+
+@api_router.get("/progress/{task_id}")
+async def get_progress(task_id: str):
+    if task_id not in progress_storage:
+        raise HTTPException(status_code=404, detail="Task ID non trovato")
+    
+    return progress_storage[task_id].get_progress()
+
+@api_router.post("/cancel/{task_id}")
+async def cancel_task(task_id: str):
+    """Stop a background task, cancelling its in-flight origin requests"""
+    if task_id not in progress_storage:
+        raise HTTPException(status_code=404, detail="Task ID non trovato")
+    
+    tracker = progress_storage[task_id]
+    if tracker.status not in ("pending", "in_progress"):
+        raise HTTPException(status_code=409, detail=f"Il task non è in corso (stato: {tracker.status})")
+    
+    if tracker.job is not None:
+        tracker.job.cancel()
+    elif tracker.pending_codes is not None:
+        tracker.pending_codes = None  # two-phase batch never executed
+    else:
+        raise HTTPException(status_code=409, detail="Il task non può essere annullato")
+    tracker.cancel()
+    return {
+        "task_id": task_id,
+        "status": tracker.status,
+        "completed_items": tracker.completed_items,
+        "message": "Elaborazione annullata"
+    }
+
+@api_router.post("/search-single", response_model=ImageSearchResult)
+async def search_single_product(request: SearchRequest):
+    if not request.code.strip():
+        raise HTTPException(status_code=400, detail="Codice prodotto non può essere vuoto")
+    
+    async with create_origin_session() as session:
+        result = await resolve_code(session, request.code, explain=request.explain, metadata=request.metadata)
+        return result
+
+@api_router.get("/search-single", response_model=ImageSearchResult)
+async def search_single_product_cached(request: Request, code: str, explain: bool = False, metadata: bool = False):
+    """Variante GET di /search-single, memorizzabile da browser e CDN (ETag, Cache-Control, 304)"""
+    code = code.strip()
+    if not code:
+        raise HTTPException(status_code=400, detail="Codice prodotto non può essere vuoto")
+    
+    cached = None if explain else await resolution_cache.get(code)
+    if cached is not None and not (metadata and cached.found and cached.width is None):
+        # A memoized/cached resolution is the response as is: revalidations
+        # (If-None-Match) are answered without touching the origin
+        result = cached
+    else:
+        async with create_origin_session() as session:
+            result = await complete_resolution(session, code, cached, explain=explain, metadata=metadata)
+    
+    if explain or result.error == INCOMPLETE_SEARCH_ERROR:
+        # Traces carry timings, incomplete searches must be retried
+        return JSONResponse(result.model_dump(), headers={"Cache-Control": "no-store"})
+    
+    etag = make_etag("search", result.model_dump(exclude={"trace", "elapsed_ms"}))
+    cache_control = f"public, max-age={SEARCH_MAX_AGE if result.found else SEARCH_NEGATIVE_MAX_AGE}"
+    if etag_matches(request, etag):
+        return not_modified(etag, cache_control)
+    return JSONResponse(result.model_dump(), headers={"ETag": etag, "Cache-Control": cache_control})
+
+@api_router.get("/download-image")
+async def download_single_image(url: str, filename: str):
+    # Images on this machine (local store, mirror) are sent from disk with sendfile/pathsend
+    local_path = image_store.local_path(url)
+    if local_path is not None and local_path.exists():
+        return FileResponse(local_path, media_type="application/octet-stream", filename=filename)
+    
+    try:
+        async with create_origin_session() as session:
+            content = await image_store.read(session, url)
+        if content is None:
+            raise HTTPException(status_code=404, detail="Immagine non trovata")
+        
+        return StreamingResponse(
+            BytesIO(content),
+            media_type="application/octet-stream",
+            headers={"Content-Disposition": f"attachment; filename={filename}"}
+        )
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Errore nel download: {str(e)}")
+
+@api_router.post("/search-batch", response_model=BatchSearchResult)
+async def search_batch_products_sync(file: UploadFile = File(...), explain: bool = False, budget_seconds: Optional[float] = None,
+                                     metadata: bool = False):
+    """Original synchronous batch search endpoint.
+    
+    With `budget_seconds` the response is returned within the budget: codes not
+    resolved in time are listed in `pending_codes` and completed in background
+    (progress and results available through the returned `task_id`)."""
+    set_probe_context(PRIORITY_BATCH, str(uuid.uuid4()))
+    if budget_seconds is not None and budget_seconds <= 0:
+        raise HTTPException(status_code=400, detail="Il budget di tempo deve essere maggiore di zero")
+    kind = code_list_kind(file.filename)
+    if kind is None:
+        raise HTTPException(status_code=400, detail=CODE_LIST_FORMAT_ERROR)
+    
+    upload = open_upload(file)
+    try:
+        # Find the CODICE, COD.PR or C.ART column and normalise its codes
+        scan, entries = await asyncio.to_thread(read_code_list, upload, kind)
+        if scan.column_index is None:
+            raise HTTPException(status_code=400, detail=CODE_COLUMN_ERROR)
+        report = {
+            "duplicate_count": scan.duplicate_count,
+            "invalid_count": scan.invalid_count,
+            "invalid_codes": scan.invalid_codes,
+        }
+        
+        if not entries:
+            raise HTTPException(status_code=400, detail="Nessun codice valido trovato nella colonna")
+        
+        if budget_seconds is not None:
+            batch = await search_codes_with_budget(entries, budget_seconds, explain=explain, metadata=metadata)
+            return batch.model_copy(update=report)
+        
+        # Search for images synchronously, each distinct code once
+        results = []
+        found_codes = []
+        not_found_codes = []
+        resolved = {}
         
-        # Priority 3: C.ART
-        if codice_col is None:
-            for col in range(1, sheet.max_column + 1):
-                cell_value = sheet.cell(row=1, column=col).value
-                if cell_value and str(cell_value).upper().strip() == "C.ART":
-                    codice_col = col
-                    column_found = "C.ART"
-                    break
+        async with create_origin_session() as session:
+            for _, code in entries:
+                if code not in resolved:
+                    resolved[code] = await resolve_code(session, code, explain=explain, metadata=metadata)
+                result = resolved[code]
+                results.append(result)
+                
+                if result.found:
+                    found_codes.append(result.code)
+                else:
+                    not_found_codes.append(result.code)
         
-        if codice_col is None:
-            if not available_columns:
-                raise HTTPException(
-                    status_code=400, 
-                    detail="Il file Excel non contiene intestazioni di colonna. Assicurati che la prima riga contenga i nomi delle colonne"
-                )
-            else:
-                raise HTTPException(
-                    status_code=400, 
-                    detail=f"Colonna richiesta non trovata. Il sistema cerca le colonne: 'CODICE', 'COD.PR' o 'C.ART'. "
-                           f"Colonne trovate nel tuo file: {', '.join(available_columns)}. "
-                           f"Rinomina una delle tue colonne con uno dei nomi supportati."
+        return BatchSearchResult(
+            total_codes=len(entries),
+            found_codes=found_codes,
+            not_found_codes=not_found_codes,
+            results=results,
+            **report
+        )
+    
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Errore nell'elaborazione del file: {str(e)}")
+
+# Candidate rules probed first by time-budgeted searches (one HEAD per format)
+EXACT_RULES = {"exact"}
+
+async def search_codes_with_budget(entries: List[tuple], budget_seconds: float, explain: bool = False,
+                                   metadata: bool = False) -> BatchSearchResult:
+    """Resolve as many (row, code) entries as possible within the time budget.
+    
+    Cached resolutions are used first, then the exact-match probes of every code
+    are queued ahead of the expensive patterns. Searches still running at the
+    deadline are not wasted: they continue in a background task. With `metadata`
+    the image dimensions are read too (counted in the budget)."""
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + budget_seconds
+    unique_codes = list(dict.fromkeys(code for _, code in entries))
+    resolved = {} if explain else await resolution_cache.get_many(unique_codes)
+    
+    async with AsyncExitStack() as cleanup:
+        session = await cleanup.enter_async_context(create_origin_session())
+        jobs = {}
+        handed_off = False
+        try:
+            semaphore = asyncio.Semaphore(BATCH_CONCURRENCY)
+            
+            async def resolve(code: str) -> ImageSearchResult:
+                try:
+                    async with semaphore:
+                        result = await find_product_image(session, code, explain=explain, rules=EXACT_RULES, final=False)
+                    if not result.found:
+                        # Queued behind the exact probes of the codes not started yet
+                        exact_probes = sum(1 for rule, _, _ in iter_candidate_filenames(code) if rule in EXACT_RULES)
+                        async with semaphore:
+                            full_result = await find_product_image(session, code, explain=explain, exclude_rules=EXACT_RULES,
+                                                                   prior_probes=exact_probes)
+                        if explain:
+                            full_result.trace = result.trace + full_result.trace
+                            full_result.elapsed_ms = round(result.elapsed_ms + full_result.elapsed_ms, 2)
+                        result = full_result
+                except Exception as e:
+                    logging.error(f"Errore nella ricerca di {code}: {str(e)}")
+                    return ImageSearchResult(code=code, found=False, error=f"Errore nella ricerca: {str(e)}")
+                if metadata:
+                    await enrich_image_metadata(session, result)
+                await resolution_cache.put(result)
+                return result
+            
+            async def enrich(result: ImageSearchResult) -> ImageSearchResult:
+                if await enrich_image_metadata(session, result):
+                    await resolution_cache.put(result)
+                return result
+            
+            jobs.update((code, asyncio.create_task(resolve(code))) for code in unique_codes if code not in resolved)
+            if metadata:
+                # Cached resolutions whose dimensions are not known yet
+                for code in [code for code, result in resolved.items() if result.found and result.width is None]:
+                    jobs[code] = asyncio.create_task(enrich(resolved.pop(code)))
+            if jobs:
+                await asyncio.wait(jobs.values(), timeout=max(0.0, deadline - loop.time()))
+            pending_jobs = {}
+            for code, job in jobs.items():
+                if job.done():
+                    resolved[code] = job.result()
+                else:
+                    pending_jobs[code] = job
+            
+            results = []
+            found_codes = []
+            not_found_codes = []
+            pending_codes = []
+            for _, code in entries:
+                if code in pending_jobs:
+                    pending_codes.append(code)
+                    continue
+                result = resolved[code]
+                results.append(result)
+                (found_codes if result.found else not_found_codes).append(result.code)
+            
+            task_id = None
+            if pending_jobs:
+                task_id = str(uuid.uuid4())
+                work_dir = BATCH_WORK_DIR / task_id
+                work_dir.mkdir(parents=True, exist_ok=True)
+                tracker = ProgressTracker(task_id, len(entries), work_dir=work_dir)
+                done_entries = [(row, code) for row, code in entries if code in resolved]
+                await tracker.results.append([(row, resolved[code]) for row, code in done_entries])
+                for _, code in done_entries:
+                    tracker.record_result(code, resolved[code].found)
+                progress_storage[task_id] = tracker
+                tracker.job = asyncio.create_task(
+                    finish_budgeted_batch(tracker, session, [entry for entry in entries if entry[1] in pending_jobs], pending_jobs)
                 )
+                # The continuation now owns the searches still running and closes the session
+                cleanup.pop_all()
+                handed_off = True
+        finally:
+            if not handed_off:
+                # Request cancelled (e.g. client disconnected) or failed: stop the searches
+                unfinished = [job for job in jobs.values() if not job.done()]
+                for job in unfinished:
+                    job.cancel()
+                await asyncio.gather(*unfinished, return_exceptions=True)
+    
+    return BatchSearchResult(
+        total_codes=len(entries),
+        found_codes=found_codes,
+        not_found_codes=not_found_codes,
+        results=results,
+        pending_codes=pending_codes,
+        task_id=task_id
+    )
+
+async def finish_budgeted_batch(tracker: ProgressTracker, session: aiohttp.ClientSession, entries: List[tuple], jobs: dict):
+    """Background continuation of a time-budgeted search"""
+    try:
+        for row_number, code in entries:
+            tracker.current_item = f"Cercando {code}..."
+            result = await jobs[code]
+            await tracker.results.append([(row_number, result)])
+            tracker.record_result(code, result.found)
+        tracker.complete()
+    except asyncio.CancelledError:
+        for job in jobs.values():
+            job.cancel()
+        tracker.cancel()
+        raise
+    except Exception as e:
+        tracker.error(str(e))
+    finally:
+        await session.close()
+
+@api_router.post("/search-batch-start")
+async def search_batch_products(file: UploadFile = File(...)):
+    """Prima fase della ricerca in due fasi: carica e valida l'elenco dei codici.
+    
+    I codici letti e normalizzati restano associati al task in forma compatta:
+    /search-batch-execute/{task_id} li cerca senza ricaricare il file."""
+    task_id = str(uuid.uuid4())
+    work_dir = BATCH_WORK_DIR / task_id
+    
+    try:
+        scan, entries = await ingest_code_list_upload(file, work_dir)
         
-        # Extract codes con validazione
-        codes = []
-        empty_rows = 0
-        invalid_codes = []
-        
-        for row in range(2, sheet.max_row + 1):
-            cell_value = sheet.cell(row=row, column=codice_col).value
-            if cell_value is not None:
-                code_str = str(cell_value).strip()
-                if code_str:
-                    codes.append(code_str)
-                else:
-                    empty_rows += 1
-            else:
-                empty_rows += 1
+        tracker = ProgressTracker(task_id, scan.total_codes, work_dir=work_dir)
+        tracker.source_filename = file.filename
+        tracker.source_kind = scan.kind
+        tracker.column_index = scan.column_index
+        tracker.has_header = scan.has_header
+        tracker.pending_codes = entries
+        tracker.status = "pending"
+        tracker.current_item = "In attesa di esecuzione"
+        progress_storage[task_id] = tracker
         
-        if not codes:
+        return {
+            "task_id": task_id,
+            "total_codes": scan.total_codes,
+            "distinct_codes": tracker.pending_codes.distinct_count,
+            "column_used": scan.column_found,
+            "empty_rows_skipped": scan.empty_rows,
+            "duplicate_codes": scan.duplicate_count,
+            "invalid_codes_skipped": scan.invalid_count,
+            "invalid_codes": [invalid.model_dump() for invalid in scan.invalid_codes],
+            "message": "Elenco caricato. Usa l'ID per avviare la ricerca e tracciarne il progresso."
+        }
+    
+    except HTTPException:
+        shutil.rmtree(work_dir, ignore_errors=True)
+        raise
+    except Exception as e:
+        shutil.rmtree(work_dir, ignore_errors=True)
+        raise HTTPException(status_code=500, detail=f"Errore nell'elaborazione del file: {str(e)}")
+
+@api_router.post("/search-batch-execute/{task_id}", response_model=BatchSearchResult)
+async def execute_batch_search(task_id: str, explain: bool = False, metadata: bool = False):
+    """Seconda fase: cerca i codici caricati con /search-batch-start.
+    
+    La ricerca gira sul motore concorrente dei batch come job del task, quindi
+    /progress, /cancel, /results ed /export-results funzionano come per
+    /search-batch-async. La risposta arriva a ricerca completata; se il client
+    si disconnette prima, la ricerca prosegue comunque."""
+    if task_id not in progress_storage:
+        raise HTTPException(status_code=404, detail="Task ID non trovato")
+    
+    tracker = progress_storage[task_id]
+    if tracker.pending_codes is None:
+        raise HTTPException(
+            status_code=409,
+            detail="Nessun elenco di codici in attesa per questo task (già eseguito o non creato con /search-batch-start)"
+        )
+    
+    pending, tracker.pending_codes = tracker.pending_codes, None
+    tracker.status = "in_progress"
+    tracker.start_time = datetime.now()
+    tracker.job = asyncio.create_task(
+        process_batch_async(tracker, pending.chunks(), explain=explain, metadata=metadata)
+    )
+    # Waiting does not propagate a client disconnect (or a /cancel) into the job
+    await asyncio.wait({tracker.job})
+    
+    if tracker.status == "cancelled":
+        raise HTTPException(status_code=409, detail="Ricerca annullata")
+    if tracker.status == "error":
+        raise HTTPException(status_code=500, detail=f"Errore durante la ricerca: {tracker.current_item}")
+    
+    stored = await asyncio.to_thread(tracker.results.read, tracker.results.select())
+    results = [ImageSearchResult(**record) for record in stored]
+    return BatchSearchResult(
+        total_codes=len(results),
+        found_codes=[result.code for result in results if result.found],
+        not_found_codes=[result.code for result in results if not result.found],
+        results=results,
+        task_id=task_id,
+        duplicate_count=len(pending) - pending.distinct_count
+    )
+
+async def ingest_code_list_upload(file: UploadFile, work_dir: Path) -> tuple:
+    """Validate an uploaded code list, save it as `work_dir`/source.<ext> and read its code column.
+    
+    Returns (scan, entries) as read_code_list. Raises HTTPException (400) with a
+    user-facing message for every invalid upload."""
+    # Validazione formato file
+    if not file.filename:
+        raise HTTPException(status_code=400, detail="Nome file non valido")
+    
+    kind = code_list_kind(file.filename)
+    if kind is None:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Formato file non supportato. Il file '{file.filename}' deve essere in formato Excel (.xlsx) o testo delimitato (.csv, .tsv, .txt)"
+        )
+    
+    # Validazione dimensione file (max 10MB)
+    upload = open_upload(file)
+    
+    # Keep the file on disk for the results export
+    work_dir.mkdir(parents=True, exist_ok=True)
+    source_path = work_dir / f"source{kind}"
+    await asyncio.to_thread(save_upload, upload, source_path)
+    
+    # Tentativo di lettura del file
+    try:
+        scan, entries = await asyncio.to_thread(read_code_list, source_path, kind)
+    except Exception as e:
+        if kind == ".xlsx":
+            detail = f"Impossibile leggere il file Excel. Assicurati che sia un file .xlsx valido e non corrotto. Errore: {str(e)}"
+        else:
+            detail = f"Impossibile leggere il file {kind}. Assicurati che sia un file di testo delimitato valido. Errore: {str(e)}"
+        raise HTTPException(status_code=400, detail=detail)
+    
+    # Verifica che il foglio non sia vuoto
+    if scan.column_index is not None and scan.total_codes + scan.empty_rows + scan.invalid_count == 0:
+        raise HTTPException(
+            status_code=400, 
+            detail="Il file sembra essere vuoto o non contiene dati. Assicurati che ci siano almeno 2 righe (intestazione + dati)"
+        )
+    
+    if scan.column_index is None:
+        if not scan.available_columns:
             raise HTTPException(
                 status_code=400, 
-                detail=f"Nessun codice prodotto valido trovato nella colonna '{column_found}'. "
-                       f"Assicurati che la colonna contenga codici prodotto validi (non vuoti) a partire dalla riga 2"
+                detail="Il file non contiene intestazioni di colonna. Assicurati che la prima riga contenga i nomi delle colonne"
             )
-        
-        if len(codes) > 1000:
+        else:
             raise HTTPException(
                 status_code=400, 
-                detail=f"Troppi codici nel file ({len(codes)}). Limite massimo: 1000 codici per elaborazione"
+                detail=f"Colonna richiesta non trovata. Il sistema cerca le colonne: 'CODICE', 'COD.PR' o 'C.ART'. "
+                       f"Colonne trovate nel tuo file: {', '.join(scan.available_columns)}. "
+                       f"Rinomina una delle tue colonne con uno dei nomi supportati."
             )
+    
+    if scan.total_codes == 0:
+        invalid_hint = ""
+        if scan.invalid_codes:
+            first = scan.invalid_codes[0]
+            invalid_hint = f" {scan.invalid_count} valori scartati (es. riga {first.row}: '{first.value}', {first.reason})."
+        raise HTTPException(
+            status_code=400, 
+            detail=f"Nessun codice prodotto valido trovato nella colonna '{scan.column_found}'.{invalid_hint} "
+                   f"Assicurati che la colonna contenga codici prodotto validi (non vuoti) a partire dalla riga 2"
+        )
+    
+    if scan.total_codes > MAX_BATCH_CODES:
+        raise HTTPException(
+            status_code=400, 
+            detail=f"Troppi codici nel file ({scan.total_codes}). Limite massimo: {MAX_BATCH_CODES} codici per elaborazione"
+        )
+    
+    return scan, entries
+
+@api_router.post("/search-batch-async")
+async def search_batch_async(file: UploadFile = File(...), explain: bool = False, metadata: bool = False):
+    """Versione asincrona che avvia l'elaborazione in background con validazione migliorata.
+    
+    Accetta file Excel (.xlsx) ed elenchi di testo (.csv, .tsv, .txt). Il file viene
+    salvato su disco (per l'export) e in memoria resta solo la colonna dei codici,
+    cercati a blocchi anche per cataloghi da decine di migliaia di codici."""
+    
+    # Generate unique task ID
+    task_id = str(uuid.uuid4())
+    work_dir = BATCH_WORK_DIR / task_id
+    
+    try:
+        scan, entries = await ingest_code_list_upload(file, work_dir)
         
         # Log informazioni per debug
-        logging.info(f"File processato: {file.filename}, Colonna: {column_found}, Codici validi: {len(codes)}, Righe vuote: {empty_rows}")
+        logging.info(f"File processato: {file.filename}, Colonna: {scan.column_found}, Codici validi: {scan.total_codes}, "
+                     f"Righe vuote: {scan.empty_rows}, Duplicati: {scan.duplicate_count}, Non validi: {scan.invalid_count}")
         
         # Create progress tracker
-        tracker = ProgressTracker(task_id, len(codes))
+        tracker = ProgressTracker(task_id, scan.total_codes, work_dir=work_dir)
+        tracker.source_filename = file.filename
+        tracker.source_kind = scan.kind
+        tracker.column_index = scan.column_index
+        tracker.has_header = scan.has_header
         progress_storage[task_id] = tracker
         
         # Start background processing
-        asyncio.create_task(process_batch_async(tracker, codes))
+        tracker.job = asyncio.create_task(
+            process_batch_async(tracker, entries.chunks(), explain=explain, metadata=metadata)
+        )
         
         return {
             "task_id": task_id,
             "message": f"Elaborazione avviata con successo",
-            "total_codes": len(codes),
-            "column_used": column_found,
-            "empty_rows_skipped": empty_rows
+            "total_codes": scan.total_codes,
+            "column_used": scan.column_found,
+            "empty_rows_skipped": scan.empty_rows,
+            "duplicate_codes": scan.duplicate_count,
+            "invalid_codes_skipped": scan.invalid_count,
+            "invalid_codes": [invalid.model_dump() for invalid in scan.invalid_codes]
         }
             
     except HTTPException:
         # Re-raise HTTP exceptions (validation errors)
+        shutil.rmtree(work_dir, ignore_errors=True)
         raise
     except Exception as e:
+        shutil.rmtree(work_dir, ignore_errors=True)
         logging.error(f"Errore imprevisto nell'elaborazione del file {file.filename}: {str(e)}")
         raise HTTPException(
             status_code=500, 
             detail=f"Errore interno durante l'elaborazione del file. Se il problema persiste, contatta l'assistenza. Dettagli: {str(e)}"
         )
 
-async def process_batch_async(tracker: ProgressTracker, codes: List[str]):
-    """Process batch search in background with progress tracking"""
+async def search_chunk(session: aiohttp.ClientSession, chunk: List[tuple], semaphore: asyncio.Semaphore, explain: bool = False,
+                       metadata: bool = False) -> List[ImageSearchResult]:
+    """Search a chunk of (row, code) pairs concurrently, keeping the input order.
+    
+    Codes repeated within the chunk are searched once."""
+    unique_codes = list(dict.fromkeys(code for _, code in chunk))
+    cached = {} if explain else await resolution_cache.get_many(unique_codes)
+    
+    async def search_one(code: str) -> ImageSearchResult:
+        if code in cached:
+            result = cached[code]
+            if metadata and await enrich_image_metadata(session, result):
+                await resolution_cache.put(result)
+            return result
+        async with semaphore:
+            result = await find_product_image(session, code, explain=explain)
+            if metadata:
+                await enrich_image_metadata(session, result)
+        await resolution_cache.put(result)
+        return result
+    
+    resolved = dict(zip(unique_codes, await asyncio.gather(*(search_one(code) for code in unique_codes))))
+    return [resolved[code] for _, code in chunk]
+
+async def process_batch_async(tracker: ProgressTracker, code_chunks, explain: bool = False, metadata: bool = False):
+    """Process batch search in background with progress tracking.
+    
+    `code_chunks` is an iterator of lists of (row, code) pairs, already parsed
+    and normalised; each chunk is searched concurrently and its results appended
+    to the task results file."""
+    set_probe_context(PRIORITY_BATCH, tracker.task_id)
+    semaphore = asyncio.Semaphore(BATCH_CONCURRENCY)
     try:
-        async with aiohttp.ClientSession() as session:
-            for code in codes:
-                # Update progress - searching
-                tracker.update_progress(f"Cercando {code}...")
-                
-                # Perform search
-                result = await find_product_image(session, code)
+        async with create_origin_session() as session:
+            for chunk in code_chunks:
+                tracker.current_item = f"Cercando {chunk[0][1]}..."
+                results = await search_chunk(session, chunk, semaphore, explain=explain, metadata=metadata)
                 
-                # Update tracker based on result - this will increment completed_items
-                if result.found:
-                    tracker.found_items.append(code)
-                else:
-                    tracker.not_found_items.append(code)
-                    
-                tracker.completed_items += 1
-                tracker.current_item = f"Completato {code} ({'trovato' if result.found else 'non trovato'})"
+                if tracker.results is not None:
+                    await tracker.results.append([(row_number, result) for (row_number, _), result in zip(chunk, results)])
+                for (_, code), result in zip(chunk, results):
+                    tracker.record_result(code, result.found)
                 
-                # Small delay to prevent overwhelming the server
-                await asyncio.sleep(0.2)
+                last_code, last_result = chunk[-1][1], results[-1]
+                tracker.current_item = f"Completato {last_code} ({'trovato' if last_result.found else 'non trovato'})"
             
             # Complete the task
             tracker.complete()
     
+    except asyncio.CancelledError:
+        # In-flight probes are cancelled with the task and free their origin slots
+        tracker.cancel()
+        raise
     except Exception as e:
         tracker.error(str(e))
 
-@api_router.post("/download-batch-zip")
-async def download_batch_zip(file: UploadFile = File(...)):
-    if not file.filename.endswith('.xlsx'):
-        raise HTTPException(status_code=400, detail="Il file deve essere in formato .xlsx")
+@api_router.get("/results/{task_id}")
+async def get_batch_results(request: Request, task_id: str, offset: int = 0, limit: int = 100, status: Optional[str] = None):
+    """Page through the full results (code, URL, format) of an async batch"""
+    if task_id not in progress_storage:
+        raise HTTPException(status_code=404, detail="Task ID non trovato")
+    
+    tracker = progress_storage[task_id]
+    if tracker.results is None:
+        raise HTTPException(status_code=404, detail="Risultati non disponibili per questo task")
+    
+    if offset < 0 or not 1 <= limit <= 1000:
+        raise HTTPException(status_code=400, detail="Parametri non validi: offset >= 0 e limit tra 1 e 1000")
+    
+    status_filters = {"found": RESULT_FOUND, "not_found": RESULT_NOT_FOUND}
+    if status is not None and status not in status_filters:
+        raise HTTPException(status_code=400, detail="Filtro stato non valido. Valori ammessi: found, not_found")
+    
+    # A page only changes while results are appended
+    etag = make_etag("results", task_id, tracker.status, len(tracker.results), offset, limit, status)
+    cache_control = "private, max-age=600" if tracker.status in ("completed", "error", "cancelled") else "private, no-cache"
+    if etag_matches(request, etag):
+        return not_modified(etag, cache_control)
+    
+    indexes = tracker.results.select(status_filters.get(status))
+    page = indexes[offset:offset + limit]
+    results = await asyncio.to_thread(tracker.results.read, page)
+    next_offset = offset + len(page)
+    
+    return JSONResponse({
+        "task_id": task_id,
+        "status": tracker.status,
+        "total_items": tracker.total_items,
+        "available": len(indexes),
+        "offset": offset,
+        "limit": limit,
+        "next_offset": next_offset if next_offset < len(indexes) else None,
+        "results": results
+    }, headers={"ETag": etag, "Cache-Control": cache_control})
+
+# Columns appended to the original workbook by the results export
+EXPORT_COLUMNS = ["URL_IMMAGINE", "FORMATO", "STATO", "DIMENSIONE_BYTE", "LARGHEZZA", "ALTEZZA"]
+
+def iter_task_results(results_path: Optional[Path]):
+    """Yield the stored results of a task, in row order"""
+    if not results_path or not results_path.exists():
+        return
+    with open(results_path) as results_file:
+        for line in results_file:
+            yield json.loads(line)
+
+def write_results_workbook(tracker: ProgressTracker, output_path: Path):
+    """Copy the original code list into a workbook adding URL/format/status/metadata columns.
+    
+    Both sides are streamed (read-only or CSV source, write-only output), so the
+    memory used does not depend on the number of rows."""
+    output = openpyxl.Workbook(write_only=True)
+    output_sheet = output.create_sheet(title="Risultati")
+    results = iter_task_results(tracker.results_path)
+    pending = next(results, None)
+    width = 1
+    source_rows = iter_code_list_rows(tracker.source_path, tracker.source_kind)
     
     try:
-        # Read Excel file and extract codes (same logic as above)
-        contents = await file.read()
-        workbook = openpyxl.load_workbook(BytesIO(contents))
-        sheet = workbook.active
-        
-        # Find CODICE, COD.PR, or C.ART column
-        codice_col = None
-        column_found = None
-        
-        # Priority 1: CODICE
-        for col in range(1, sheet.max_column + 1):
-            cell_value = sheet.cell(row=1, column=col).value
-            if cell_value and str(cell_value).upper() == "CODICE":
-                codice_col = col
-                column_found = "CODICE"
-                break
-        
-        # Priority 2: COD.PR
-        if codice_col is None:
-            for col in range(1, sheet.max_column + 1):
-                cell_value = sheet.cell(row=1, column=col).value
-                if cell_value and str(cell_value).upper() == "COD.PR":
-                    codice_col = col
-                    column_found = "COD.PR"
-                    break
-        
-        # Priority 3: C.ART
-        if codice_col is None:
-            for col in range(1, sheet.max_column + 1):
-                cell_value = sheet.cell(row=1, column=col).value
-                if cell_value and str(cell_value).upper() == "C.ART":
-                    codice_col = col
-                    column_found = "C.ART"
-                    break
-        
-        if codice_col is None:
-            raise HTTPException(status_code=400, detail="Colonna 'CODICE', 'COD.PR' o 'C.ART' non trovata nel file Excel")
+        if not tracker.has_header:
+            output_sheet.append(["CODICE"] + EXPORT_COLUMNS)
+        for row_number, row in enumerate(source_rows, start=1):
+            values = list(row)
+            if row_number == 1 and tracker.has_header:
+                width = len(values)
+                output_sheet.append(values + EXPORT_COLUMNS)
+                continue
+            
+            # Results are written in row order, skip ahead to this row
+            while pending is not None and pending["row"] < row_number:
+                pending = next(results, None)
+            
+            values += [None] * (width - len(values))
+            if pending is not None and pending["row"] == row_number:
+                status = "Trovato" if pending["found"] else "Non trovato"
+                values += [pending["image_url"], pending["format"], status,
+                           pending.get("size_bytes"), pending.get("width"), pending.get("height")]
+            elif tracker.column_index < len(row) and row[tracker.column_index] not in (None, ""):
+                # Every valid code has a result once the task is completed
+                status = "Codice non valido" if tracker.status == "completed" else "In attesa"
+                values += [None, None, status, None, None, None]
+            else:
+                values += [None] * len(EXPORT_COLUMNS)
+            output_sheet.append(values)
         
-        codes = []
-        for row in range(2, sheet.max_row + 1):
-            cell_value = sheet.cell(row=row, column=codice_col).value
-            if cell_value:
-                codes.append(str(cell_value).strip())
+        output.save(output_path)
+    finally:
+        source_rows.close()
+
+@api_router.get("/export-results/{task_id}")
+async def export_batch_results(task_id: str):
+    """Download the original Excel file enriched with the search results"""
+    if task_id not in progress_storage:
+        raise HTTPException(status_code=404, detail="Task ID non trovato")
+    
+    tracker = progress_storage[task_id]
+    if not tracker.source_path or not tracker.source_path.exists():
+        raise HTTPException(status_code=404, detail="File originale non disponibile per questo task")
+    
+    output_path = tracker.work_dir / f"export-{uuid.uuid4().hex}.xlsx"
+    try:
+        await asyncio.to_thread(write_results_workbook, tracker, output_path)
+    except Exception as e:
+        output_path.unlink(missing_ok=True)
+        logging.error(f"Errore nell'esportazione dei risultati {task_id}: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Errore nell'esportazione dei risultati: {str(e)}")
+    
+    stem = Path(tracker.source_filename or "risultati").stem
+    return FileResponse(
+        output_path,
+        media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+        filename=f"{stem}_risultati.xlsx",
+        background=BackgroundTask(output_path.unlink, missing_ok=True)
+    )
+
+@api_router.post("/download-batch-zip")
+async def download_batch_zip(request: Request, file: UploadFile = File(...)):
+    set_probe_context(PRIORITY_ZIP, str(uuid.uuid4()))
+    kind = code_list_kind(file.filename)
+    if kind is None:
+        raise HTTPException(status_code=400, detail=CODE_LIST_FORMAT_ERROR)
+    
+    try:
+        scan, entries = await asyncio.to_thread(read_code_list, open_upload(file), kind)
+        if scan.column_index is None:
+            raise HTTPException(status_code=400, detail=CODE_COLUMN_ERROR)
+        # Distinct normalised codes: a repeated code adds nothing to the archive
+        codes = entries.distinct_codes()
         
         # Create temporary directory for images
         temp_dir = tempfile.mkdtemp()
         zip_path = os.path.join(temp_dir, "immagini_prodotti.zip")
         
         try:
-            # Browser-like headers for downloading images
-            headers = {
-                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
-                'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,image/apng,*/*;q=0.8',
-                'Accept-Language': 'en-US,en;q=0.9,it;q=0.8',
-                'Accept-Encoding': 'gzip, deflate, br',
-                'Connection': 'keep-alive',
-                'Upgrade-Insecure-Requests': '1'
-            }
+            # Stop searching and downloading as soon as the client goes away
+            downloaded_count, archive_path = await run_until_disconnected(request, build_zip_archive(codes, zip_path))
             
-            async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=60)) as session:
-                with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zip_file:
-                    downloaded_count = 0
-                    
-                    for code in codes:
-                        try:
-                            result = await find_product_image(session, code)
-                            
-                            if result.found and result.image_url:
-                                try:
-                                    async with session.get(result.image_url, headers=headers, timeout=aiohttp.ClientTimeout(total=30)) as response:
-                                        if response.status == 200:
-                                            image_content = await response.read()
-                                            filename = f"{code}{result.format}"
-                                            zip_file.writestr(filename, image_content)
-                                            downloaded_count += 1
-                                            logging.info(f"Added {filename} to ZIP ({downloaded_count}/{len(codes)})")
-                                except Exception as e:
-                                    logging.error(f"Errore nel download di {code}: {str(e)}")
-                                    continue
-                        except Exception as e:
-                            logging.error(f"Errore nella ricerca di {code}: {str(e)}")
-                            continue
-                    
-                    logging.info(f"ZIP creation completed: {downloaded_count} images added")
-                    
-                    if downloaded_count == 0:
-                        raise HTTPException(status_code=404, detail="Nessuna immagine trovata per i codici forniti")
+            if downloaded_count == 0:
+                raise HTTPException(status_code=404, detail="Nessuna immagine trovata per i codici forniti")
+            
+            ZIP_ARCHIVE_BYTES.inc(os.path.getsize(archive_path))
             
-            # Return zip file
+            # Return zip file (FileResponse uses the ASGI pathsend/sendfile extension when the server offers it)
             return FileResponse(
-                zip_path,
+                archive_path,
                 media_type="application/zip",
                 filename="immagini_prodotti.zip",
-                background=lambda: shutil.rmtree(temp_dir)
+                background=BackgroundTask(shutil.rmtree, temp_dir, ignore_errors=True)
             )
             
+        except ClientDisconnected:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+            logging.info("Client disconnesso: creazione ZIP annullata")
+            return Response(status_code=499)
         except Exception as e:
-            shutil.rmtree(temp_dir)
+            shutil.rmtree(temp_dir, ignore_errors=True)
             raise e
     
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Errore nell'elaborazione: {str(e)}")
+
+# ZIP compression policy: JPEG/PNG/WebP are already compressed, deflating them
+# burns CPU for ~0% gain, so they are stored; TIF (often uncompressed) is deflated
+ZIP_STORED_FORMATS = {".jpg", ".jpeg", ".png", ".webp"}
+ZIP_DEFLATE_LEVEL = int(os.environ.get('ZIP_DEFLATE_LEVEL', 6))
+# Entries above this size are written (CRC + compression) from a worker thread
+ZIP_THREAD_THRESHOLD = 256 * 1024
+
+def zip_compression_for(format_ext: Optional[str]) -> tuple:
+    """Return (compress_type, compresslevel) for an image format"""
+    if (format_ext or "").lower() in ZIP_STORED_FORMATS:
+        return zipfile.ZIP_STORED, None
+    return zipfile.ZIP_DEFLATED, ZIP_DEFLATE_LEVEL
+
+class ZipPayload:
+    """An image compressed once for the ZIP, written as-is by every entry sharing it"""
+    def __init__(self, compress_type: int, crc: int, file_size: int, data: bytes):
+        self.compress_type = compress_type
+        self.crc = crc
+        self.file_size = file_size
+        self.data = data
+
+def compress_zip_payload(content: bytes, format_ext: Optional[str]) -> ZipPayload:
+    compress_type, compresslevel = zip_compression_for(format_ext)
+    data = content
+    if compress_type == zipfile.ZIP_DEFLATED:
+        # Raw deflate stream, as zipfile itself writes it
+        compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, -15)
+        data = compressor.compress(content) + compressor.flush()
+    return ZipPayload(compress_type, zlib.crc32(content), len(content), data)
+
+def write_zip_payload(zip_file: zipfile.ZipFile, filename: str, payload: ZipPayload):
+    """Append an entry with already compressed data (zipfile has no public API
+    for this: the steps mirror ZipFile.open(mode='w') on a seekable file, and
+    tests/test_zip_archive.py checks them against the running zipfile)"""
+    zinfo = zipfile.ZipInfo(filename, date_time=time.localtime(time.time())[:6])
+    zinfo.compress_type = payload.compress_type
+    zinfo.external_attr = 0o600 << 16
+    zinfo.file_size = payload.file_size
+    zinfo.compress_size = len(payload.data)
+    zinfo.CRC = payload.crc
+    with zip_file._lock:
+        zip_file._writecheck(zinfo)
+        zip_file._didModify = True
+        zip_file.fp.seek(zip_file.start_dir)
+        zinfo.header_offset = zip_file.fp.tell()
+        zip_file.fp.write(zinfo.FileHeader())
+        zip_file.fp.write(payload.data)
+        zip_file.start_dir = zip_file.fp.tell()
+        zip_file.filelist.append(zinfo)
+        zip_file.NameToInfo[zinfo.filename] = zinfo
+
+async def prepare_zip_payload(content: bytes, format_ext: Optional[str]) -> ZipPayload:
+    if len(content) >= ZIP_THREAD_THRESHOLD:
+        # zlib releases the GIL, so the event loop keeps serving other requests
+        return await asyncio.to_thread(compress_zip_payload, content, format_ext)
+    return compress_zip_payload(content, format_ext)
+
+async def write_zip_entry(zip_file: zipfile.ZipFile, filename: str, payload: ZipPayload):
+    if payload.file_size >= ZIP_THREAD_THRESHOLD:
+        await asyncio.to_thread(write_zip_payload, zip_file, filename, payload)
+    else:
+        write_zip_payload(zip_file, filename, payload)
+
+# Finished archives are kept as artifacts keyed by a hash of the codes and their
+# resolved URLs/ETags, so repeated downloads of the same spreadsheet skip the build
+ZIP_ARTIFACT_DIR = Path(os.environ.get('ZIP_ARTIFACT_DIR', os.path.join(tempfile.gettempdir(), 'borella-zip-artifacts')))
+ZIP_ARTIFACT_MAX_BYTES = int(os.environ.get('ZIP_ARTIFACT_MAX_BYTES', 2 * 1024 * 1024 * 1024))
+ZIP_ARTIFACT_TTL = timedelta(hours=int(os.environ.get('ZIP_ARTIFACT_TTL_HOURS', 12)))
+
+ZIP_ARTIFACTS = Counter("image_search_zip_artifacts_total", "ZIP artifact cache lookups", ["result"])
+
+class ZipArtifactCache:
+    """Size-bounded, expiring directory of finished ZIP archives.
+    
+    The file mtime is the creation time (expiry), the atime the last use (LRU)."""
+    def __init__(self, directory: Path, max_bytes: int, ttl: timedelta):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+    
+    @staticmethod
+    def key_for(results: List[ImageSearchResult]) -> str:
+        entries = sorted({(result.code, result.image_url, result.etag or "") for result in results if result.found})
+        return hashlib.sha256(json.dumps(entries).encode()).hexdigest()
+    
+    def _path(self, key: str) -> Path:
+        return self.directory / f"{key}.zip"
+    
+    def _expired(self, stat_result) -> bool:
+        return time.time() - stat_result.st_mtime > self.ttl.total_seconds()
+    
+    def get(self, key: str) -> Optional[Path]:
+        path = self._path(key)
+        try:
+            stat_result = path.stat()
+        except FileNotFoundError:
+            ZIP_ARTIFACTS.labels(result="miss").inc()
+            return None
+        if self._expired(stat_result):
+            path.unlink(missing_ok=True)
+            ZIP_ARTIFACTS.labels(result="miss").inc()
+            return None
+        os.utime(path, (time.time(), stat_result.st_mtime))
+        ZIP_ARTIFACTS.labels(result="hit").inc()
+        return path
+    
+    def put(self, key: str, zip_path: str) -> Path:
+        self.directory.mkdir(parents=True, exist_ok=True)
+        path = self._path(key)
+        shutil.move(zip_path, path)
+        self.evict()
+        return path
+    
+    def evict(self):
+        """Drop expired artifacts, then the least recently used until under the size limit"""
+        artifacts = []
+        for path in self.directory.glob("*.zip"):
+            try:
+                stat_result = path.stat()
+            except FileNotFoundError:
+                continue
+            if self._expired(stat_result):
+                path.unlink(missing_ok=True)
+            else:
+                artifacts.append((stat_result.st_atime, stat_result.st_size, path))
+        
+        total = sum(size for _, size, _ in artifacts)
+        for _, size, path in sorted(artifacts):
+            if total <= self.max_bytes:
+                break
+            path.unlink(missing_ok=True)
+            total -= size
+
+zip_artifacts = ZipArtifactCache(ZIP_ARTIFACT_DIR, ZIP_ARTIFACT_MAX_BYTES, ZIP_ARTIFACT_TTL)
+
+async def build_zip_archive(codes: List[str], zip_path: str, tracker: Optional[ProgressTracker] = None) -> tuple:
+    """Search and download the images of `codes` into a ZIP file.
+    
+    Returns (number of images, archive path): the archive is either a cached
+    artifact for the same codes/images or the freshly built `zip_path`, which is
+    then stored as an artifact. Codes are resolved first and grouped by image
+    URL: catalog families sharing one file (e.g. 22497-22501 PORTAFOTO-ASTRA)
+    download it once and every code's entry reuses the same bytes.
+    
+    With a `tracker` (ZIP jobs), codes resolved and images/bytes written are
+    reported as the archive is built."""
+    async with create_origin_session(timeout=aiohttp.ClientTimeout(total=60)) as session:
+        semaphore = asyncio.Semaphore(BATCH_CONCURRENCY)
+        results = []
+        for start in range(0, len(codes), BATCH_CHUNK_SIZE):
+            chunk = list(enumerate(codes[start:start + BATCH_CHUNK_SIZE], start=start))
+            if tracker is not None:
+                tracker.current_item = f"Cercando {chunk[0][1]}..."
+            chunk_results = await search_chunk(session, chunk, semaphore)
+            results.extend(chunk_results)
+            if tracker is not None:
+                for result in chunk_results:
+                    tracker.record_result(result.code, result.found)
+        
+        # image URL -> results of the codes using it, in spreadsheet order
+        images = {}
+        for result in results:
+            if result.found and result.image_url:
+                images.setdefault(result.image_url, []).append(result)
+        
+        entry_count = len({f"{result.code}{result.format}" for results_group in images.values() for result in results_group})
+        if tracker is not None:
+            tracker.zip_progress.update(images_total=entry_count)
+        
+        artifact_key = zip_artifacts.key_for(results)
+        artifact_path = await asyncio.to_thread(zip_artifacts.get, artifact_key)
+        if artifact_path is not None:
+            logging.info(f"ZIP servito dalla cache: {artifact_key}")
+            if tracker is not None:
+                tracker.zip_progress.update(images_written=entry_count, bytes_written=os.path.getsize(artifact_path))
+            return entry_count, str(artifact_path)
+        
+        async def download(image_url: str) -> Optional[bytes]:
+            local_path = image_store.local_path(image_url)
+            if local_path is not None and local_path.exists():
+                return await asyncio.to_thread(local_path.read_bytes)
+            return await image_store.read(session, image_url)
+        
+        # Images are downloaded in windows; the next window downloads while the
+        # current one is written, keeping at most two windows in memory
+        urls = list(images)
+        windows = [urls[index:index + BATCH_CONCURRENCY] for index in range(0, len(urls), BATCH_CONCURRENCY)]
+        
+        def fetch_window(window_index: int):
+            if window_index >= len(windows):
+                return None
+            return asyncio.ensure_future(asyncio.gather(*(download(url) for url in windows[window_index])))
+        
+        with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zip_file:
+            downloaded_count = 0
+            failed_downloads = 0
+            written = set()
+            next_window = fetch_window(0)
+            
+            try:
+                for window_index, window in enumerate(windows):
+                    contents = await next_window
+                    next_window = fetch_window(window_index + 1)
+                    
+                    for image_url, image_content in zip(window, contents):
+                        if image_content is None:
+                            failed_downloads += 1
+                            continue
+                        # Compressed (and CRC'd) once, however many codes share the image
+                        payloads = {}
+                        for result in images[image_url]:
+                            filename = f"{result.code}{result.format}"
+                            if filename in written:
+                                continue
+                            if result.format not in payloads:
+                                payloads[result.format] = await prepare_zip_payload(image_content, result.format)
+                            await write_zip_entry(zip_file, filename, payloads[result.format])
+                            written.add(filename)
+                            downloaded_count += 1
+                            logging.info(f"Added {filename} to ZIP ({downloaded_count}/{len(codes)})")
+                    
+                    if tracker is not None:
+                        tracker.current_item = f"Scaricate {downloaded_count}/{entry_count} immagini"
+                        tracker.zip_progress.update(images_written=downloaded_count, bytes_written=zip_file.fp.tell())
+            finally:
+                if next_window is not None and not next_window.done():
+                    next_window.cancel()
+            
+            logging.info(f"ZIP creation completed: {downloaded_count} images added, {len(images)} downloaded")
+        
+        if tracker is not None:
+            tracker.zip_progress.update(bytes_written=os.path.getsize(zip_path))
+        
+        # Only complete archives are reused
+        if downloaded_count and not failed_downloads:
+            return downloaded_count, str(await asyncio.to_thread(zip_artifacts.put, artifact_key, zip_path))
+        return downloaded_count, zip_path
+
+@api_router.post("/download-batch-zip-async")
+async def download_batch_zip_async(file: UploadFile = File(...)):
+    """Avvia la creazione dello ZIP in background.
+    
+    L'avanzamento (codici risolti, immagini scritte, byte scritti) è visibile su
+    /progress/{task_id}; a completamento lo ZIP si scarica da /download-zip/{task_id}."""
+    task_id = str(uuid.uuid4())
+    work_dir = BATCH_WORK_DIR / task_id
+    
+    try:
+        scan, entries = await ingest_code_list_upload(file, work_dir)
+        # A repeated code adds nothing to the archive
+        codes = entries.distinct_codes()
+        
+        tracker = ProgressTracker(task_id, len(codes), work_dir=work_dir)
+        tracker.source_filename = file.filename
+        tracker.source_kind = scan.kind
+        tracker.column_index = scan.column_index
+        tracker.has_header = scan.has_header
+        tracker.zip_progress = {"images_total": None, "images_written": 0, "bytes_written": 0}
+        progress_storage[task_id] = tracker
+        
+        tracker.job = asyncio.create_task(process_zip_async(tracker, codes))
+        
+        return {
+            "task_id": task_id,
+            "message": "Creazione ZIP avviata con successo",
+            "total_codes": scan.total_codes,
+            "column_used": scan.column_found,
+            "empty_rows_skipped": scan.empty_rows,
+            "duplicate_codes": scan.duplicate_count,
+            "invalid_codes_skipped": scan.invalid_count,
+            "invalid_codes": [invalid.model_dump() for invalid in scan.invalid_codes]
+        }
+    
+    except HTTPException:
+        shutil.rmtree(work_dir, ignore_errors=True)
+        raise
     except Exception as e:
+        shutil.rmtree(work_dir, ignore_errors=True)
+        logging.error(f"Errore imprevisto nell'avvio dello ZIP per {file.filename}: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Errore nell'elaborazione: {str(e)}")
 
+async def process_zip_async(tracker: ProgressTracker, codes: List[str]):
+    """Build the ZIP archive of a task in background"""
+    set_probe_context(PRIORITY_ZIP, tracker.task_id)
+    try:
+        zip_path = tracker.work_dir / "immagini_prodotti.zip"
+        downloaded_count, archive_path = await build_zip_archive(codes, str(zip_path), tracker)
+        
+        if downloaded_count == 0:
+            tracker.error("Nessuna immagine trovata per i codici forniti")
+            return
+        
+        # The task keeps its own link to cached artifacts, which may be evicted before the download
+        if Path(archive_path) != zip_path:
+            try:
+                await asyncio.to_thread(os.link, archive_path, zip_path)
+            except OSError:
+                await asyncio.to_thread(shutil.copyfile, archive_path, zip_path)
+        tracker.archive_path = zip_path
+        tracker.complete()
+    
+    except asyncio.CancelledError:
+        tracker.cancel()
+        raise
+    except Exception as e:
+        logging.error(f"Errore nella creazione dello ZIP {tracker.task_id}: {str(e)}")
+        tracker.error(str(e))
+
+@api_router.get("/download-zip/{task_id}")
+async def download_zip_result(task_id: str):
+    """Scarica lo ZIP prodotto da un task /download-batch-zip-async"""
+    if task_id not in progress_storage:
+        raise HTTPException(status_code=404, detail="Task ID non trovato")
+    
+    tracker = progress_storage[task_id]
+    if tracker.zip_progress is None:
+        raise HTTPException(status_code=404, detail="Il task non produce un archivio ZIP")
+    
+    if tracker.status != "completed":
+        raise HTTPException(status_code=409, detail=f"Archivio ZIP non pronto (stato: {tracker.status})")
+    
+    if not tracker.archive_path or not tracker.archive_path.exists():
+        raise HTTPException(status_code=404, detail="Archivio ZIP non più disponibile")
+    
+    ZIP_ARCHIVE_BYTES.inc(tracker.archive_path.stat().st_size)
+    stem = Path(tracker.source_filename or "immagini_prodotti").stem
+    return FileResponse(tracker.archive_path, media_type="application/zip", filename=f"{stem}_immagini.zip")
+
+@api_router.get("/mirror/status")
+async def get_mirror_status():
+    """Stato del mirror locale della cartella immagini"""
+    if image_mirror is None:
+        return {"enabled": False}
+    return image_mirror.get_status()
+
+@api_router.post("/mirror/sync")
+async def sync_mirror():
+    """Avvia subito una sincronizzazione del mirror locale"""
+    if image_mirror is None:
+        raise HTTPException(status_code=404, detail="Modalità mirror non attiva (IMAGE_MIRROR_DIR non impostata)")
+    if image_mirror.syncing:
+        raise HTTPException(status_code=409, detail="Sincronizzazione già in corso")
+    
+    asyncio.create_task(image_mirror.try_sync())
+    return {"message": "Sincronizzazione avviata", **image_mirror.get_status()}
+
+@api_router.get("/cache/status")
+async def get_cache_status():
+    """Statistiche della cache delle risoluzioni (memo in memoria e MongoDB) e del rilevamento modifiche"""
+    return {
+        "memo": resolution_memo.get_status(),
+        "shared": {"enabled": resolution_cache.enabled, "available": resolution_cache.available},
+        "origin_watch": origin_watcher.get_status()
+    }
+
+MANIFEST_CACHE_CONTROL = "public, max-age=60"
+
+def gzip_json_response(request: Request, body: bytes, headers: Optional[dict] = None) -> Response:
+    """Send gzip-compressed JSON, decompressing it for clients that do not accept gzip"""
+    headers = dict(headers or {})
+    headers["Vary"] = "Accept-Encoding"
+    if accepts_gzip(request):
+        headers["Content-Encoding"] = "gzip"
+    else:
+        body = gzip.decompress(body)
+    return Response(body, media_type="application/json", headers=headers)
+
+@api_router.get("/manifest")
+async def get_manifest(request: Request):
+    """Manifest completo codice -> immagine (JSON compresso gzip) per i plugin WordPress"""
+    if not resolution_manifest.enabled:
+        raise HTTPException(status_code=404, detail="Manifest non attivo")
+    try:
+        # Clients holding the current version get a 304 without an export
+        etag = make_etag("manifest", await resolution_manifest.version(), accepts_gzip(request))
+        if etag_matches(request, etag):
+            return not_modified(etag, MANIFEST_CACHE_CONTROL)
+        version, body = await resolution_manifest.export()
+    except Exception as e:
+        logging.error(f"Errore nella generazione del manifest: {str(e)}")
+        raise HTTPException(status_code=503, detail="Manifest temporaneamente non disponibile")
+    
+    # The export may be newer than the version checked above
+    etag = make_etag("manifest", version, accepts_gzip(request))
+    return gzip_json_response(request, body, {
+        "X-Manifest-Version": str(version), "ETag": etag, "Cache-Control": MANIFEST_CACHE_CONTROL
+    })
+
+@api_router.get("/manifest/changes")
+async def get_manifest_changes(request: Request, since: int, limit: int = 5000):
+    """Modifiche al manifest dopo la versione `since` (codici aggiornati e rimossi)"""
+    if not resolution_manifest.enabled:
+        raise HTTPException(status_code=404, detail="Manifest non attivo")
+    if since < 0 or not 1 <= limit <= MANIFEST_MAX_CHANGES:
+        raise HTTPException(status_code=400, detail=f"Parametri non validi: since >= 0 e limit tra 1 e {MANIFEST_MAX_CHANGES}")
+    try:
+        etag = make_etag("manifest-changes", await resolution_manifest.version(), since, limit, accepts_gzip(request))
+        if etag_matches(request, etag):
+            return not_modified(etag, MANIFEST_CACHE_CONTROL)
+        changes = await resolution_manifest.changes(since, limit)
+    except Exception as e:
+        logging.error(f"Errore nella lettura delle modifiche al manifest: {str(e)}")
+        raise HTTPException(status_code=503, detail="Manifest temporaneamente non disponibile")
+    body = await asyncio.to_thread(lambda: gzip.compress(json.dumps(changes, separators=(",", ":")).encode()))
+    return gzip_json_response(request, body, {"X-Manifest-Version": str(changes["version"]), "ETag": etag, "Cache-Control": MANIFEST_CACHE_CONTROL})
+
 # Plugin download endpoints
 @api_router.get("/download-plugin")
 async def download_plugin():
@@ -896,9 +3503,16 @@ async def download_plugin_autonomo():
         }
     )
 
+@app.get("/metrics")
+async def metrics():
+    """Prometheus scrape endpoint"""
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
 # Include the router in the main app
 app.include_router(api_router)
 
+app.add_middleware(UploadSizeLimitMiddleware, max_body_size=MAX_UPLOAD_SIZE + UPLOAD_BODY_OVERHEAD)
+
 app.add_middleware(
     CORSMiddleware,
     allow_credentials=True,
@@ -914,6 +3528,41 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+@app.on_event("startup")
+async def create_cache_indexes():
+    await resolution_cache.ensure_indexes()
+    await resolution_manifest.ensure_indexes()
+    if resolution_manifest.enabled:
+        resolution_manifest.job = asyncio.create_task(resolution_manifest.run())
+
+@app.on_event("startup")
+async def start_task_sweeper():
+    global task_sweeper
+    task_sweeper = asyncio.create_task(run_task_sweeper())
+
+@app.on_event("startup")
+async def start_image_mirror():
+    if image_mirror is not None:
+        await asyncio.to_thread(image_mirror.load)
+        image_mirror.job = asyncio.create_task(image_mirror.run(IMAGE_MIRROR_SYNC_MINUTES))
+
+@app.on_event("startup")
+async def start_origin_watcher():
+    # With the mirror enabled its syncs report the origin changes
+    if image_mirror is None and ORIGIN_WATCH_SECONDS > 0:
+        origin_watcher.job = asyncio.create_task(origin_watcher.run(ORIGIN_WATCH_SECONDS))
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
-    client.close()
\ No newline at end of file
+    if resolution_manifest.job:
+        resolution_manifest.job.cancel()
+        await resolution_manifest.flush()
+    client.close()
+    if image_mirror is not None and image_mirror.job:
+        image_mirror.job.cancel()
+    if origin_watcher.job:
+        origin_watcher.job.cancel()
+    if task_sweeper is not None:
+        task_sweeper.cancel()
+    if origin_recorder:
+        origin_recorder.close()
\ No newline at end of file
@@ -2,6 +2,8 @@ import requests
 import sys
 import os
 import tempfile
+import time
+import zipfile
 import openpyxl
 from datetime import datetime
 from io import BytesIO
@@ -107,6 +109,67 @@ class ImageSearchAPITester:
         
         return True, {"code": "TEST123", "found": False}
 
+    def test_single_search_explain(self):
+        """Test single search with the probe trace (explain mode)"""
+        success, response = self.run_test(
+            "Single Search - Explain Mode",
+            "POST",
+            "search-single",
+            200,
+            data={"code": "117", "explain": True}
+        )
+        
+        if success and not response.get('trace'):
+            print("   ❌ Explain mode returned no probe trace")
+            return False, response
+        
+        if success:
+            print(f"   🔎 Probes: {len(response['trace'])} in {response.get('elapsed_ms')} ms")
+        return success, response
+
+    def test_single_search_metadata(self):
+        """Test single search with image size and dimensions"""
+        success, response = self.run_test(
+            "Single Search - Image Metadata",
+            "POST",
+            "search-single",
+            200,
+            data={"code": "25627", "metadata": True}
+        )
+        
+        if success and response.get('found') and not (response.get('width') and response.get('height')):
+            print("   ❌ Metadata requested but no dimensions returned")
+            return False, response
+        
+        if success:
+            print(f"   📐 {response.get('width')}x{response.get('height')}, {response.get('size_bytes')} byte, {response.get('content_type')}")
+        return success, response
+
+    def test_single_search_conditional_get(self):
+        """Test ETag/304 revalidation of the GET single search"""
+        url = f"{self.api_url}/search-single"
+        self.tests_run += 1
+        print(f"\n🔍 Testing Single Search - Conditional GET...")
+        print(f"   URL: {url}")
+        try:
+            response = requests.get(url, params={"code": "25627"})
+            etag = response.headers.get("ETag")
+            if response.status_code != 200 or not etag:
+                print(f"❌ Failed - Status {response.status_code}, ETag {etag}")
+                return False, {}
+            
+            revalidated = requests.get(url, params={"code": "25627"}, headers={"If-None-Match": etag})
+            if revalidated.status_code != 304:
+                print(f"❌ Failed - Expected 304, got {revalidated.status_code}")
+                return False, {}
+            
+            self.tests_passed += 1
+            print(f"✅ Passed - ETag {etag}, Cache-Control: {response.headers.get('Cache-Control')}")
+            return True, {}
+        except Exception as e:
+            print(f"❌ Failed - Error: {str(e)}")
+            return False, {}
+
     def test_single_search_empty(self):
         """Test single search with empty code"""
         return self.run_test(
@@ -179,11 +242,80 @@ class ImageSearchAPITester:
             files=files
         )
 
+    def test_batch_search_normalisation(self):
+        """Test code normalisation: numeric cells, duplicates and invalid values"""
+        codes = [25627.0, " 25627 ", "0117", 117, 117.5, "#N/A", "A/B"]
+        excel_file = self.create_test_excel_file(codes)
+        
+        files = {'file': ('normalisation.xlsx', excel_file, 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')}
+        
+        success, response = self.run_test(
+            "Batch Search - Code Normalisation",
+            "POST",
+            "search-batch",
+            200,
+            files=files
+        )
+        
+        if success:
+            searched = [result['code'] for result in response.get('results', [])]
+            # Leading zeros are kept: "0117" is probed as "0117.jpg"
+            if searched != ["25627", "25627", "0117", "117"] or response.get('invalid_count') != 3 or response.get('duplicate_count') != 1:
+                print(f"   ❌ Unexpected normalisation: {searched}, {response.get('invalid_codes')}")
+                return False, response
+            print(f"   🧹 Invalid codes reported: {[invalid['value'] for invalid in response['invalid_codes']]}")
+        return success, response
+
+    def test_batch_search_time_budget(self):
+        """Test batch search with a time budget (partial results + background task)"""
+        test_codes = ["24369", "13025", "2210", "117", "TEST123", "PROD001"]
+        excel_file = self.create_test_excel_file(test_codes)
+        
+        files = {'file': ('budget_codes.xlsx', excel_file, 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')}
+        
+        success, response = self.run_test(
+            "Batch Search - Time Budget 2s",
+            "POST",
+            "search-batch?budget_seconds=2",
+            200,
+            files=files
+        )
+        
+        if success:
+            resolved = len(response.get('results', []))
+            pending = len(response.get('pending_codes', []))
+            print(f"   ⏱️  Resolved: {resolved}, Pending: {pending}, Task: {response.get('task_id')}")
+            if resolved + pending != len(test_codes):
+                print("   ❌ Resolved + pending codes do not match the uploaded codes")
+                return False, response
+        
+        return success, response
+
+    def test_batch_search_time_budget_metadata(self):
+        """Test that a time-budgeted batch search returns the image metadata when requested"""
+        excel_file = self.create_test_excel_file(["25627", "24369"])
+        files = {'file': ('budget_metadata.xlsx', excel_file, 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')}
+        
+        success, response = self.run_test(
+            "Batch Search - Time Budget With Metadata",
+            "POST",
+            "search-batch?budget_seconds=10&metadata=true",
+            200,
+            files=files
+        )
+        
+        if success:
+            missing = [result['code'] for result in response.get('results', []) if result.get('found') and not result.get('width')]
+            if missing:
+                print(f"   ❌ Metadata requested but no dimensions returned for {missing}")
+                return False, response
+        return success, response
+
     def test_batch_search_invalid_file(self):
         """Test batch search with invalid file"""
-        # Create a text file instead of Excel
+        # Create a file in an unsupported format (text lists are accepted)
         text_content = "This is not an Excel file"
-        files = {'file': ('test.txt', BytesIO(text_content.encode()), 'text/plain')}
+        files = {'file': ('test.pdf', BytesIO(text_content.encode()), 'application/pdf')}
         
         return self.run_test(
             "Batch Search - Invalid File",
@@ -193,6 +325,37 @@ class ImageSearchAPITester:
             files=files
         )
 
+    def test_batch_search_csv(self):
+        """Test batch search with a semicolon separated CSV export"""
+        csv_content = "DESCRIZIONE;CODICE\nTisaniera;25627\nPortafoto;117\nArticolo test;TEST123\n"
+        files = {'file': ('codici.csv', BytesIO(csv_content.encode()), 'text/csv')}
+        
+        success, response = self.run_test(
+            "Batch Search - CSV File",
+            "POST",
+            "search-batch",
+            200,
+            files=files
+        )
+        
+        if success and [result['code'] for result in response.get('results', [])] != ["25627", "117", "TEST123"]:
+            print(f"   ❌ Unexpected codes read from the CSV: {response.get('results')}")
+            return False, response
+        return success, response
+
+    def test_batch_search_oversized_file(self):
+        """Test that uploads above the 10MB limit are rejected"""
+        oversized = BytesIO(b"0" * (11 * 1024 * 1024))
+        files = {'file': ('oversized.xlsx', oversized, 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')}
+        
+        return self.run_test(
+            "Batch Search - Oversized File",
+            "POST",
+            "search-batch",
+            413,
+            files=files
+        )
+
     def test_batch_search_no_codice_column(self):
         """Test batch search with Excel file without CODICE column"""
         workbook = openpyxl.Workbook()
@@ -272,6 +435,80 @@ class ImageSearchAPITester:
         
         return success, response
 
+    def test_download_batch_zip_repeated(self):
+        """Test that repeating a batch ZIP download returns the same entries (names and CRCs)"""
+        known_codes = ["24369", "13025", "2210", "117"]
+        excel_file = self.create_test_excel_file(known_codes)
+        
+        archives = []
+        for attempt in range(2):
+            excel_file.seek(0)
+            files = {'file': ('known_codes.xlsx', excel_file, 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')}
+            success, response = self.run_test(
+                f"Download Batch ZIP - Repeated ({attempt + 1})",
+                "POST",
+                "download-batch-zip",
+                200,
+                files=files
+            )
+            if not success:
+                return False, {}
+            # Entry timestamps may differ between builds, contents may not
+            with zipfile.ZipFile(BytesIO(response)) as zip_file:
+                archives.append(sorted((info.filename, info.CRC) for info in zip_file.infolist()))
+        
+        if not archives[0] or archives[0] != archives[1]:
+            print(f"   ⚠️  Repeated download returned different entries: {archives[0]} vs {archives[1]}")
+            return False, {}
+        print(f"   📦 {len(archives[0])} identical entries")
+        return True, {}
+
+    def test_two_phase_batch_search(self):
+        """Test /search-batch-start followed by /search-batch-execute"""
+        excel_file = self.create_test_excel_file(["24369", "13025", "117", "117", "TEST123"])
+        files = {'file': ('two_phase.xlsx', excel_file, 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')}
+        
+        success, response = self.run_test(
+            "Two-Phase Batch - Start",
+            "POST",
+            "search-batch-start",
+            200,
+            files=files
+        )
+        if not success or 'task_id' not in response:
+            return False, response
+        
+        task_id = response['task_id']
+        print(f"   📋 {response.get('total_codes')} codes ({response.get('distinct_codes')} distinct) waiting for execution")
+        
+        success, response = self.run_test(
+            "Two-Phase Batch - Pending Status",
+            "GET",
+            f"progress/{task_id}",
+            200
+        )
+        if success and response.get('status') != "pending":
+            print(f"   ❌ Expected status 'pending' before execution, got {response.get('status')}")
+            return False, response
+        
+        success, response = self.run_test(
+            "Two-Phase Batch - Execute",
+            "POST",
+            f"search-batch-execute/{task_id}",
+            200
+        )
+        if success and response.get('total_codes') != 5:
+            print(f"   ❌ Expected 5 results, got {response.get('total_codes')}")
+            return False, response
+        
+        # The code list is consumed by the first execution
+        return self.run_test(
+            "Two-Phase Batch - Execute Twice",
+            "POST",
+            f"search-batch-execute/{task_id}",
+            409
+        )
+
     def test_batch_search_async_known_codes(self):
         """Test async batch search with known working codes - STUCK TASK"""
         known_codes = ["24369", "13025", "2210", "117"]
@@ -316,6 +553,36 @@ class ImageSearchAPITester:
         
         return success, response
 
+    def test_batch_search_async_large_file(self):
+        """Test async batch search above the old 1000 codes limit"""
+        large_codes = [str(100000 + i) for i in range(1500)]
+        excel_file = self.create_test_excel_file(large_codes)
+        
+        files = {'file': ('large_codes_async.xlsx', excel_file, 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')}
+        
+        success, response = self.run_test(
+            "Batch Search Async - 1500 Codes",
+            "POST",
+            "search-batch-async",
+            200,
+            files=files
+        )
+        
+        if success and response.get('total_codes') != len(large_codes):
+            print(f"   ❌ Expected {len(large_codes)} codes, got {response.get('total_codes')}")
+            return False, response
+        
+        # The codes are made up: stop the task instead of probing the origin for all of them
+        if success and response.get('task_id'):
+            self.run_test(
+                "Batch Search Async - Cancel 1500 Codes",
+                "POST",
+                f"cancel/{response['task_id']}",
+                200
+            )
+        
+        return success, response
+
     def test_progress_tracking_invalid_task(self):
         """Test progress tracking with invalid task ID"""
         fake_task_id = "invalid-task-id-12345"
@@ -352,7 +619,6 @@ class ImageSearchAPITester:
         print(f"   📋 Created task_id: {task_id}")
         
         # Now test progress tracking
-        import time
         time.sleep(1)  # Give it a moment to start processing
         
         progress_success, progress_response = self.run_test(
@@ -371,6 +637,136 @@ class ImageSearchAPITester:
         
         return progress_success, progress_response
 
+    def test_cancel_invalid_task(self):
+        """Test task cancellation with invalid task ID"""
+        return self.run_test(
+            "Cancel Task - Invalid Task ID",
+            "POST",
+            "cancel/invalid-task-id-12345",
+            404
+        )
+
+    def test_results_invalid_task(self):
+        """Test paginated results with invalid task ID"""
+        return self.run_test(
+            "Batch Results - Invalid Task ID",
+            "GET",
+            "results/invalid-task-id-12345",
+            404,
+            params={"offset": 0, "limit": 50}
+        )
+
+    def test_export_results_invalid_task(self):
+        """Test results export with invalid task ID"""
+        return self.run_test(
+            "Export Results - Invalid Task ID",
+            "GET",
+            "export-results/invalid-task-id-12345",
+            404
+        )
+
+    def test_download_zip_invalid_task(self):
+        """Test downloading the ZIP of an invalid task ID"""
+        fake_task_id = "invalid-task-id-12345"
+        
+        return self.run_test(
+            "Download ZIP - Invalid Task",
+            "GET",
+            f"download-zip/{fake_task_id}",
+            404
+        )
+
+    def test_download_batch_zip_async(self):
+        """Test background ZIP creation followed by download by task ID"""
+        known_codes = ["24369", "13025", "2210", "117"]
+        excel_file = self.create_test_excel_file(known_codes)
+        
+        files = {'file': ('known_codes.xlsx', excel_file, 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')}
+        
+        success, response = self.run_test(
+            "Download Batch ZIP Async - Start",
+            "POST",
+            "download-batch-zip-async",
+            200,
+            files=files
+        )
+        if not success or 'task_id' not in response:
+            return False, {}
+        
+        task_id = response['task_id']
+        for _ in range(30):
+            time.sleep(2)
+            progress_success, progress = self.run_test(
+                "Download Batch ZIP Async - Progress",
+                "GET",
+                f"progress/{task_id}",
+                200
+            )
+            if not progress_success:
+                return False, {}
+            print(f"   ZIP progress: {progress.get('zip')}")
+            if progress.get('status') != 'in_progress':
+                break
+        
+        if progress.get('status') != 'completed':
+            print(f"   ⚠️  ZIP job ended with status {progress.get('status')}")
+            return progress.get('status') == 'error', progress
+        
+        return self.run_test(
+            "Download Batch ZIP Async - Download",
+            "GET",
+            f"download-zip/{task_id}",
+            200
+        )
+
+    def test_mirror_status(self):
+        """Test the local mirror status endpoint"""
+        success, response = self.run_test(
+            "Mirror Status",
+            "GET",
+            "mirror/status",
+            200
+        )
+        if success and 'enabled' not in response:
+            print("   ⚠️  Missing 'enabled' in mirror status")
+            return False, response
+        return success, response
+
+    def test_cache_status(self):
+        """Test the resolution cache statistics after a repeated lookup"""
+        for _ in range(2):
+            self.run_test("Cache Warm-up Search", "POST", "search-single", 200, data={"code": "24369"})
+        success, response = self.run_test(
+            "Cache Status",
+            "GET",
+            "cache/status",
+            200
+        )
+        memo = response.get('memo', {}) if success else {}
+        if success and not all(key in memo for key in ("entries", "hits", "misses", "hit_rate")):
+            print("   ⚠️  Missing fields in cache status")
+            return False, response
+        if success and 'origin_watch' not in response:
+            print("   ⚠️  Missing origin change detection status")
+            return False, response
+        if memo.get('enabled'):
+            print(f"   Memo: {memo['entries']} entries, hit rate {memo['hit_rate']}")
+        return success, response
+
+    def test_manifest_changes(self):
+        """Test the manifest delta endpoint"""
+        success, response = self.run_test(
+            "Manifest Changes Since 0",
+            "GET",
+            "manifest/changes",
+            200,
+            params={"since": 0, "limit": 10}
+        )
+        if success and not all(key in response for key in ("version", "changes", "removed")):
+            print("   ⚠️  Missing fields in manifest changes")
+            return False, response
+        return success, response
+
     def test_complete_async_workflow(self):
         """Test complete async workflow: upload -> progress -> completion - CRITICAL STUCK TASK"""
         print("\n🔄 Testing Complete Async Workflow (CRITICAL STUCK TASK)")
@@ -398,7 +794,6 @@ class ImageSearchAPITester:
         print(f"   📋 Task ID: {task_id}")
         
         # Step 2: Poll progress multiple times
-        import time
         max_polls = 10
         poll_count = 0
         final_status = None
@@ -459,15 +854,34 @@ def main():
         tester.test_root_endpoint,
         tester.test_single_search_known_codes,
         tester.test_single_search_test_codes,
+        tester.test_single_search_explain,
+        tester.test_single_search_metadata,
+        tester.test_single_search_conditional_get,
         tester.test_single_search_empty,
         tester.test_download_image_invalid,
         tester.test_batch_search_known_codes,
         tester.test_batch_search_test_codes,
+        tester.test_batch_search_normalisation,
+        tester.test_batch_search_time_budget,
+        tester.test_batch_search_time_budget_metadata,
         tester.test_batch_search_invalid_file,
+        tester.test_batch_search_csv,
+        tester.test_batch_search_oversized_file,
         tester.test_batch_search_no_codice_column,
         tester.test_download_batch_zip_test_codes,
+        tester.test_download_batch_zip_repeated,
         tester.test_batch_search_async_test_codes,
+        tester.test_batch_search_async_large_file,
         tester.test_progress_tracking_invalid_task,
+        tester.test_results_invalid_task,
+        tester.test_cancel_invalid_task,
+        tester.test_export_results_invalid_task,
+        tester.test_two_phase_batch_search,
+        tester.test_download_batch_zip_async,
+        tester.test_download_zip_invalid_task,
+        tester.test_mirror_status,
+        tester.test_cache_status,
+        tester.test_manifest_changes,
     ]
     
     # Run stuck tests first
@@ -0,0 +1,4 @@
+"""Offline benchmarks for the image search backend.
+
+Run with `python -m benchmarks.run_benchmarks` from the repository root.
+"""
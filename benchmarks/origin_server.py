@@ -0,0 +1,161 @@
+"""Local stand-in for the image origin (IMAGE_BASE_URL).
+
+Serves a synthetic image folder with realistic filenames (exact codes with
+mixed-case extensions, "(1)" variants, multi-code names, descriptive
+suffixes) with configurable latency and error rate.
+
+    python -m benchmarks.origin_server --codes 2000 --latency-ms 30 --error-rate 0.01
+"""
+import argparse
+import asyncio
+import random
+import threading
+import urllib.parse
+from collections import Counter
+
+from aiohttp import web
+
+EXACT_EXTENSIONS = [".jpg", ".JPG", ".png", ".PNG", ".webp", ".tif", ".TIF"]
+EXACT_WEIGHTS = [40, 25, 10, 5, 5, 10, 5]
+SUFFIXES = ["ROSSO", "BEST TISANIERA"]
+
+
+def build_catalog(codes: int = 2000, first_code: int = 10000, missing_rate: float = 0.15, seed: int = 42):
+    """Return (filenames, searched codes) for a synthetic image folder"""
+    rng = random.Random(seed)
+    filenames = []
+    searched = []
+    code = first_code
+
+    while code < first_code + codes:
+        roll = rng.random()
+        if roll < missing_rate:
+            searched.append(str(code))
+            code += 1
+        elif roll < missing_rate + 0.08:
+            # Multi-code name: "10020 - 10021 - 10022.jpg"
+            group = [str(code + offset) for offset in range(3)]
+            filenames.append(" - ".join(group) + ".jpg")
+            searched.extend(group)
+            code += 3
+        elif roll < missing_rate + 0.16:
+            filenames.append(f"{code} (1){rng.choice(['.jpg', '.JPG'])}")
+            searched.append(str(code))
+            code += 1
+        elif roll < missing_rate + 0.20:
+            filenames.append(f"{code} - {rng.choice(SUFFIXES)}.jpg")
+            searched.append(str(code))
+            code += 1
+        else:
+            extension = rng.choices(EXACT_EXTENSIONS, weights=EXACT_WEIGHTS)[0]
+            filenames.append(f"{code}{extension}")
+            searched.append(str(code))
+            code += 1
+
+    rng.shuffle(searched)
+    return filenames, searched
+
+
+class OriginServer:
+    """aiohttp application serving the synthetic folder"""
+
+    def __init__(self, filenames, latency_ms: float = 20.0, jitter_ms: float = 5.0,
+                 error_rate: float = 0.0, image_size: int = 64 * 1024, seed: int = 42):
+        self.files = set(filenames)
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.payload = random.Random(seed).randbytes(image_size)
+        self.rng = random.Random(seed)
+        self.requests = Counter()
+
+    def reset_stats(self):
+        self.requests.clear()
+
+    async def _delay(self):
+        delay = max(0.0, self.rng.gauss(self.latency_ms, self.jitter_ms)) / 1000
+        if delay:
+            await asyncio.sleep(delay)
+
+    async def handle_image(self, request: web.Request) -> web.Response:
+        self.requests[request.method] += 1
+        await self._delay()
+
+        if self.error_rate and self.rng.random() < self.error_rate:
+            self.requests["error"] += 1
+            return web.Response(status=503)
+
+        name = urllib.parse.unquote(request.match_info["name"])
+        if name not in self.files:
+            return web.Response(status=404)
+
+        headers = {"ETag": f'"{abs(hash(name))}"', "Content-Type": "image/jpeg"}
+        if request.headers.get("If-None-Match") == headers["ETag"]:
+            return web.Response(status=304, headers=headers)
+        if request.method == "HEAD":
+            headers["Content-Length"] = str(len(self.payload))
+            return web.Response(status=200, headers=headers)
+        if request.http_range.start is not None or request.http_range.stop is not None:
+            start, stop, _ = request.http_range.indices(len(self.payload))
+            headers["Content-Range"] = f"bytes {start}-{stop - 1}/{len(self.payload)}"
+            return web.Response(status=206, body=self.payload[start:stop], headers=headers)
+        return web.Response(body=self.payload, headers=headers)
+
+    async def handle_listing(self, request: web.Request) -> web.Response:
+        """nginx-style directory index of the folder (used by the mirror sync)"""
+        self.requests["listing"] += 1
+        await self._delay()
+        lines = ["<html><body><pre>"]
+        for name in sorted(self.files):
+            lines.append(f'<a href="{urllib.parse.quote(name)}">{name}</a>  01-Jan-2024 00:00  {len(self.payload)}')
+        lines.append("</pre></body></html>")
+        return web.Response(text="\n".join(lines), content_type="text/html")
+
+    def make_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_get("/", self.handle_listing)
+        app.router.add_route("*", "/{name:.+}", self.handle_image)
+        return app
+
+
+def start_in_thread(origin: OriginServer, host: str = "127.0.0.1", port: int = 0) -> str:
+    """Run the origin on its own event loop thread and return its base URL"""
+    loop = asyncio.new_event_loop()
+    started = threading.Event()
+    state = {}
+
+    async def start():
+        runner = web.AppRunner(origin.make_app(), access_log=None)
+        await runner.setup()
+        site = web.TCPSite(runner, host, port)
+        await site.start()
+        state["port"] = runner.addresses[0][1]
+
+    def run():
+        asyncio.set_event_loop(loop)
+        loop.run_until_complete(start())
+        started.set()
+        loop.run_forever()
+
+    threading.Thread(target=run, name="origin-server", daemon=True).start()
+    started.wait()
+    return f"http://{host}:{state['port']}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in for the image origin")
+    parser.add_argument("--port", type=int, default=8900)
+    parser.add_argument("--codes", type=int, default=2000)
+    parser.add_argument("--latency-ms", type=float, default=20.0)
+    parser.add_argument("--jitter-ms", type=float, default=5.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    args = parser.parse_args()
+
+    filenames, _ = build_catalog(args.codes)
+    origin = OriginServer(filenames, args.latency_ms, args.jitter_ms, args.error_rate)
+    print(f"Serving {len(filenames)} images on http://127.0.0.1:{args.port}")
+    web.run_app(origin.make_app(), host="127.0.0.1", port=args.port, access_log=None)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+"""Replay a recorded origin trace as a local origin server.
+
+A trace is captured by starting the backend with ORIGIN_TRACE_FILE set:
+every request to the real origin is appended as a JSON line (URL, status,
+headers, timing, body size). The replay server answers the same requests
+with the recorded status, headers and latency, so probe counts and latency
+of different find_product_image versions can be compared against a frozen
+real-world catalog:
+
+    ORIGIN_TRACE_FILE=origin-trace.jsonl uvicorn server:app   # capture
+    python -m benchmarks.run_benchmarks --replay origin-trace.jsonl
+
+Requests missing from the trace are answered 404 with the median latency of
+recorded misses and counted as "unmatched" (a file that exists in the real
+folder but was never probed during capture will not be found).
+"""
+import asyncio
+import json
+import statistics
+import urllib.parse
+from collections import Counter, defaultdict
+
+from aiohttp import web
+
+
+class ReplayOrigin:
+    """aiohttp application serving a recorded trace"""
+
+    def __init__(self, trace_path: str, speed: float = 1.0):
+        self.speed = speed
+        self.image_base_url = None
+        self.responses = defaultdict(list)
+        self.cursors = Counter()
+        self.requests = Counter()
+        self.codes = []
+
+        seen_codes = set()
+        miss_latencies = []
+        with open(trace_path) as trace_file:
+            for line in trace_file:
+                record = json.loads(line)
+                if record["type"] == "meta":
+                    self.image_base_url = self.image_base_url or record["image_base_url"]
+                    continue
+
+                path = urllib.parse.urlsplit(record["url"]).path
+                self.responses[(record["method"], path)].append(record)
+                if record.get("status") == 404:
+                    miss_latencies.append(record["elapsed_ms"])
+
+                # Every lookup starts by probing "<code>.jpg"
+                filename = urllib.parse.unquote(path.rsplit("/", 1)[-1])
+                if record["method"] == "HEAD" and filename.endswith(".jpg") and " " not in filename:
+                    code = filename[:-len(".jpg")]
+                    if code not in seen_codes:
+                        seen_codes.add(code)
+                        self.codes.append(code)
+
+        self.miss_latency_ms = statistics.median(miss_latencies) if miss_latencies else 0.0
+        self.base_path = urllib.parse.urlsplit(self.image_base_url or "").path.rstrip("/")
+
+    def reset_stats(self):
+        self.requests.clear()
+        self.cursors.clear()
+
+    async def _delay(self, elapsed_ms: float):
+        if elapsed_ms and self.speed:
+            await asyncio.sleep(elapsed_ms / 1000 / self.speed)
+
+    def _recorded(self, method: str, path: str):
+        records = self.responses.get((method, path))
+        if not records and method == "GET":
+            # A GET for a file only HEAD-probed during capture
+            records = self.responses.get(("HEAD", path))
+        if not records:
+            return None
+        key = (method, path)
+        record = records[self.cursors[key] % len(records)]
+        self.cursors[key] += 1
+        return record
+
+    async def handle(self, request: web.Request) -> web.Response:
+        self.requests[request.method] += 1
+        record = self._recorded(request.method, request.rel_url.raw_path)
+
+        if record is None:
+            self.requests["unmatched"] += 1
+            await self._delay(self.miss_latency_ms)
+            return web.Response(status=404)
+
+        await self._delay(record["elapsed_ms"])
+        if record.get("status") is None:
+            self.requests["error"] += 1
+            return web.Response(status=504)
+
+        headers = dict(record.get("headers", {}))
+        if request.method == "HEAD" or record["status"] != 200:
+            return web.Response(status=record["status"], headers=headers)
+
+        headers.pop("Content-Length", None)
+        body_size = record.get("body_size") or int(record.get("headers", {}).get("Content-Length", 0))
+        return web.Response(status=200, body=b"\0" * body_size, headers=headers)
+
+    def make_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_route("*", "/{path:.*}", self.handle)
+        return app
@@ -0,0 +1,314 @@
+"""Offline benchmark suite for the image search API.
+
+Starts a local stand-in origin (see origin_server.py), points the FastAPI app
+at it through IMAGE_BASE_URL and runs it in-process with uvicorn. For each
+scenario it reports codes/sec, p50/p99 request latency and origin probes
+per code.
+
+    python -m benchmarks.run_benchmarks --latency-ms 30 --error-rate 0.01
+    python -m benchmarks.run_benchmarks --scenarios single,zip --json bench_output.json
+
+With --replay the stand-in is replaced by a recorded origin trace (see
+replay_origin.py); --record captures the origin requests of this run.
+--mirror runs the backend in local mirror mode (IMAGE_MIRROR_DIR), measuring
+after the initial sync of the synthetic folder. --store s3 serves the folder
+from a local S3 stand-in (s3_origin.py) through the S3 image store; there,
+probes per code counts ListObjectsV2 calls. --list-format csv uploads the
+batch and ZIP code lists as CSV instead of Excel workbooks.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import socket
+import sys
+import tempfile
+import time
+from io import BytesIO
+from pathlib import Path
+
+import aiohttp
+import openpyxl
+
+from benchmarks.origin_server import OriginServer, build_catalog, start_in_thread
+from benchmarks.replay_origin import ReplayOrigin
+from benchmarks.s3_origin import S3OriginServer
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent / "backend"
+SCENARIOS = ["single", "batch", "batch-async", "zip", "zip-async"]
+
+
+def percentile(values, fraction: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(fraction * len(ordered) + 0.5) - 1))
+    return ordered[index]
+
+
+def make_workbook(codes) -> bytes:
+    workbook = openpyxl.Workbook()
+    sheet = workbook.active
+    sheet.append(["CODICE", "DESCRIZIONE"])
+    for code in codes:
+        sheet.append([code, "articolo"])
+    buffer = BytesIO()
+    workbook.save(buffer)
+    return buffer.getvalue()
+
+
+def make_code_list(codes, list_format: str = "xlsx") -> tuple:
+    """(filename, content) of an uploaded code list in the given format"""
+    if list_format == "xlsx":
+        return "bench.xlsx", make_workbook(codes)
+    return "bench.csv", ("CODICE;DESCRIZIONE\n" + "".join(f"{code};articolo\n" for code in codes)).encode()
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def load_app(image_base_url: str):
+    """Import the backend with the origin pointed at the stand-in"""
+    os.environ["IMAGE_BASE_URL"] = image_base_url
+    os.environ.setdefault("MONGO_URL", "mongodb://127.0.0.1:27017")
+    os.environ.setdefault("DB_NAME", "benchmark")
+    # Measure the origin path, not the resolution caches
+    os.environ.setdefault("RESOLUTION_CACHE_ENABLED", "false")
+    os.environ.setdefault("RESOLUTION_MEMO_MAX_ENTRIES", "0")
+    os.environ.setdefault("ORIGIN_WATCH_SECONDS", "0")
+    os.environ.setdefault("MANIFEST_ENABLED", "false")
+    # ...and ZIP archives are built from scratch: the artifact cache of this run
+    # is emptied before every scenario (see clear_zip_artifacts)
+    os.environ["ZIP_ARTIFACT_DIR"] = tempfile.mkdtemp(prefix="bench-zip-artifacts-")
+    sys.path.insert(0, str(BACKEND_DIR))
+    import server
+    logging.getLogger().setLevel(logging.WARNING)
+    return server.app
+
+
+def clear_zip_artifacts():
+    """Drop the ZIP artifacts cached by earlier scenarios (zip and zip-async build the same archive)"""
+    directory = os.environ.get("ZIP_ARTIFACT_DIR")
+    if directory:
+        for path in Path(directory).glob("*.zip"):
+            path.unlink(missing_ok=True)
+
+
+class BenchmarkRunner:
+    def __init__(self, api_url: str, origin: OriginServer, codes, args):
+        self.api_url = api_url
+        self.origin = origin
+        self.codes = codes
+        self.args = args
+
+    def report(self, scenario: str, codes: int, elapsed: float, latencies) -> dict:
+        return {
+            "scenario": scenario,
+            "requests": len(latencies),
+            "codes": codes,
+            "seconds": round(elapsed, 3),
+            "codes_per_sec": round(codes / elapsed, 2) if elapsed else 0.0,
+            "p50_ms": round(percentile(latencies, 0.50) * 1000, 1),
+            "p99_ms": round(percentile(latencies, 0.99) * 1000, 1),
+            "probes_per_code": round((self.origin.requests["HEAD"] + self.origin.requests["LIST"]) / codes, 2) if codes else 0.0,
+            "origin_gets": self.origin.requests["GET"],
+            "origin_errors": self.origin.requests["error"],
+            "unmatched": self.origin.requests["unmatched"],
+        }
+
+    async def timed(self, coro):
+        started = time.perf_counter()
+        result = await coro
+        return result, time.perf_counter() - started
+
+    async def bench_single(self, session: aiohttp.ClientSession) -> dict:
+        codes = self.codes[:self.args.single_codes]
+        semaphore = asyncio.Semaphore(self.args.concurrency)
+        latencies = []
+
+        async def search(code):
+            async with semaphore:
+                started = time.perf_counter()
+                async with session.post(f"{self.api_url}/search-single", json={"code": code}) as response:
+                    await response.read()
+                latencies.append(time.perf_counter() - started)
+
+        _, elapsed = await self.timed(asyncio.gather(*(search(code) for code in codes)))
+        return self.report("single", len(codes), elapsed, latencies)
+
+    async def bench_batch(self, session: aiohttp.ClientSession) -> dict:
+        codes = self.codes[:self.args.batch_codes]
+        filename, content = make_code_list(codes, self.args.list_format)
+        latencies = []
+        started = time.perf_counter()
+        for _ in range(self.args.repeat):
+            form = aiohttp.FormData()
+            form.add_field("file", content, filename=filename)
+            request_started = time.perf_counter()
+            async with session.post(f"{self.api_url}/search-batch", data=form) as response:
+                await response.read()
+            latencies.append(time.perf_counter() - request_started)
+        return self.report("batch", len(codes) * self.args.repeat, time.perf_counter() - started, latencies)
+
+    async def start_and_wait(self, session: aiohttp.ClientSession, endpoint: str, codes) -> dict:
+        """Start a background task and poll its progress until it ends"""
+        filename, content = make_code_list(codes, self.args.list_format)
+        form = aiohttp.FormData()
+        form.add_field("file", content, filename=filename)
+        async with session.post(f"{self.api_url}/{endpoint}", data=form) as response:
+            task = await response.json()
+
+        while True:
+            await asyncio.sleep(0.2)
+            async with session.get(f"{self.api_url}/progress/{task['task_id']}") as response:
+                progress = await response.json()
+            if progress["status"] != "in_progress":
+                return progress
+
+    async def bench_batch_async(self, session: aiohttp.ClientSession) -> dict:
+        codes = self.codes[:self.args.async_codes]
+        started = time.perf_counter()
+        await self.start_and_wait(session, "search-batch-async", codes)
+        elapsed = time.perf_counter() - started
+        return self.report("batch-async", len(codes), elapsed, [elapsed])
+
+    async def bench_zip(self, session: aiohttp.ClientSession) -> dict:
+        codes = self.codes[:self.args.zip_codes]
+        filename, content = make_code_list(codes, self.args.list_format)
+        form = aiohttp.FormData()
+        form.add_field("file", content, filename=filename)
+        started = time.perf_counter()
+        async with session.post(f"{self.api_url}/download-batch-zip", data=form) as response:
+            await response.read()
+        elapsed = time.perf_counter() - started
+        return self.report("zip", len(codes), elapsed, [elapsed])
+
+    async def bench_zip_async(self, session: aiohttp.ClientSession) -> dict:
+        codes = self.codes[:self.args.zip_codes]
+        started = time.perf_counter()
+        progress = await self.start_and_wait(session, "download-batch-zip-async", codes)
+        if progress["status"] == "completed":
+            async with session.get(f"{self.api_url}/download-zip/{progress['task_id']}") as response:
+                await response.read()
+        elapsed = time.perf_counter() - started
+        return self.report("zip-async", len(codes), elapsed, [elapsed])
+
+    async def run(self, scenarios) -> list:
+        results = []
+        timeout = aiohttp.ClientTimeout(total=None)
+        async with aiohttp.ClientSession(timeout=timeout) as session:
+            for scenario in scenarios:
+                self.origin.reset_stats()
+                clear_zip_artifacts()
+                bench = getattr(self, f"bench_{scenario.replace('-', '_')}")
+                results.append(await bench(session))
+        return results
+
+
+async def wait_for_mirror(api_url: str):
+    async with aiohttp.ClientSession() as session:
+        while True:
+            async with session.get(f"{api_url}/mirror/status") as response:
+                status = await response.json()
+            if status.get("ready") or status.get("last_error"):
+                return status
+            await asyncio.sleep(0.2)
+
+
+async def run_suite(args) -> list:
+    import uvicorn
+
+    if args.replay:
+        origin = ReplayOrigin(args.replay, speed=args.replay_speed)
+        codes = origin.codes
+        origin_url = start_in_thread(origin) + origin.base_path
+    elif args.store == "s3":
+        filenames, codes = build_catalog(args.codes, missing_rate=args.missing_rate)
+        origin = S3OriginServer(filenames, bucket="bench", latency_ms=args.latency_ms,
+                                jitter_ms=args.jitter_ms, error_rate=args.error_rate)
+        origin_url = start_in_thread(origin)
+        os.environ.update(IMAGE_STORE="s3", S3_BUCKET="bench", S3_ENDPOINT_URL=origin_url)
+        for variable in ("AWS_ACCESS_KEY_ID", "AWS_SECRET_ACCESS_KEY"):
+            os.environ.setdefault(variable, "bench")
+        os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+    else:
+        filenames, codes = build_catalog(args.codes, missing_rate=args.missing_rate)
+        origin = OriginServer(filenames, args.latency_ms, args.jitter_ms, args.error_rate)
+        origin_url = start_in_thread(origin)
+    if args.record:
+        os.environ["ORIGIN_TRACE_FILE"] = args.record
+    if args.mirror:
+        os.environ["IMAGE_MIRROR_DIR"] = tempfile.mkdtemp(prefix="bench-mirror-")
+
+    app = load_app(origin_url)
+    port = free_port()
+    api_server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    serve_task = asyncio.create_task(api_server.serve())
+    while not api_server.started:
+        await asyncio.sleep(0.05)
+
+    try:
+        if args.mirror:
+            await wait_for_mirror(f"http://127.0.0.1:{port}/api")
+        runner = BenchmarkRunner(f"http://127.0.0.1:{port}/api", origin, codes, args)
+        return await runner.run(args.scenarios)
+    finally:
+        api_server.should_exit = True
+        await serve_task
+
+
+def print_table(results):
+    columns = ["scenario", "requests", "codes", "seconds", "codes_per_sec", "p50_ms", "p99_ms",
+               "probes_per_code", "origin_gets", "origin_errors", "unmatched"]
+    print("  ".join(f"{column:>15}" for column in columns))
+    for result in results:
+        print("  ".join(f"{str(result[column]):>15}" for column in columns))
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Offline benchmarks for the image search API")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS),
+                        help=f"Comma separated list of: {', '.join(SCENARIOS)}")
+    parser.add_argument("--codes", type=int, default=2000, help="Size of the synthetic catalog")
+    parser.add_argument("--missing-rate", type=float, default=0.15)
+    parser.add_argument("--latency-ms", type=float, default=20.0)
+    parser.add_argument("--jitter-ms", type=float, default=5.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--concurrency", type=int, default=8, help="Parallel /search-single clients")
+    parser.add_argument("--single-codes", type=int, default=200)
+    parser.add_argument("--batch-codes", type=int, default=50)
+    parser.add_argument("--async-codes", type=int, default=500)
+    parser.add_argument("--zip-codes", type=int, default=50)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--replay", metavar="TRACE", help="Serve a recorded origin trace instead of the synthetic folder")
+    parser.add_argument("--replay-speed", type=float, default=1.0, help="Latency divisor for --replay (0 = no delay)")
+    parser.add_argument("--record", metavar="TRACE", help="Record the origin requests of this run (ORIGIN_TRACE_FILE)")
+    parser.add_argument("--store", choices=["http", "s3"], default="http",
+                        help="Image store of the backend (s3: local S3 stand-in)")
+    parser.add_argument("--list-format", choices=["xlsx", "csv"], default="xlsx",
+                        help="Format of the code lists uploaded by the batch and ZIP scenarios")
+    parser.add_argument("--mirror", action="store_true", help="Serve lookups and downloads from a local mirror of the folder")
+    parser.add_argument("--json", dest="json_path", help="Also write the results to this file")
+    args = parser.parse_args(argv)
+    args.scenarios = [scenario.strip() for scenario in args.scenarios.split(",") if scenario.strip()]
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"Unknown scenarios: {', '.join(sorted(unknown))}")
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    results = asyncio.run(run_suite(args))
+    print_table(results)
+    if args.json_path:
+        with open(args.json_path, "w") as output:
+            json.dump(results, output, indent=2)
+
+
+if __name__ == "__main__":
+    main()
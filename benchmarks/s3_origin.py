@@ -0,0 +1,95 @@
+"""Local S3 stand-in serving the synthetic image folder as a bucket.
+
+Implements the subset of the S3 API used by the backend's S3 image store
+(ListObjectsV2 with Prefix, GetObject, HeadObject) with path-style
+addressing, so IMAGE_STORE=s3 can be exercised without AWS or MinIO:
+
+    python -m benchmarks.s3_origin --bucket images --port 9000
+    IMAGE_STORE=s3 S3_BUCKET=images S3_ENDPOINT_URL=http://127.0.0.1:9000 \
+        AWS_ACCESS_KEY_ID=test AWS_SECRET_ACCESS_KEY=test uvicorn server:app
+
+Request signatures are not verified.
+"""
+import argparse
+import urllib.parse
+from xml.sax.saxutils import escape
+
+from aiohttp import web
+
+from benchmarks.origin_server import OriginServer, build_catalog
+
+MAX_KEYS = 1000
+
+
+class S3OriginServer(OriginServer):
+    """OriginServer exposing its folder as an S3 bucket"""
+
+    def __init__(self, filenames, bucket: str = "images", **kwargs):
+        super().__init__(filenames, **kwargs)
+        self.bucket = bucket
+        self.keys = sorted(self.files)
+
+    async def handle_list(self, request: web.Request) -> web.Response:
+        if request.match_info["bucket"] != self.bucket:
+            return web.Response(status=404)
+        self.requests["LIST"] += 1
+        await self._delay()
+
+        prefix = request.query.get("prefix", "")
+        start_after = request.query.get("continuation-token") or request.query.get("start-after", "")
+        max_keys = min(int(request.query.get("max-keys", MAX_KEYS)), MAX_KEYS)
+        url_encoded = request.query.get("encoding-type") == "url"
+
+        matching = [key for key in self.keys if key.startswith(prefix) and key > start_after]
+        page, truncated = matching[:max_keys], len(matching) > max_keys
+
+        def encode(value: str) -> str:
+            return escape(urllib.parse.quote(value) if url_encoded else value)
+
+        contents = "".join(
+            f"<Contents><Key>{encode(key)}</Key><LastModified>2024-01-01T00:00:00.000Z</LastModified>"
+            f"<ETag>&quot;{abs(hash(key))}&quot;</ETag><Size>{len(self.payload)}</Size>"
+            f"<StorageClass>STANDARD</StorageClass></Contents>"
+            for key in page
+        )
+        continuation = f"<NextContinuationToken>{escape(page[-1])}</NextContinuationToken>" if truncated else ""
+        body = (
+            '<?xml version="1.0" encoding="UTF-8"?>'
+            '<ListBucketResult xmlns="http://s3.amazonaws.com/doc/2006-03-01/">'
+            f"<Name>{self.bucket}</Name><Prefix>{encode(prefix)}</Prefix><KeyCount>{len(page)}</KeyCount>"
+            f"<MaxKeys>{max_keys}</MaxKeys><IsTruncated>{'true' if truncated else 'false'}</IsTruncated>"
+            f"{'<EncodingType>url</EncodingType>' if url_encoded else ''}{contents}{continuation}"
+            "</ListBucketResult>"
+        )
+        return web.Response(text=body, content_type="application/xml")
+
+    async def handle_object(self, request: web.Request) -> web.Response:
+        if request.match_info["bucket"] != self.bucket:
+            return web.Response(status=404)
+        return await self.handle_image(request)
+
+    def make_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_get("/{bucket}", self.handle_list)
+        app.router.add_get("/{bucket}/", self.handle_list)
+        app.router.add_route("*", "/{bucket}/{name:.+}", self.handle_object)
+        return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local S3 stand-in for the image bucket")
+    parser.add_argument("--port", type=int, default=9000)
+    parser.add_argument("--bucket", default="images")
+    parser.add_argument("--codes", type=int, default=2000)
+    parser.add_argument("--latency-ms", type=float, default=20.0)
+    parser.add_argument("--jitter-ms", type=float, default=5.0)
+    args = parser.parse_args()
+
+    filenames, _ = build_catalog(args.codes)
+    origin = S3OriginServer(filenames, bucket=args.bucket, latency_ms=args.latency_ms, jitter_ms=args.jitter_ms)
+    print(f"Serving {len(filenames)} objects in bucket '{args.bucket}' on http://127.0.0.1:{args.port}")
+    web.run_app(origin.make_app(), host="127.0.0.1", port=args.port, access_log=None)
+
+
+if __name__ == "__main__":
+    main()
@@ -71,14 +71,10 @@ function App() {
 
     setSingleLoading(true);
     try {
-      console.log("Making API call to:", `${API}/search-single`);
-      const response = await fetch(`${API}/search-single`, {
-        method: 'POST',
-        headers: {
-          'Content-Type': 'application/json'
-        },
-        body: JSON.stringify({ code: singleCode.trim() })
-      });
+      // GET so that the browser cache can revalidate the result (ETag / 304)
+      const params = new URLSearchParams({ code: singleCode.trim() });
+      console.log("Making API call to:", `${API}/search-single?${params}`);
+      const response = await fetch(`${API}/search-single?${params}`);
       
       if (!response.ok) {
         throw new Error(`HTTP error! status: ${response.status}`);
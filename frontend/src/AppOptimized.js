@@ -106,11 +106,9 @@ function AppOptimized() {
     if (!singleCode.trim()) return;
     setSingleLoading(true);
     try {
-      const response = await fetch(`${API}/search-single`, {
-        method: 'POST',
-        headers: { 'Content-Type': 'application/json' },
-        body: JSON.stringify({ code: singleCode.trim() })
-      });
+      // GET: il browser riconvalida il risultato in cache (ETag / 304)
+      const params = new URLSearchParams({ code: singleCode.trim() });
+      const response = await fetch(`${API}/search-single?${params}`);
       
       if (!response.ok) throw new Error(`HTTP error! status: ${response.status}`);
       
@@ -0,0 +1,8 @@
+import os
+import sys
+from pathlib import Path
+
+# backend/server.py reads its MongoDB settings at import; the unit tests never reach the database
+os.environ.setdefault("MONGO_URL", "mongodb://127.0.0.1:1/?serverSelectionTimeoutMS=200")
+os.environ.setdefault("DB_NAME", "image_search_test")
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
@@ -0,0 +1,30 @@
+import server
+
+
+def normalize(values):
+    normalized = server.normalize_codes(values)
+    return list(normalized["code"]), list(normalized["reason"].where(normalized["reason"].notna(), None))
+
+
+def test_integer_valued_numbers_match_across_file_types():
+    codes, reasons = normalize([25627.0, "25627.0", " 25627 ", 117, "0117.00"])
+    assert codes == ["25627", "25627", "25627", "117", "0117"]
+    assert reasons == [None] * 5
+    assert list(server.normalize_codes([25627.0, "25627.0"])["duplicate"]) == [False, True]
+
+
+def test_non_integral_and_out_of_range_numbers():
+    codes, reasons = normalize([117.5, 1e20, float("inf"), "25627.5"])
+    assert reasons == ["numero non intero", "numero fuori intervallo", "numero fuori intervallo", None]
+    assert codes[3] == "25627.5"
+
+
+def test_control_characters_are_rejected():
+    codes, reasons = normalize(["25627\t1", "a\x01b", "ab\nc", "  25627\t", "A  B"])
+    assert reasons == ["caratteri di controllo"] * 3 + [None, None]
+    assert codes[3:] == ["25627", "A B"]
+
+
+def test_invalid_file_names():
+    _, reasons = normalize(["#N/A", "A/B", "---"])
+    assert reasons == ["errore di formula Excel", "caratteri non ammessi in un nome file", "nessun carattere alfanumerico"]
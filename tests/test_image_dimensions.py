@@ -0,0 +1,91 @@
+import asyncio
+import struct
+
+import pytest
+
+import server
+
+APP0 = b"\xff\xe0" + struct.pack(">H", 16) + b"JFIF\x00" + b"\x00" * 9
+EXIF = b"\xff\xe1" + struct.pack(">H", 60000) + b"E" * 59998
+SOF2 = b"\xff\xc2" + struct.pack(">HBHHB", 17, 8, 480, 640, 3) + b"\x00" * 9
+
+
+def buffer_of(data: bytes) -> server.RangeBuffer:
+    buffer = server.RangeBuffer()
+    buffer.add(0, data)
+    return buffer
+
+
+def tiff(order: str, ifd_padding: int = 0) -> bytes:
+    prefix = "<" if order == "II" else ">"
+    magic = b"II*\x00" if order == "II" else b"MM\x00*"
+    entries = (struct.pack(prefix + "HHII", 256, 4, 1, 4000)           # ImageWidth LONG
+               + struct.pack(prefix + "HHIHH", 257, 3, 1, 3000, 0))   # ImageLength SHORT
+    return (magic + struct.pack(prefix + "I", 8 + ifd_padding) + b"\x00" * ifd_padding
+            + struct.pack(prefix + "H", 2) + entries + b"\x00" * 4)
+
+
+@pytest.mark.parametrize("data, expected", [
+    (b"\x89PNG\r\n\x1a\n" + struct.pack(">I", 13) + b"IHDR" + struct.pack(">II", 1920, 1080) + b"\x08\x02\x00\x00\x00", (1920, 1080)),
+    (b"\xff\xd8" + APP0 + b"\xff\xff" + SOF2 + b"\xff\xda", (640, 480)),
+    (b"RIFF" + struct.pack("<I", 100) + b"WEBP" + b"VP8 " + struct.pack("<I", 50) + b"\x00\x00\x00\x9d\x01\x2a"
+     + struct.pack("<HH", 300, 200), (300, 200)),
+    (b"RIFF" + struct.pack("<I", 100) + b"WEBP" + b"VP8L" + struct.pack("<I", 50) + b"\x2f"
+     + struct.pack("<I", 122 | (44 << 14)), (123, 45)),
+    (tiff("II"), (4000, 3000)),
+    (tiff("MM"), (4000, 3000)),
+])
+def test_parse_image_dimensions(data, expected):
+    assert server.parse_image_dimensions(buffer_of(data + b"\x00" * 64)) == expected
+
+
+def test_unsupported_or_broken_headers():
+    # GIF is not among the candidate formats
+    assert server.parse_image_dimensions(buffer_of(b"GIF89a" + struct.pack("<HH", 10, 20) + b"\x00" * 32)) is None
+    # Start of scan before any frame header
+    assert server.parse_image_dimensions(buffer_of(b"\xff\xd8" + APP0 + b"\xff\xda" + b"\x00" * 32)) is None
+
+
+def test_missing_ranges_are_requested():
+    # The frame header follows two 60 KB EXIF blocks, past the first read
+    jpeg = b"\xff\xd8" + APP0 + EXIF + EXIF + SOF2 + b"\xff\xda"
+    buffer = buffer_of(jpeg[:server.IMAGE_HEADER_BYTES])
+    with pytest.raises(server.NeedBytes) as need:
+        server.parse_image_dimensions(buffer)
+    assert need.value.start >= server.IMAGE_HEADER_BYTES
+    buffer.add(need.value.start, jpeg[need.value.start:])
+    assert server.parse_image_dimensions(buffer) == (640, 480)
+
+
+class RangeStore:
+    """Serves byte ranges of in-memory files, recording the reads"""
+    def __init__(self, data: bytes):
+        self.data = data
+        self.reads = []
+    
+    async def read_range(self, session, url, start, length):
+        self.reads.append((start, length))
+        return self.data[start:start + length]
+
+
+def read_dimensions(monkeypatch, data: bytes, size=None):
+    store = RangeStore(data)
+    monkeypatch.setattr(server, "image_store", store)
+    return asyncio.run(server.read_image_dimensions(None, "http://origin/x", size)), store.reads
+
+
+def test_read_image_dimensions_follows_the_parser(monkeypatch):
+    data = tiff("II", ifd_padding=500000)
+    dimensions, reads = read_dimensions(monkeypatch, data, size=len(data))
+    assert dimensions == (4000, 3000)
+    assert reads == [(0, server.IMAGE_HEADER_BYTES), (500008, server.IMAGE_EXTRA_RANGE_BYTES)]
+
+
+def test_read_image_dimensions_truncated_file(monkeypatch):
+    # The header points past the end of the file: give up instead of reading again,
+    # whether the size is known from the probe or the first read came back short
+    data = tiff("II", ifd_padding=500000)[:1000]
+    for size in (len(data), None):
+        dimensions, reads = read_dimensions(monkeypatch, data, size=size)
+        assert dimensions is None
+        assert reads == [(0, server.IMAGE_HEADER_BYTES)]
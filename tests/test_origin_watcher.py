@@ -0,0 +1,56 @@
+import asyncio
+
+import pytest
+
+import server
+
+
+@pytest.mark.parametrize("filename, expected", [
+    ("25627.JPG", {"25627"}),
+    ("13025 (2).webp", {"13025 (2)", "13025", "2"}),
+    ("117 - BEST TISANIERA.jpg", {"117 - BEST TISANIERA", "117"}),
+    ("22497 - 22498 - 22499 PORTAFOTO-ASTRA.jpg",
+     {"22497 - 22498 - 22499 PORTAFOTO-ASTRA", "22497", "22497 - 22498", "22498", "22499"}),
+])
+def test_codes_for_filename(filename, expected):
+    # A superset is fine (an extra code is only searched again), a missing code is not
+    assert server.codes_for_filename(filename) == expected
+
+
+def test_codes_for_filename_ignores_other_files():
+    assert server.codes_for_filename("index.html") == set()
+    assert server.codes_for_filename("25627.gif") == set()
+    assert server.codes_for_filename("25627") == set()
+
+
+@pytest.mark.parametrize("code", ["117", "22497", "2210", "13025", "1", "abc"])
+def test_every_candidate_maps_back_to_its_code(code):
+    # Invalidation must reach every code whose search could resolve to the file
+    for _, filename, _ in server.iter_candidate_filenames(code):
+        assert code in server.codes_for_filename(filename), filename
+
+
+class Recorder:
+    def __init__(self):
+        self.discarded = []
+    
+    async def discard(self, codes):
+        self.discarded.extend(codes)
+        return len(codes)
+    
+    async def known_codes(self, codes):
+        return []
+
+
+def test_apply_invalidates_the_affected_codes(monkeypatch):
+    recorder = Recorder()
+    monkeypatch.setattr(server, "resolution_cache", recorder)
+    monkeypatch.setattr(server, "resolution_manifest", recorder)
+    watcher = server.OriginWatcher()
+    
+    asyncio.run(watcher.apply(added={"25627 (1).jpg"}, removed={"readme.txt"}, changed={"2210.png"}))
+    assert recorder.discarded == ["1", "2210", "25627", "25627 (1)"]
+    assert watcher.stats == {"added": 1, "removed": 1, "changed": 1, "codes_invalidated": 4, "codes_refreshed": 0}
+    
+    asyncio.run(watcher.apply(added=set(), removed={"readme.txt"}))
+    assert watcher.stats["codes_invalidated"] == 4
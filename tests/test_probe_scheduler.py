@@ -0,0 +1,98 @@
+import asyncio
+
+import server
+
+
+async def grant_order(scheduler, requests):
+    """Queue `requests` ((name, priority, task key)) behind a held slot; return the order they are granted"""
+    order = []
+    
+    async def probe(name, priority, task_key):
+        await scheduler.acquire(priority, task_key)
+        order.append(name)
+        scheduler.release(task_key)
+    
+    await scheduler.acquire(server.PRIORITY_INTERACTIVE, "holder")
+    tasks = []
+    for request in requests:
+        tasks.append(asyncio.create_task(probe(*request)))
+        await asyncio.sleep(0)  # queued in this order
+    scheduler.release("holder")
+    await asyncio.gather(*tasks)
+    return order
+
+
+def test_priority_classes_come_first():
+    scheduler = server.ProbeScheduler(1)
+    order = asyncio.run(grant_order(scheduler, [
+        ("warmup", server.PRIORITY_WARMUP, "w"),
+        ("batch", server.PRIORITY_BATCH, "b"),
+        ("zip", server.PRIORITY_ZIP, "z"),
+        ("interactive", server.PRIORITY_INTERACTIVE, "i"),
+    ]))
+    assert order == ["interactive", "zip", "batch", "warmup"]
+    assert scheduler.in_use == 0
+
+
+def test_tasks_of_one_class_share_slots_fairly():
+    scheduler = server.ProbeScheduler(1)
+    requests = [(f"a{index}", server.PRIORITY_BATCH, "a") for index in range(4)]
+    requests += [(f"b{index}", server.PRIORITY_BATCH, "b") for index in range(4)]
+    order = asyncio.run(grant_order(scheduler, requests))
+    # The second task does not wait for the whole backlog of the first
+    assert order == ["a0", "b0", "a1", "b1", "a2", "b2", "a3", "b3"]
+    assert scheduler._task_refs == {} and scheduler._task_time == {}
+
+
+def test_cancelled_waiter_gives_up_its_turn():
+    async def scenario():
+        scheduler = server.ProbeScheduler(1)
+        await scheduler.acquire(server.PRIORITY_BATCH, "holder")
+        cancelled = asyncio.create_task(scheduler.acquire(server.PRIORITY_BATCH, "gone"))
+        waiting = asyncio.create_task(scheduler.acquire(server.PRIORITY_BATCH, "next"))
+        await asyncio.sleep(0)
+        assert scheduler.waiting == 2
+        cancelled.cancel()
+        await asyncio.gather(cancelled, return_exceptions=True)
+        assert scheduler.waiting == 1
+        
+        scheduler.release("holder")
+        await waiting
+        assert scheduler.in_use == 1
+        scheduler.release("next")
+        return scheduler
+    
+    scheduler = asyncio.run(scenario())
+    assert scheduler.in_use == 0
+    assert scheduler._task_refs == {}
+
+
+def test_slot_granted_during_cancellation_is_released():
+    async def scenario():
+        scheduler = server.ProbeScheduler(1)
+        await scheduler.acquire(server.PRIORITY_BATCH, "holder")
+        waiter = asyncio.create_task(scheduler.acquire(server.PRIORITY_BATCH, "late"))
+        await asyncio.sleep(0)
+        # The slot is granted and the task cancelled before it resumes
+        scheduler.release("holder")
+        waiter.cancel()
+        await asyncio.gather(waiter, return_exceptions=True)
+        return scheduler
+    
+    scheduler = asyncio.run(scenario())
+    assert scheduler.in_use == 0
+    assert scheduler._task_refs == {}
+
+
+def test_slot_context_releases_on_error():
+    async def scenario():
+        scheduler = server.ProbeScheduler(2)
+        try:
+            async with scheduler.slot():
+                assert scheduler.in_use == 1
+                raise RuntimeError("probe failed")
+        except RuntimeError:
+            pass
+        return scheduler
+    
+    assert asyncio.run(scenario()).in_use == 0
@@ -0,0 +1,53 @@
+import zipfile
+import zlib
+from io import BytesIO
+
+import server
+
+TIF_CONTENT = b"II*\x00" + b"tifdata" * 5000
+JPEG_CONTENT = b"\xff\xd8" + bytes(range(256)) * 40
+
+
+def build_archive(entries):
+    buffer = BytesIO()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as zip_file:
+        for filename, payload in entries:
+            server.write_zip_payload(zip_file, filename, payload)
+        # Regular writes after precompressed entries must still land in a valid archive
+        zip_file.writestr("note.txt", b"ok")
+    buffer.seek(0)
+    return zipfile.ZipFile(buffer)
+
+
+def test_compress_zip_payload_policy():
+    stored = server.compress_zip_payload(JPEG_CONTENT, ".jpg")
+    assert stored.compress_type == zipfile.ZIP_STORED
+    assert stored.data == JPEG_CONTENT
+    
+    deflated = server.compress_zip_payload(TIF_CONTENT, ".tif")
+    assert deflated.compress_type == zipfile.ZIP_DEFLATED
+    assert len(deflated.data) < len(TIF_CONTENT)
+    assert zlib.decompress(deflated.data, -15) == TIF_CONTENT
+    assert deflated.crc == zlib.crc32(TIF_CONTENT)
+    assert deflated.file_size == len(TIF_CONTENT)
+
+
+def test_shared_payloads_make_a_valid_archive():
+    tif = server.compress_zip_payload(TIF_CONTENT, ".tif")
+    jpeg = server.compress_zip_payload(JPEG_CONTENT, ".jpg")
+    archive = build_archive([("555.tif", tif), ("556.tif", tif), ("22497.jpg", jpeg), ("22498.jpg", jpeg)])
+    
+    assert archive.testzip() is None
+    infos = {info.filename: info for info in archive.infolist()}
+    assert list(infos) == ["555.tif", "556.tif", "22497.jpg", "22498.jpg", "note.txt"]
+    for name in ("555.tif", "556.tif"):
+        assert infos[name].compress_type == zipfile.ZIP_DEFLATED
+        assert infos[name].CRC == zlib.crc32(TIF_CONTENT)
+        assert infos[name].compress_size == len(tif.data)
+        assert archive.read(name) == TIF_CONTENT
+    for name in ("22497.jpg", "22498.jpg"):
+        assert infos[name].compress_type == zipfile.ZIP_STORED
+        assert infos[name].CRC == zlib.crc32(JPEG_CONTENT)
+        assert archive.read(name) == JPEG_CONTENT
+    assert archive.read("note.txt") == b"ok"
+